@@ -0,0 +1,235 @@
+import logging
+import queue
+import sqlite3 as sql
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+logger = logging.getLogger(__name__)
+
+DATABASE = 'database.db'
+
+
+class ConnectionPool:
+	"""
+	Pool of long-lived SQLite connections in WAL mode, so that readers are not blocked by the writer.
+	Each connection keeps its own cache of prepared statements (cached_statements), which survives across
+	requests because the connection is not closed after use.
+	"""
+
+	def __init__(self, database=DATABASE, max_idle=8, synchronous='NORMAL', cached_statements=256, timeout=30.0):
+		self.database = database
+		self.synchronous = synchronous
+		self.cached_statements = cached_statements
+		self.timeout = timeout
+		self.idle = queue.LifoQueue(maxsize=max_idle)
+
+	def connect(self):
+		# a connection is only used by one thread at a time, but not always the same one.
+		con = sql.connect(self.database, timeout=self.timeout, check_same_thread=False,
+						  cached_statements=self.cached_statements)
+		con.row_factory = sql.Row
+		con.execute('PRAGMA journal_mode=WAL')
+		con.execute('PRAGMA synchronous={}'.format(self.synchronous))
+		return con
+
+	def acquire(self):
+		try:
+			return self.idle.get_nowait()
+		except queue.Empty:
+			return self.connect()
+
+	def release(self, con):
+		if con.in_transaction:
+			con.rollback()
+		try:
+			self.idle.put_nowait(con)
+		except queue.Full:
+			con.close()
+
+	@contextmanager
+	def connection(self):
+		con = self.acquire()
+		try:
+			yield con
+		finally:
+			self.release(con)
+
+	def close_all(self):
+		while True:
+			try:
+				self.idle.get_nowait().close()
+			except queue.Empty:
+				break
+
+
+def select_page(con, table, fields, where=None, params=(), limit=None, after_id=None):
+	"""
+	Keyset pagination: rows are ordered by id and the page starts right after after_id.
+	fields must be trusted column names. Returns the cursor, rows can be fetched lazily.
+	"""
+	columns = ['id'] + [f for f in fields if f != 'id']
+	clauses = []
+	params = list(params)
+	if where:
+		clauses.append(where)
+	if after_id is not None:
+		clauses.append('id > ?')
+		params.append(after_id)
+	query = 'SELECT {} FROM {}'.format(', '.join(columns), table)
+	if clauses:
+		query += ' WHERE ' + ' AND '.join(clauses)
+	query += ' ORDER BY id'
+	if limit is not None:
+		query += ' LIMIT ?'
+		params.append(limit)
+	return con.execute(query, params)
+
+
+def detail_time(meeting_date_time, offset_sec):
+	"""Wall clock 'HH:MM:SS' of a transcript line, offset_sec after the start of the meeting ('%Y-%m-%d %H:%M:%S')."""
+	try:
+		start = datetime.strptime(meeting_date_time, '%Y-%m-%d %H:%M:%S')
+	except (TypeError, ValueError):
+		start = datetime(1970, 1, 1)  # unknown start: time from the beginning of the recording.
+	return (start + timedelta(seconds=int(round(offset_sec)))).strftime('%H:%M:%S')
+
+
+def detail_offset(meeting_date_time, time_):
+	"""Inverse of detail_time: seconds between the start of the meeting and a 'HH:MM:SS' line, None if unknown."""
+	try:
+		t = datetime.strptime(time_.strip(), '%H:%M:%S')
+	except (AttributeError, ValueError):
+		return None
+	try:
+		start = datetime.strptime(meeting_date_time, '%Y-%m-%d %H:%M:%S')
+	except (TypeError, ValueError):
+		start = datetime(1970, 1, 1)
+	offset = (t.hour * 3600 + t.minute * 60 + t.second) - (start.hour * 3600 + start.minute * 60 + start.second)
+	return offset % (24 * 3600)  # meetings running past midnight.
+
+
+def label_details(con, meeting_id, meeting_date_time, segments):
+	"""
+	Sets the name of the meeting's detail lines that have none to the speaker of the segment
+	({'start', 'end', 'speaker'}, in seconds from the start of the meeting) containing their time.
+	Returns the ids of the updated lines.
+	"""
+	updates = []
+	for row in con.execute("SELECT id, time FROM detail WHERE meeting_id=? AND TRIM(COALESCE(name, ''))=''", (meeting_id,)):
+		offset = detail_offset(meeting_date_time, row['time'])
+		if offset is None:
+			continue
+		for seg in segments:
+			if seg['speaker'] is not None and seg['start'] <= offset < seg['end']:
+				updates.append((seg['speaker'], row['id']))
+				break
+	with con:
+		con.executemany("UPDATE detail SET name=? WHERE id=?", updates)
+	return [row_id for (_, row_id) in updates]
+
+
+INSERT_DETAIL = "INSERT INTO detail (name,content,time,meeting_id) VALUES (?,?,?,?)"
+
+
+def insert_details(con, rows):
+	"""
+	Inserts (name, content, time, meeting_id) rows with executemany in a single transaction.
+	Returns the ids given to the rows, in order.
+	"""
+	with con:
+		# the write lock is held until commit, so the new ids are exactly the ones above the current max.
+		con.execute('BEGIN IMMEDIATE')
+		last_id = con.execute('SELECT COALESCE(MAX(id), 0) FROM detail').fetchone()[0]
+		con.executemany(INSERT_DETAIL, rows)
+		ids = [row[0] for row in con.execute('SELECT id FROM detail WHERE id > ? ORDER BY id', (last_id,))]
+	return ids
+
+
+class DetailWriteBehind:
+	"""
+	Coalesces single transcript lines: rows are queued and written in one transaction
+	every max_rows rows or every flush_interval seconds, whichever comes first.
+	The rows are acknowledged before they are written, so they are never dropped on a transient error:
+	a failed batch is retried with exponential backoff, then written one row at a time. Rows that cannot be
+	written because the database is unavailable (sql.OperationalError, e.g. locked) stay in pending and go
+	first in the next batch; rows rejected by the database (e.g. a constraint) are logged and kept in failed.
+	"""
+
+	def __init__(self, pool, max_rows=200, flush_interval=0.5, retries=4, retry_delay=0.1):
+		self.pool = pool
+		self.max_rows = max_rows
+		self.flush_interval = flush_interval
+		self.retries = retries
+		self.retry_delay = retry_delay
+		self.rows = queue.Queue()
+		self.pending = []
+		self.failed = []
+		self.worker = threading.Thread(target=self._loop, name='detail-write-behind', daemon=True)
+		self.worker.start()
+
+	def put(self, name, content, time_, meeting_id):
+		self.rows.put((name, content, time_, meeting_id))
+
+	def close(self):
+		self.rows.put(None)
+		self.worker.join()
+		if self.pending:
+			logger.error('{} detail rows could not be written before closing.'.format(len(self.pending)))
+
+	def _insert(self, rows, attempts):
+		"""None once rows are written, else the last error."""
+		error = None
+		for attempt in range(attempts):
+			if attempt > 0:
+				time.sleep(self.retry_delay * 2 ** (attempt - 1))
+			try:
+				with self.pool.connection() as con:
+					insert_details(con, rows)
+				return None
+			except sql.OperationalError as e:
+				error = e
+			except sql.Error as e:
+				return e  # retrying the same rows does not help.
+		return error
+
+	def _flush(self, rows):
+		error = self._insert(rows, self.retries)
+		if error is None:
+			return
+		logger.warning('Could not write {} detail rows ({}): writing them one at a time.'.format(len(rows), error))
+		for i, row in enumerate(rows):
+			error = self._insert([row], 1)
+			if isinstance(error, sql.OperationalError):
+				self.pending = rows[i:]
+				logger.error('Could not write {} detail rows ({}): kept for the next flush.'.format(len(self.pending),
+																									 error))
+				return
+			if error is not None:
+				self.failed.append(row)
+				logger.error('Could not write the detail row {}: {}'.format(row, error))
+
+	def _loop(self):
+		stop = False
+		while not stop:
+			rows, self.pending = self.pending, []
+			if len(rows) == 0:
+				row = self.rows.get()
+				if row is None:
+					break
+				rows.append(row)
+			deadline = time.monotonic() + self.flush_interval
+			while len(rows) < self.max_rows:
+				timeout = deadline - time.monotonic()
+				if timeout <= 0:
+					break
+				try:
+					row = self.rows.get(timeout=timeout)
+				except queue.Empty:
+					break
+				if row is None:
+					stop = True
+					break
+				rows.append(row)
+			self._flush(rows)
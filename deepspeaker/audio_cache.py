@@ -0,0 +1,165 @@
+import logging
+import os
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+AUDIO_CACHE_DIRNAME = 'audio_cache_mmap'
+DATA_FILENAME = 'audio.f32'
+INDEX_FILENAME = 'index.npz'
+
+FILENAME = 'filename'
+INDEX_FIELDS = [FILENAME, 'speaker_id', 'start', 'length', 'voiced_start', 'voiced_end',
+                'left_blank_duration_ms', 'right_blank_duration_ms']
+
+
+def extract_speaker_id(filename):
+    return filename.split('/')[-2]
+
+
+def voiced_bounds(audio):
+    """[start, end) of audio_voice_only, as computed by AudioReader.get_audio_no_cache (|x| above its 95th percentile)."""
+    energy = np.abs(np.asarray(audio).reshape(-1))
+    offsets = np.where(energy > np.percentile(energy, 95))[0]
+    return int(offsets[0]), int(offsets[-1])
+
+
+def empty_index():
+    return {FILENAME: np.zeros(shape=(0,), dtype=np.str_),
+            'speaker_id': np.zeros(shape=(0,), dtype=np.str_),
+            'start': np.zeros(shape=(0,), dtype=np.int64),
+            'length': np.zeros(shape=(0,), dtype=np.int64),
+            'voiced_start': np.zeros(shape=(0,), dtype=np.int64),
+            'voiced_end': np.zeros(shape=(0,), dtype=np.int64),
+            'left_blank_duration_ms': np.zeros(shape=(0,), dtype=float),
+            'right_blank_duration_ms': np.zeros(shape=(0,), dtype=float)}
+
+
+class MmapAudioCache:
+    """
+    All the decoded audio of the corpus in one contiguous float32 file (audio.f32), opened with np.memmap,
+    and a small index (index.npz): filename, speaker_id, start/length in the data file, voiced bounds
+    (relative to start) and blank durations of every file.
+    Entities are the same dicts as the pkl cache, but 'audio' and 'audio_voice_only' are zero-copy views:
+    nothing is read from disk until the samples are used, and the voiced part is not stored twice.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.data_filename = os.path.join(cache_dir, DATA_FILENAME)
+        self.index_filename = os.path.join(cache_dir, INDEX_FILENAME)
+        self._data = None
+        self.index = empty_index()
+        if os.path.isfile(self.index_filename):
+            with np.load(self.index_filename) as index:
+                self.index = {k: index[k] for k in INDEX_FIELDS}
+        self._build_lookups()
+
+    def _build_lookups(self):
+        self.rows_by_filename = {f: i for i, f in enumerate(self.index[FILENAME].tolist())}
+        self.rows_by_speaker = {}
+        for i, speaker_id in enumerate(self.index['speaker_id'].tolist()):
+            self.rows_by_speaker.setdefault(speaker_id, []).append(i)
+
+    def __getstate__(self):
+        # never pickle the samples (e.g. when the reader is given to worker processes).
+        state = dict(self.__dict__)
+        state['_data'] = None
+        return state
+
+    def __len__(self):
+        return len(self.index[FILENAME])
+
+    def __contains__(self, filename):
+        return filename in self.rows_by_filename
+
+    @property
+    def speaker_ids(self):
+        return sorted(self.rows_by_speaker)
+
+    @property
+    def num_samples(self):
+        # end of the last file in the data file (the samples of removed files stay until they are overwritten).
+        return int(np.max(self.index['start'] + self.index['length'])) if len(self) > 0 else 0
+
+    @property
+    def data(self):
+        if self._data is None and self.num_samples > 0:
+            self._data = np.memmap(self.data_filename, dtype=np.float32, mode='r', shape=(self.num_samples,))
+        return self._data
+
+    def entity(self, row):
+        start, length = int(self.index['start'][row]), int(self.index['length'][row])
+        audio = self.data[start:start + length].reshape(-1, 1)
+        return {'audio': audio,
+                'audio_voice_only': audio[int(self.index['voiced_start'][row]):int(self.index['voiced_end'][row])],
+                'left_blank_duration_ms': float(self.index['left_blank_duration_ms'][row]),
+                'right_blank_duration_ms': float(self.index['right_blank_duration_ms'][row]),
+                FILENAME: str(self.index[FILENAME][row])}
+
+    def load_speakers(self, speaker_ids=None):
+        """<filename, entity> of every file of speaker_ids (all the files if None), like AudioReader.load_cache."""
+        if speaker_ids is None:
+            rows = range(len(self))
+        else:
+            rows = [row for speaker_id in speaker_ids for row in self.rows_by_speaker.get(speaker_id, [])]
+        cache = {}
+        for row in rows:
+            entity = self.entity(row)
+            cache[entity[FILENAME]] = entity
+        return cache
+
+    def remove(self, filenames):
+        """Removes filenames from the index. Their samples are not read anymore."""
+        rows = [self.rows_by_filename[f] for f in filenames if f in self]
+        if len(rows) == 0:
+            return 0
+        keep = np.ones(shape=(len(self),), dtype=bool)
+        keep[rows] = False
+        self.index = {k: v[keep] for k, v in self.index.items()}
+        self._save_index()
+        logger.info('[REMOVE AUDIO] {} files removed from {}.'.format(len(rows), self.index_filename))
+        return len(rows)
+
+    def _save_index(self):
+        tmp_filename = self.index_filename + '.tmp.npz'
+        np.savez(tmp_filename, **self.index)
+        os.replace(tmp_filename, self.index_filename)
+        self._data = None  # the file changed: re-mapped on the next access.
+        self._build_lookups()
+
+    def append(self, entities):
+        """
+        Appends the audio of entities (dicts as returned by AudioReader.get_audio_no_cache) to the data file,
+        then atomically replaces the index. Files already in the cache are skipped.
+        """
+        entities = [e for e in entities if e is not None and e[FILENAME] not in self]
+        if len(entities) == 0:
+            return 0
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        new_rows = {k: [] for k in INDEX_FIELDS}
+        position = self.num_samples
+        with open(self.data_filename, 'ab') as f:
+            # drops the samples of an append that was interrupted before its index was written.
+            f.truncate(position * np.dtype(np.float32).itemsize)
+            for entity in entities:
+                audio = np.ascontiguousarray(entity['audio'], dtype=np.float32).reshape(-1)
+                voiced_start, voiced_end = voiced_bounds(audio)
+                f.write(audio.tobytes())
+                new_rows[FILENAME].append(entity[FILENAME])
+                new_rows['speaker_id'].append(extract_speaker_id(entity[FILENAME]))
+                new_rows['start'].append(position)
+                new_rows['length'].append(len(audio))
+                new_rows['voiced_start'].append(voiced_start)
+                new_rows['voiced_end'].append(voiced_end)
+                new_rows['left_blank_duration_ms'].append(entity['left_blank_duration_ms'])
+                new_rows['right_blank_duration_ms'].append(entity['right_blank_duration_ms'])
+                position += len(audio)
+        for k in INDEX_FIELDS:
+            dtype = np.str_ if self.index[k].dtype.kind == 'U' else self.index[k].dtype
+            self.index[k] = np.concatenate([self.index[k], np.array(new_rows[k], dtype=dtype)])
+        self._save_index()
+        logger.info('[DUMP AUDIO] {} files appended to {}.'.format(len(entities), self.data_filename))
+        return len(entities)
@@ -1,12 +1,15 @@
 import logging
 import os
 import pickle
+from functools import partial
 from glob import glob
 
 import librosa
 import numpy as np
 from tqdm import tqdm
 
+from deepspeaker.audio_cache import AUDIO_CACHE_DIRNAME, MmapAudioCache, extract_speaker_id
+from deepspeaker.manifest import MANIFEST_FILENAME, Manifest
 from deepspeaker.utils import parallel_function
 
 logger = logging.getLogger(__name__)
@@ -27,6 +30,28 @@ def read_audio_from_filename(filename, sample_rate):
     return audio, filename
 
 
+def decode_audio_file(input_filename, sample_rate):
+    """Audio entity of a file: the audio, its voiced part and the durations of the blanks around it."""
+    try:
+        audio, _ = read_audio_from_filename(input_filename, sample_rate)
+        energy = np.abs(audio[:, 0])
+        silence_threshold = np.percentile(energy, 95)
+        offsets = np.where(energy > silence_threshold)[0]
+        left_blank_duration_ms = (1000.0 * offsets[0]) // sample_rate  # frame_id to duration (ms)
+        right_blank_duration_ms = (1000.0 * (len(audio) - offsets[-1])) // sample_rate
+
+        obj = {'audio': audio,
+               'audio_voice_only': audio[offsets[0]:offsets[-1]],
+               'left_blank_duration_ms': left_blank_duration_ms,
+               'right_blank_duration_ms': right_blank_duration_ms,
+               FILENAME: input_filename}
+
+        return obj
+    except librosa.util.exceptions.ParameterError as e:
+        logger.error(e)
+        logger.error('[DECODE AUDIO ERROR SKIPPING FILENAME] {}'.format(input_filename))
+
+
 def trim_silence(audio, threshold):
     """Removes silence at the beginning and end of a sample."""
     energy = librosa.feature.rmse(audio)
@@ -44,8 +69,41 @@ def trim_silence(audio, threshold):
     return audio_trim, left_blank, right_blank
 
 
-def extract_speaker_id(filename):
-    return filename.split('/')[-2]
+def split_on_silence(audio, sample_rate, max_chunk_sec=30.0, min_chunk_sec=5.0, frame_ms=10):
+    """
+    Splits audio in [start, end) chunks (in samples) of at most max_chunk_sec, cutting at silences.
+    Silence is defined as in get_audio_no_cache (|x| below its 95th percentile): each cut is placed in the
+    10ms frame with the fewest samples above this threshold (then the lowest energy) between min_chunk_sec
+    and max_chunk_sec after the previous cut.
+    """
+    energy = np.abs(np.asarray(audio).reshape(-1))
+    if len(energy) == 0:
+        return []
+    silence_threshold = np.percentile(energy, 95)
+    frame = max(1, int(sample_rate * frame_ms / 1000))
+    num_frames = len(energy) // frame
+    if num_frames == 0:
+        return [(0, len(energy))]  # shorter than one frame: nothing to cut.
+    frames = energy[0:num_frames * frame].reshape(num_frames, frame)
+    frame_energy = frames.mean(axis=1)
+    cost = np.sum(frames > silence_threshold, axis=1) * (frame_energy.max() + 1.0) + frame_energy
+
+    max_frames = max(1, int(max_chunk_sec * 1000 / frame_ms))
+    # at least one frame of choice when max_chunk_sec <= min_chunk_sec, and at least one frame of progress.
+    min_frames = max(1, min(max_frames - 1, int(min_chunk_sec * 1000 / frame_ms)))
+    chunks = []
+    start_frame = 0
+    while (num_frames - start_frame) > max_frames:
+        window = cost[start_frame + min_frames:start_frame + max_frames]
+        if len(window) == 0:
+            cut_frame = start_frame + max_frames  # max_chunk_sec of one frame: nothing to choose from.
+        else:
+            cut_frame = start_frame + min_frames + int(np.argmin(window))
+        cut = cut_frame * frame + frame // 2
+        chunks.append((start_frame * frame + (frame // 2 if start_frame else 0), cut))
+        start_frame = cut_frame
+    chunks.append((start_frame * frame + (frame // 2 if start_frame else 0), len(energy)))
+    return chunks
 
 
 def extract_sentence_id(filename):
@@ -62,14 +120,18 @@ class AudioReader:
         self.sample_rate = sample_rate
         self.multi_threading = multi_threading
         self.cache_pkl_dir = os.path.join(self.cache_dir, 'audio_cache_pkl')
-        self.pkl_filenames = find_files(self.cache_pkl_dir, pattern='/**/*.pkl')
+        self.audio_cache = MmapAudioCache(os.path.join(self.cache_dir, AUDIO_CACHE_DIRNAME))
+        # the pkl cache (older format) is only globbed when there is no memory-mapped cache.
+        self.pkl_filenames = []
+        if len(self.audio_cache) == 0:
+            self.pkl_filenames = find_files(self.cache_pkl_dir, pattern='/**/*.pkl')
         self.inference_wav_filenames = find_files(os.path.join(os.getcwd(), 'samples'), pattern='/**/*.wav')
 
         logger.info('audio_dir = {}'.format(self.audio_dir))
         logger.info('cache_dir = {}'.format(self.cache_dir))
         logger.info('sample_rate = {}'.format(sample_rate))
 
-        speakers = set()
+        speakers = set(self.audio_cache.speaker_ids)
         self.speaker_ids_to_filename = {}
         self.speaker_ids_to_filename_wav = {}
         for pkl_filename in self.pkl_filenames:
@@ -90,7 +152,8 @@ class AudioReader:
         return list(self.speaker_ids_to_filename_wav.keys())
 
     def load_cache(self, speakers_sub_list=None):
-        cache = {}
+        # memory-mapped cache: an index lookup, the samples are read lazily.
+        cache = self.audio_cache.load_speakers(speakers_sub_list)
         metadata = {}
 
         if speakers_sub_list is None:
@@ -98,7 +161,7 @@ class AudioReader:
         else:
             filenames = []
             for speaker_id in speakers_sub_list:
-                filenames.extend(self.speaker_ids_to_filename[speaker_id])
+                filenames.extend(self.speaker_ids_to_filename.get(speaker_id, []))
 
         for pkl_file in filenames:
             with open(pkl_file, 'rb') as f:
@@ -138,77 +201,62 @@ class AudioReader:
 
         return audio
 
-    def build_cache(self):
-        if not os.path.exists(self.cache_pkl_dir):
-            os.makedirs(self.cache_pkl_dir)
-        logger.info('Nothing found at {}. Generating all the cache now.'.format(self.cache_pkl_dir))
+    def load_manifest(self):
+        # what the memory-mapped cache was built from.
+        return Manifest(os.path.join(self.audio_cache.cache_dir, MANIFEST_FILENAME),
+                        params={'sample_rate': self.sample_rate})
+
+    def build_cache(self, feature_executor=None, batch_size=256):
+        logger.info('Building the audio cache in {}.'.format(self.audio_cache.cache_dir))
         logger.info('Looking for the audio dataset in {}.'.format(self.audio_dir))
         audio_files = find_files(self.audio_dir)
         audio_files_count = len(audio_files)
         assert audio_files_count != 0, 'Generate your cache please.'
         logger.info('Found {} files in total in {}.'.format(audio_files_count, self.audio_dir))
-        assert len(audio_files) != 0
 
-        if self.multi_threading:
-            num_threads = os.cpu_count()
-            parallel_function(self.dump_audio_to_pkl_cache, audio_files, num_threads)
-        else:
-            bar = tqdm(audio_files)
-            for filename in bar:
-                bar.set_description(filename)
-                self.dump_audio_to_pkl_cache(filename)
-            bar.close()
-
-    def dump_audio_to_pkl_cache(self, input_filename):
-        try:
-            cache_filename = input_filename.split('/')[-1].split('.')[0] + '_cache'
-            pkl_filename = os.path.join(self.cache_pkl_dir, cache_filename) + '.pkl'
-
-            if os.path.isfile(pkl_filename):
-                logger.info('[FILE ALREADY EXISTS] {}'.format(pkl_filename))
-                return
-
-            audio, _ = read_audio_from_filename(input_filename, self.sample_rate)
-            energy = np.abs(audio[:, 0])
-            silence_threshold = np.percentile(energy, 95)
-            offsets = np.where(energy > silence_threshold)[0]
-            left_blank_duration_ms = (1000.0 * offsets[0]) // self.sample_rate  # frame_id to duration (ms)
-            right_blank_duration_ms = (1000.0 * (len(audio) - offsets[-1])) // self.sample_rate
-            # _, left_blank, right_blank = trim_silence(audio[:, 0], silence_threshold)
-            # logger.info('_' * 100)
-            # logger.info('left_blank_duration_ms = {}, right_blank_duration_ms = {}, '
-            #             'audio_length = {} frames, silence_threshold = {}'.format(left_blank_duration_ms,
-            #                                                                       right_blank_duration_ms,
-            #                                                                       len(audio),
-            #                                                                       silence_threshold))
-            obj = {'audio': audio,
-                   'audio_voice_only': audio[offsets[0]:offsets[-1]],
-                   'left_blank_duration_ms': left_blank_duration_ms,
-                   'right_blank_duration_ms': right_blank_duration_ms,
-                   FILENAME: input_filename}
-
-            with open(pkl_filename, 'wb') as f:
-                pickle.dump(obj, f)
-                logger.info('[DUMP AUDIO] {}'.format(pkl_filename))
-        except librosa.util.exceptions.ParameterError as e:
-            logger.error(e)
-            logger.error('[DUMP AUDIO ERROR SKIPPING FILENAME] {}'.format(input_filename))
+        # only the new and modified files are decoded (cf. manifest). Files cached before the manifest
+        # existed (e.g. converted from pkl) are trusted as they are.
+        manifest = self.load_manifest()
+        if not manifest.params_changed:
+            manifest.record([f for f in audio_files if f in self.audio_cache and f not in manifest.files])
+        changed = manifest.changed(audio_files)
+        removed = manifest.removed(audio_files)
+        logger.info('{} new or modified files, {} removed files.'.format(len(changed), len(removed)))
+        self.audio_cache.remove(changed + removed)
+        manifest.forget(removed)
+        manifest.save()
+
+        # decoded batch_size files at a time, then appended to the memory-mapped cache in order.
+        bar = tqdm(total=len(changed))
+        for i in range(0, len(changed), batch_size):
+            batch = changed[i:i + batch_size]
+            if feature_executor is not None:
+                # decoding and trimming are CPU bound: worker processes instead of threads.
+                entities = feature_executor.map(decode_audio_file, batch, [self.sample_rate] * len(batch))
+            elif self.multi_threading:
+                entities = parallel_function(partial(decode_audio_file, sample_rate=self.sample_rate),
+                                             batch, os.cpu_count())
+            else:
+                entities = [decode_audio_file(filename, self.sample_rate) for filename in batch]
+            self.audio_cache.append(entities)
+            manifest.record([e[FILENAME] for e in entities if e is not None])
+            manifest.save()
+            bar.update(len(batch))
+        bar.close()
+        return changed, removed
+
+    def convert_pkl_cache(self):
+        """Moves the per-file pkl cache into the memory-mapped cache. The pkl files are kept."""
+        pkl_filenames = find_files(self.cache_pkl_dir, pattern='/**/*.pkl')
+        logger.info('Converting {} pkl files from {}.'.format(len(pkl_filenames), self.cache_pkl_dir))
+        for i in tqdm(range(0, len(pkl_filenames), 256)):
+            entities = []
+            for pkl_file in pkl_filenames[i:i + 256]:
+                with open(pkl_file, 'rb') as f:
+                    obj = pickle.load(f)
+                if FILENAME in obj:
+                    entities.append(obj)
+            self.audio_cache.append(entities)
 
     def get_audio_no_cache(self, input_filename):
-        try:
-            audio, _ = read_audio_from_filename(input_filename, self.sample_rate)
-            energy = np.abs(audio[:, 0])
-            silence_threshold = np.percentile(energy, 95)
-            offsets = np.where(energy > silence_threshold)[0]
-            left_blank_duration_ms = (1000.0 * offsets[0]) // self.sample_rate  # frame_id to duration (ms)
-            right_blank_duration_ms = (1000.0 * (len(audio) - offsets[-1])) // self.sample_rate
-
-            obj = {'audio': audio,
-                   'audio_voice_only': audio[offsets[0]:offsets[-1]],
-                   'left_blank_duration_ms': left_blank_duration_ms,
-                   'right_blank_duration_ms': right_blank_duration_ms,
-                   FILENAME: input_filename}
-
-            return obj
-        except librosa.util.exceptions.ParameterError as e:
-            logger.error(e)
+        return decode_audio_file(input_filename, self.sample_rate)
@@ -0,0 +1,100 @@
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class BatchingScheduler:
+    """
+    Long-lived worker that runs predict_fn on batches gathered from concurrent callers.
+    A batch is flushed when it holds max_batch_size rows or when its first request waited max_wait_ms.
+    Each caller gets back the rows of the output matching its own inputs.
+    """
+
+    def __init__(self, predict_fn, max_batch_size=4096, max_wait_ms=5):
+        self.predict_fn = predict_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait_sec = max_wait_ms / 1000.0
+        self.requests = queue.Queue()
+        self.closed = False
+        # submit and close are serialized: no request can be queued after the stop sentinel.
+        self.lock = threading.Lock()
+        self.worker = threading.Thread(target=self._loop, name='batching-scheduler', daemon=True)
+        self.worker.start()
+
+    def submit(self, x):
+        future = Future()
+        with self.lock:
+            if self.closed:
+                raise RuntimeError('Scheduler is closed.')
+            self.requests.put((np.asarray(x), future))
+        return future
+
+    def predict(self, x):
+        return self.submit(x).result()
+
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.requests.put(None)
+        self.worker.join()
+        # nothing should be left, but a caller must never wait forever on a future.
+        while True:
+            try:
+                item = self.requests.get_nowait()
+            except queue.Empty:
+                break
+            if item is not None and item[1].set_running_or_notify_cancel():
+                item[1].set_exception(RuntimeError('Scheduler is closed.'))
+
+    def _next_batch(self):
+        first = self.requests.get()
+        if first is None:
+            return None
+        batch = [first]
+        num_rows = len(first[0])
+        deadline = time.monotonic() + self.max_wait_sec
+        while num_rows < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = self.requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if item is None:
+                # stop after this batch.
+                self.requests.put(None)
+                break
+            batch.append(item)
+            num_rows += len(item[0])
+        return batch
+
+    def _loop(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                break
+            batch = [(x, f) for (x, f) in batch if f.set_running_or_notify_cancel()]
+            if len(batch) == 0:
+                continue
+            inputs = [x for (x, _) in batch]
+            futures = [f for (_, f) in batch]
+            try:
+                outputs = self.predict_fn(np.vstack(inputs))
+            except Exception as e:
+                logger.exception('Batch prediction failed.')
+                for f in futures:
+                    f.set_exception(e)
+                continue
+            logger.debug('Predicted {} requests in one batch of {} rows.'.format(len(inputs), len(outputs)))
+            splits = np.cumsum([len(x) for x in inputs])[:-1]
+            for f, output in zip(futures, np.split(outputs, splits)):
+                f.set_result(output)
@@ -4,8 +4,10 @@ import shutil
 import time
 from argparse import ArgumentParser
 
+from deepspeaker.audio_cache import AUDIO_CACHE_DIRNAME, MmapAudioCache
 from deepspeaker.audio_reader import AudioReader
 from deepspeaker.constants import c
+from deepspeaker.feature_executor import FeatureExecutor
 from deepspeaker.utils import InputsGenerator
 
 
@@ -15,15 +17,21 @@ def arg_parse():
     arg_p.add_argument('--cache_output_dir', default=os.path.join(os.getcwd(), 'data', 'cache'))
     arg_p.add_argument('--regenerate_full_cache', action='store_true')
     arg_p.add_argument('--update_cache', action='store_true')
+    arg_p.add_argument('--convert_pkl_cache', action='store_true')  # pkl cache -> memory-mapped cache.
     arg_p.add_argument('--generate_training_inputs', action='store_true')
     arg_p.add_argument('--multi_threading', action='store_true')
+    arg_p.add_argument('--feature_workers', type=int, default=0)  # > 0: feature extraction in N processes.
     arg_p.add_argument('--unseen_speakers')  # p225,p226 example.
     arg_p.add_argument('--get_embeddings')  # p225 example.
     arg_p.add_argument('--inference')
+    arg_p.add_argument('--enroll_speakers', action='store_true')  # rebuilds the gallery from samples/.
+    arg_p.add_argument('--gallery_dtype', choices=['float32', 'float16', 'int8'])  # storage of the gallery.
+    arg_p.add_argument('--gallery_pca_dim', type=int)  # PCA fit on the training speakers.
+    arg_p.add_argument('--codec_report', action='store_true')  # accuracy delta of the codec vs float32.
     return arg_p
 
 
-def regenerate_full_cache(audio_reader, args):
+def regenerate_full_cache(audio_reader, args, feature_executor=None):
     cache_output_dir = os.path.expanduser(args.cache_output_dir)
     print('The directory containing the cache is {}.'.format(cache_output_dir))
     print('Going to wipe out and regenerate the cache in 5 seconds. Ctrl+C to kill this script.')
@@ -33,16 +41,18 @@ def regenerate_full_cache(audio_reader, args):
     except:
         pass
     os.makedirs(cache_output_dir)
-    audio_reader.build_cache()
+    audio_reader.audio_cache = MmapAudioCache(os.path.join(cache_output_dir, AUDIO_CACHE_DIRNAME))
+    audio_reader.build_cache(feature_executor=feature_executor)
 
 
-def generate_cache_from_training_inputs(audio_reader, args):
+def generate_cache_from_training_inputs(audio_reader, args, feature_executor=None):
     cache_dir = os.path.expanduser(args.cache_output_dir)
     inputs_generator = InputsGenerator(cache_dir=cache_dir,
                                        audio_reader=audio_reader,
                                        max_count_per_class=1000,
                                        speakers_sub_list=None,
-                                       multi_threading=args.multi_threading)
+                                       multi_threading=args.multi_threading,
+                                       feature_executor=feature_executor)
     inputs_generator.start_generation()
 
 
@@ -53,17 +63,22 @@ def main():
                                output_cache_dir=args.cache_output_dir,
                                sample_rate=c.AUDIO.SAMPLE_RATE,
                                multi_threading=args.multi_threading)
+    feature_executor = FeatureExecutor(args.feature_workers) if args.feature_workers > 0 else None
 
     if args.regenerate_full_cache:
-        regenerate_full_cache(audio_reader, args)
+        regenerate_full_cache(audio_reader, args, feature_executor)
         exit(1)
 
     if args.update_cache:
-        audio_reader.build_cache()
+        audio_reader.build_cache(feature_executor=feature_executor)
+        exit(1)
+
+    if args.convert_pkl_cache:
+        audio_reader.convert_pkl_cache()
         exit(1)
 
     if args.generate_training_inputs:
-        generate_cache_from_training_inputs(audio_reader, args)
+        generate_cache_from_training_inputs(audio_reader, args, feature_executor)
         exit(1)
 
     if args.inference is not None:
@@ -75,6 +90,20 @@ def main():
         print(results)
         exit(1)
 
+    if args.enroll_speakers or args.codec_report:
+        from deepspeaker.unseen_speakers import MultithreadsInference
+        inference = MultithreadsInference(audio_reader=audio_reader, auto_enroll=False,
+                                          feature_executor=feature_executor)
+        codec = None
+        if args.gallery_dtype is not None or args.gallery_pca_dim is not None:
+            codec = inference.make_codec(dtype=args.gallery_dtype or 'float32', pca_dim=args.gallery_pca_dim)
+        if args.codec_report:
+            print(inference.codec_report(codec or inference.make_codec()))
+        if args.enroll_speakers:
+            inference.gallery_codec = codec
+            inference.enroll()
+        exit(1)
+
     if args.get_embeddings is not None:
         speaker_id = args.get_embeddings.strip()
         from unseen_speakers import inference_embeddings
@@ -0,0 +1,108 @@
+import logging
+
+import numpy as np
+
+from deepspeaker.gallery import l2_normalize
+from deepspeaker.speech_features import CONTEXT_STEP, WINDOW_STEP_SEC, iter_mfcc_features_390
+
+logger = logging.getLogger(__name__)
+
+ROW_HOP_SEC = CONTEXT_STEP * WINDOW_STEP_SEC  # time between two consecutive inputs (30ms).
+SILENCE_LOG_ENERGY_RANGE = 5.0  # inputs more than 5 (log energy) below the loud ones are silence.
+UNKNOWN_SPEAKER = None
+
+
+def hop_embeddings(sig, rate, embed_fn, hop_rows, block_rows=12000):
+    """
+    Embeds every input of the signal in batches and sums the embeddings per hop of hop_rows inputs.
+    Only voiced inputs are summed. Returns (hop_sums (num_hops, emb_dim), voiced_counts (num_hops,)).
+    Memory is bounded by block_rows, whatever the length of the signal.
+    """
+    block_rows -= block_rows % hop_rows  # hops never straddle two blocks.
+
+    # first pass: normalization statistics over all the inputs (cf. generate_features_for_new_file).
+    count, total, total_sq, energies = 0, 0.0, 0.0, []
+    for _, feat in iter_mfcc_features_390(sig, rate, block_rows):
+        count += feat.size
+        total += np.sum(feat)
+        total_sq += np.sum(np.square(feat))
+        energies.append(np.mean(feat[:, 0:10], axis=1))  # c0 = log energy of the 10 stacked frames.
+    if count == 0:
+        return np.zeros(shape=(0, 0), dtype=np.float32), np.zeros(shape=(0,), dtype=int)
+    mean = total / count
+    std = np.sqrt(max(total_sq / count - mean ** 2, 1e-12))
+    energies = np.concatenate(energies)
+    voiced = energies > np.percentile(energies, 95) - SILENCE_LOG_ENERGY_RANGE
+
+    # second pass: embeddings, summed per hop.
+    num_hops = int(np.ceil(len(energies) / hop_rows))
+    hop_sums, voiced_counts = None, np.zeros(shape=(num_hops,), dtype=int)
+    for first_row, feat in iter_mfcc_features_390(sig, rate, block_rows):
+        emb = np.asarray(embed_fn((feat - mean) / std))
+        if hop_sums is None:
+            hop_sums = np.zeros(shape=(num_hops, emb.shape[1]), dtype=np.float32)
+        mask = voiced[first_row:first_row + len(emb)]
+        hop_ids = (first_row + np.arange(len(emb))) // hop_rows
+        np.add.at(hop_sums, hop_ids[mask], emb[mask])
+        voiced_counts += np.bincount(hop_ids[mask], minlength=num_hops)
+    return hop_sums, voiced_counts
+
+
+def change_points(hop_sums, window_hops, threshold=None):
+    """
+    Hops where the cosine distance between the window before and the window after is a local maximum above threshold.
+    The scale of the distances depends on the model: by default the threshold is mean + std of all the distances.
+    """
+    num_hops = len(hop_sums)
+    if num_hops < 2 * window_hops:
+        return []
+    cumsum = np.concatenate([np.zeros_like(hop_sums[0:1]), np.cumsum(hop_sums, axis=0)])
+    candidates = np.arange(window_hops, num_hops - window_hops + 1)
+    left = l2_normalize(cumsum[candidates] - cumsum[candidates - window_hops])
+    right = l2_normalize(cumsum[candidates + window_hops] - cumsum[candidates])
+    distances = 1.0 - np.sum(left * right, axis=1)
+    if threshold is None:
+        threshold = np.mean(distances) + np.std(distances)
+    points = []
+    for i in np.argsort(-distances):
+        if distances[i] <= threshold:
+            break
+        # greedy non-maximum suppression: turns are at least one window apart.
+        if all(abs(candidates[i] - p) >= window_hops for p in points):
+            points.append(int(candidates[i]))
+    return sorted(points)
+
+
+def diarize(sig, rate, embed_fn, gallery, window_sec=1.5, hop_sec=0.3, change_threshold=None,
+            match_threshold=0.1, min_voiced_ratio=0.3):
+    """
+    Speaker turns of a long recording, matched against the enrolled speakers of gallery.
+    Returns [{'start', 'end', 'speaker', 'cosine'}] (seconds); speaker is None when no enrolled speaker
+    is closer than match_threshold. Silent parts are not reported. Consecutive turns of the same speaker are merged.
+    """
+    hop_rows = max(1, int(round(hop_sec / ROW_HOP_SEC)))
+    window_hops = max(1, int(round(window_sec / (hop_rows * ROW_HOP_SEC))))
+    hop_sums, voiced_counts = hop_embeddings(sig, rate, embed_fn, hop_rows)
+    if len(hop_sums) == 0:
+        return []
+    bounds = [0] + change_points(hop_sums, window_hops, change_threshold) + [len(hop_sums)]
+    logger.info('{} speaker turns found.'.format(len(bounds) - 1))
+
+    segments = []
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        if np.sum(voiced_counts[start:end]) < min_voiced_ratio * hop_rows * (end - start):
+            continue
+        distances = gallery.distances(np.sum(hop_sums[start:end], axis=0))
+        speaker, cosine = UNKNOWN_SPEAKER, None
+        if len(distances) > 0:
+            best = int(np.argmin(distances))
+            cosine = float(distances[best])
+            if cosine <= match_threshold:
+                speaker = gallery.speaker_ids[best]
+        segment = {'start': start * hop_rows * ROW_HOP_SEC, 'end': end * hop_rows * ROW_HOP_SEC,
+                   'speaker': speaker, 'cosine': cosine}
+        if segments and segments[-1]['speaker'] == speaker and segments[-1]['end'] == segment['start']:
+            segments[-1]['end'] = segment['end']
+        else:
+            segments.append(segment)
+    return segments
@@ -0,0 +1,139 @@
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+DTYPES = ('float32', 'float16', 'int8')
+INT8_SCALE = 127.0  # codes are L2-normalized: every component is in [-1, 1].
+BLOCK_ROWS = 4096
+
+
+def l2_normalize(x, axis=-1, epsilon=1e-12):
+    x = np.asarray(x, dtype=np.float32)
+    norm = np.sqrt(np.maximum(np.sum(np.square(x), axis=axis, keepdims=True), epsilon))
+    return x / norm
+
+
+def fit_pca(embeddings, dim, center=False):
+    """
+    (mean, components (dim, emb_dim)) of the principal subspace of embeddings (e.g. of the training speakers).
+    Not centered by default: the cosine distances, and so the match thresholds, stay on the same scale.
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float64)
+    mean = np.mean(embeddings, axis=0) if center else np.zeros(shape=embeddings.shape[1:])
+    _, _, vt = np.linalg.svd(embeddings - mean, full_matrices=False)
+    return mean.astype(np.float32), vt[0:dim].astype(np.float32)
+
+
+class EmbeddingCodec:
+    """
+    Compact representation of the gallery embeddings: an optional PCA projection to a smaller dimension, then
+    L2 normalization, then float16 or int8 scalar quantization. Cosine similarities are computed directly on the
+    codes, block_rows at a time: no full precision copy of the gallery is ever held in memory.
+    """
+
+    def __init__(self, dtype='float32', pca_mean=None, pca_components=None):
+        assert dtype in DTYPES, 'Unknown dtype {}.'.format(dtype)
+        self.dtype = dtype
+        self.pca_mean = None if pca_mean is None else np.asarray(pca_mean, dtype=np.float32)
+        self.pca_components = None if pca_components is None else np.asarray(pca_components, dtype=np.float32)
+
+    @property
+    def name(self):
+        return self.dtype if self.pca_components is None else '{}+pca{}'.format(self.dtype, len(self.pca_components))
+
+    def project(self, x):
+        x = np.asarray(x, dtype=np.float32)
+        if self.pca_components is not None:
+            x = (x - self.pca_mean).dot(self.pca_components.T)
+        return l2_normalize(x)
+
+    def encode(self, embeddings):
+        x = self.project(embeddings)
+        if self.dtype == 'int8':
+            return np.round(x * INT8_SCALE).astype(np.int8)
+        return x.astype(self.dtype)
+
+    def decode(self, codes):
+        x = np.asarray(codes, dtype=np.float32)
+        return x / INT8_SCALE if self.dtype == 'int8' else x
+
+    def similarities(self, codes, embedding, norms=None, block_rows=BLOCK_ROWS):
+        """
+        Cosine similarity between embedding (full precision, not projected) and every code.
+        norms: self.norms(codes), to compute only once for int8 codes.
+        """
+        query = self.project(embedding)
+        if self.dtype == 'float32':
+            return codes.dot(query)
+        out = np.empty(shape=(len(codes),), dtype=np.float32)
+        for i in range(0, len(codes), block_rows):
+            out[i:i + block_rows] = self.decode(codes[i:i + block_rows]).dot(query)
+        if self.dtype == 'int8':
+            # rounding changes the norms a little: cosine, not dot product.
+            out /= self.norms(codes) if norms is None else norms
+        return out
+
+    def norms(self, codes, block_rows=BLOCK_ROWS):
+        norms = np.empty(shape=(len(codes),), dtype=np.float32)
+        for i in range(0, len(codes), block_rows):
+            norms[i:i + block_rows] = np.linalg.norm(self.decode(codes[i:i + block_rows]), axis=1)
+        return np.maximum(norms, 1e-12)
+
+    def to_arrays(self):
+        arrays = {'codec_dtype': np.array(self.dtype)}
+        if self.pca_components is not None:
+            arrays['pca_mean'] = self.pca_mean
+            arrays['pca_components'] = self.pca_components
+        return arrays
+
+    @staticmethod
+    def from_arrays(arrays):
+        if 'codec_dtype' not in arrays:
+            return EmbeddingCodec()  # galleries saved before the codecs: float32.
+        return EmbeddingCodec(dtype=str(arrays['codec_dtype']),
+                              pca_mean=arrays['pca_mean'] if 'pca_mean' in arrays else None,
+                              pca_components=arrays['pca_components'] if 'pca_components' in arrays else None)
+
+
+def codec_report(codec, speaker_ids, recordings):
+    """
+    Accuracy delta of codec against the full precision gallery, on held-out recordings: recordings[i] holds the
+    embeddings (num_files, dim) of the recordings of speaker_ids[i]. Each recording is identified (top 1) against
+    a gallery where its own speaker is the mean of their other recordings (leave-one-out), so that it is never
+    scored against itself. Speakers with a single recording are only in the galleries.
+    Returns a dict of the figures.
+    """
+    full = EmbeddingCodec()
+    recordings = [np.asarray(r, dtype=np.float32).reshape(len(r), -1) for r in recordings]
+    embeddings = np.vstack([np.mean(r, axis=0) for r in recordings])
+    full_codes, codes = full.encode(embeddings), codec.encode(embeddings)
+    speaker_ids = np.asarray(speaker_ids)
+    correct_full, correct, agree, max_error, n = 0, 0, 0, 0.0, 0
+    for row, speaker_recordings in enumerate(recordings):
+        if len(speaker_recordings) < 2:
+            continue
+        for i, query in enumerate(speaker_recordings):
+            held_out = np.mean(np.delete(speaker_recordings, i, axis=0), axis=0)
+            full_codes_i, codes_i = full_codes.copy(), codes.copy()
+            full_codes_i[row], codes_i[row] = full.encode(held_out), codec.encode(held_out)
+            sim_full = full.similarities(full_codes_i, query)
+            sim = codec.similarities(codes_i, query)
+            best_full, best = speaker_ids[np.argmax(sim_full)], speaker_ids[np.argmax(sim)]
+            correct_full += best_full == speaker_ids[row]
+            correct += best == speaker_ids[row]
+            agree += best_full == best
+            max_error = max(max_error, float(np.max(np.abs(sim_full - sim))))
+            n += 1
+    report = {'codec': codec.name,
+              'bytes_full': int(full_codes.nbytes),
+              'bytes': int(codes.nbytes),
+              'queries': n,
+              'accuracy_full': correct_full / max(1, n),
+              'accuracy': correct / max(1, n),
+              'accuracy_delta': (correct - correct_full) / max(1, n),
+              'top1_agreement': agree / max(1, n),
+              'max_distance_error': max_error}
+    logger.info('Codec {}: {}.'.format(codec.name, report))
+    return report
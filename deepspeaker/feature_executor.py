@@ -0,0 +1,114 @@
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+from deepspeaker.speech_features import get_mfcc_features_390, num_stacked_frames
+
+logger = logging.getLogger(__name__)
+
+
+def _mfcc_features_390_worker(in_name, in_shape, in_dtype, out_name, out_shape, rate):
+    # runs in a worker process: reads the signal and writes the features in place, nothing is pickled.
+    shm_in = SharedMemory(name=in_name)
+    shm_out = SharedMemory(name=out_name)
+    try:
+        sig = np.ndarray(in_shape, dtype=in_dtype, buffer=shm_in.buf)
+        out = np.ndarray(out_shape, dtype=float, buffer=shm_out.buf)
+        out[:] = get_mfcc_features_390(sig, rate)
+        del sig, out
+    finally:
+        shm_in.close()
+        shm_out.close()
+
+
+class FeatureExtraction:
+    """Pending get_mfcc_features_390 in a worker process. result() returns the features and frees the shared memory."""
+
+    def __init__(self, future, shm_in, shm_out, out_shape):
+        self.future = future
+        self.shm_in = shm_in
+        self.shm_out = shm_out
+        self.out_shape = out_shape
+
+    def result(self):
+        if self.future is None:
+            return np.array([])
+        try:
+            self.future.result()
+            return np.array(np.ndarray(self.out_shape, dtype=float, buffer=self.shm_out.buf))
+        finally:
+            self._free()
+
+    def release(self):
+        """Drops the result: cancels the extraction (or waits for the worker to be done) and frees the shared memory."""
+        if self.future is None:
+            return
+        if not self.future.cancel():
+            self.future.exception()  # waits, the error if any is not ours to raise.
+        self._free()
+
+    def _free(self):
+        for shm in (self.shm_in, self.shm_out):
+            shm.close()
+            shm.unlink()
+
+
+class FeatureExecutor:
+    """
+    Persistent pool of processes for the CPU heavy feature extraction, which does not scale with threads (GIL).
+    Signals are given to the workers and features are given back through shared memory.
+    map() and submit() also expose the pool for any other picklable work (e.g. decoding audio files).
+    """
+
+    def __init__(self, num_workers=None):
+        self.num_workers = num_workers or os.cpu_count()
+        # the workers start lazily, when the process may already run threads (e.g. the server's): they are not
+        # forked from it, a lock held by another thread at fork time would never be released in the child.
+        self.pool = ProcessPoolExecutor(max_workers=self.num_workers,
+                                        mp_context=multiprocessing.get_context('forkserver'))
+        logger.info('Feature extraction uses {} processes.'.format(self.num_workers))
+
+    def submit_mfcc_features_390(self, sig, rate):
+        sig = np.ascontiguousarray(sig)
+        out_shape = (num_stacked_frames(len(sig), rate), 390)
+        if out_shape[0] == 0:
+            return FeatureExtraction(None, None, None, None)
+        shm_in = SharedMemory(create=True, size=sig.nbytes)
+        shm_out = SharedMemory(create=True, size=int(np.prod(out_shape)) * np.dtype(float).itemsize)
+        np.ndarray(sig.shape, dtype=sig.dtype, buffer=shm_in.buf)[:] = sig
+        future = self.pool.submit(_mfcc_features_390_worker, shm_in.name, sig.shape, sig.dtype.str,
+                                  shm_out.name, out_shape, rate)
+        return FeatureExtraction(future, shm_in, shm_out, out_shape)
+
+    def mfcc_features_390(self, sig, rate):
+        return self.submit_mfcc_features_390(sig, rate).result()
+
+    def map_mfcc_features_390(self, signals, rate, max_pending=None):
+        """get_mfcc_features_390 of every signal, in order. At most max_pending signals are in shared memory at once."""
+        max_pending = max_pending or 4 * self.num_workers
+        pending, results = [], []
+        try:
+            for sig in signals:
+                pending.append(self.submit_mfcc_features_390(sig, rate))
+                if len(pending) >= max_pending:
+                    results.append(pending.pop(0).result())
+            while len(pending) > 0:
+                results.append(pending.pop(0).result())
+        finally:
+            # on error, the shared memory of the extractions still pending is freed as well.
+            for p in pending:
+                p.release()
+        return results
+
+    def submit(self, fn, *args, **kwargs):
+        return self.pool.submit(fn, *args, **kwargs)
+
+    def map(self, fn, *iterables):
+        return list(self.pool.map(fn, *iterables))
+
+    def shutdown(self):
+        self.pool.shutdown(wait=True)
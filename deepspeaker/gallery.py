@@ -0,0 +1,173 @@
+import hashlib
+import logging
+import os
+import threading
+
+import numpy as np
+
+from deepspeaker.embedding_codec import EmbeddingCodec, l2_normalize
+
+logger = logging.getLogger(__name__)
+
+GALLERY_FILENAME = 'deepspeaker/gallery.npz'
+IVF_MIN_SIZE = 10000  # below, an exhaustive search is as fast.
+
+
+def files_fingerprint(filenames, extra=''):
+    """Hash of (path, size, mtime) for every file. Changes whenever one of them is added, removed or modified."""
+    h = hashlib.sha1()
+    h.update(extra.encode('utf8'))
+    for filename in sorted(filenames):
+        st = os.stat(filename)
+        h.update('{}|{}|{}\n'.format(filename, st.st_size, int(st.st_mtime)).encode('utf8'))
+    return h.hexdigest()
+
+
+def top_k_rows(similarities, k):
+    """Rows of the k largest similarities, best first: argpartition then a sort of k elements only."""
+    k = min(k, len(similarities))
+    if k <= 0:
+        return np.zeros(shape=(0,), dtype=int)
+    rows = np.argpartition(-similarities, k - 1)[:k]
+    return rows[np.argsort(-similarities[rows], kind='stable')]
+
+
+def spherical_kmeans(x, num_clusters, num_iterations=10, seed=0):
+    """k-means on the unit sphere (cosine similarity). x is L2-normalized. Returns (centroids, assignments)."""
+    rng = np.random.RandomState(seed)
+    centroids = x[rng.choice(len(x), size=num_clusters, replace=False)]
+    assignments = np.zeros(shape=(len(x),), dtype=int)
+    for _ in range(num_iterations):
+        assignments = np.argmax(x.dot(centroids.T), axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, x)
+        empty = np.bincount(assignments, minlength=num_clusters) == 0
+        sums[empty] = x[rng.choice(len(x), size=int(np.sum(empty)))]  # re-seeds the empty clusters.
+        centroids = l2_normalize(sums)
+    return centroids, assignments
+
+
+class IVFIndex:
+    """
+    Inverted file over the gallery codes: they are split in num_lists clusters (spherical k-means, in the space
+    of the codec) and a query is only compared to the codes of its nprobe closest clusters. Approximate: a speaker
+    in a cluster that is not probed is missed.
+    """
+
+    def __init__(self, codes, codec, norms=None, num_lists=None, nprobe=8, num_iterations=10, seed=0):
+        num_lists = num_lists or max(1, int(np.sqrt(len(codes))))
+        self.codec = codec
+        self.nprobe = min(nprobe, num_lists)
+        self.centroids, assignments = spherical_kmeans(l2_normalize(codec.decode(codes)), num_lists,
+                                                       num_iterations, seed)
+        # the rows of each list are contiguous: one slice of the reordered matrix per list.
+        self.order = np.argsort(assignments, kind='stable')
+        self.codes = codes[self.order]
+        self.norms = None if norms is None else norms[self.order]
+        self.offsets = np.concatenate([[0], np.cumsum(np.bincount(assignments, minlength=num_lists))])
+
+    def search(self, embedding, k):
+        """(rows, similarities) of the k most similar codes among the probed lists, best first."""
+        lists = top_k_rows(self.centroids.dot(self.codec.project(embedding)), self.nprobe)
+        candidates = np.concatenate([np.arange(self.offsets[i], self.offsets[i + 1]) for i in lists])
+        similarities = self.codec.similarities(self.codes[candidates], embedding,
+                                               norms=None if self.norms is None else self.norms[candidates])
+        best = top_k_rows(similarities, k)
+        return self.order[candidates[best]], similarities[best]
+
+
+class SpeakerGallery:
+    """
+    Mean embedding of every enrolled speaker, stored as one (num_speakers, dim) matrix of codes (cf. EmbeddingCodec:
+    float32 by default, optionally PCA-reduced and/or float16 / int8 quantized).
+    Rows are L2-normalized so that scoring a query is a single matrix-vector product.
+    """
+
+    def __init__(self, speaker_ids=None, embeddings=None, fingerprint='', ivf_min_size=IVF_MIN_SIZE, nprobe=8,
+                 codec=None, codes=None):
+        self.speaker_ids = list(speaker_ids) if speaker_ids is not None else []
+        self.codec = codec or EmbeddingCodec()
+        if codes is None:
+            if embeddings is None or len(embeddings) == 0:
+                codes = np.zeros(shape=(0, 0), dtype=self.codec.dtype)
+            else:
+                codes = self.codec.encode(embeddings)
+        self.codes = codes
+        self.norms = self.codec.norms(codes) if self.codec.dtype == 'int8' and len(codes) > 0 else None
+        self.fingerprint = fingerprint
+        # large galleries: top_k probes an IVF index (approximate), built once on the first query.
+        self.ivf_min_size = ivf_min_size
+        self.nprobe = nprobe
+        self.ivf = None
+        self._ivf_lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.speaker_ids)
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes
+
+    def is_stale(self, fingerprint):
+        return self.fingerprint != fingerprint
+
+    def similarities(self, embedding):
+        return self.codec.similarities(self.codes, embedding, norms=self.norms)
+
+    def distances(self, embedding):
+        # cosine distance (same definition as scipy.spatial.distance.cosine).
+        if len(self) == 0:
+            return np.zeros(shape=(0,), dtype=np.float32)
+        return 1.0 - self.similarities(embedding)
+
+    def score(self, embedding):
+        return dict(zip(self.speaker_ids, self.distances(embedding).tolist()))
+
+    def ivf_index(self):
+        # concurrent first queries wait for a single build instead of each running the k-means.
+        if self.ivf is None:
+            with self._ivf_lock:
+                if self.ivf is None:
+                    ivf = IVFIndex(self.codes, self.codec, norms=self.norms, nprobe=self.nprobe)
+                    logger.info('Built an IVF index over {} speakers ({} lists).'.format(len(self),
+                                                                                       len(ivf.centroids)))
+                    self.ivf = ivf
+        return self.ivf
+
+    def top_k(self, embedding, k=5):
+        """The k closest enrolled speakers: [(speaker_id, cosine distance)], closest first."""
+        if len(self) == 0:
+            return []
+        if self.ivf_min_size is not None and len(self) >= self.ivf_min_size:
+            rows, similarities = self.ivf_index().search(embedding, k)
+        else:
+            similarities = self.similarities(embedding)
+            rows = top_k_rows(similarities, k)
+            similarities = similarities[rows]
+        return [(self.speaker_ids[row], float(1.0 - sim)) for row, sim in zip(rows, similarities)]
+
+    def save(self, filename=GALLERY_FILENAME):
+        output_dir = os.path.dirname(filename)
+        if output_dir and not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+        tmp_filename = filename + '.tmp.npz'
+        np.savez(tmp_filename,
+                 speaker_ids=np.array(self.speaker_ids, dtype=np.str_),
+                 embeddings=self.codes,
+                 fingerprint=np.array(self.fingerprint),
+                 **self.codec.to_arrays())
+        os.replace(tmp_filename, filename)
+        logger.info('[DUMP GALLERY] {} ({} speakers, {}, {} bytes)'.format(filename, len(self), self.codec.name,
+                                                                           self.nbytes))
+
+    @staticmethod
+    def load(filename=GALLERY_FILENAME):
+        if not os.path.isfile(filename):
+            return None
+        with np.load(filename) as data:
+            gallery = SpeakerGallery(speaker_ids=[str(s) for s in data['speaker_ids']],
+                                     codes=data['embeddings'],
+                                     codec=EmbeddingCodec.from_arrays(data),
+                                     fingerprint=str(data['fingerprint']))
+        logger.info('Loaded gallery {} ({} speakers, {}).'.format(filename, len(gallery), gallery.codec.name))
+        return gallery
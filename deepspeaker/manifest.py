@@ -0,0 +1,90 @@
+import hashlib
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILENAME = 'manifest.json'
+
+
+def file_sha1(filename, chunk_size=1024 * 1024):
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def digest(obj):
+    """Stable hash of a JSON serializable object (e.g. parameters, or a list of (filename, sha1))."""
+    return hashlib.sha1(json.dumps(obj, sort_keys=True).encode('utf8')).hexdigest()
+
+
+class Manifest:
+    """
+    What an output was built from: <source path -> size, mtime, sha1> and the parameters of the build.
+    The content of a file is only re-hashed when its size or mtime changed, so checking an unchanged
+    corpus costs one stat per file. When the parameters change, every source is considered changed.
+    """
+
+    def __init__(self, filename, params=None):
+        self.filename = filename
+        self.params = params or {}
+        self.files = {}
+        self.outputs = {}  # <output key -> digest of what it was built from>, e.g. one per speaker.
+        self._hashed = {}
+        self.params_changed = False
+        if os.path.isfile(filename):
+            with open(filename, 'r') as r:
+                manifest = json.load(r)
+            if manifest.get('params') == json.loads(json.dumps(self.params)):
+                self.files = manifest.get('files', {})
+                self.outputs = manifest.get('outputs', {})
+            else:
+                self.params_changed = True
+                logger.info('Parameters changed since the last build ({}): rebuilding everything.'.format(filename))
+
+    def entry(self, filename):
+        """Current (size, mtime, sha1) of filename, hashing its content only if needed."""
+        if filename in self._hashed:
+            return self._hashed[filename]
+        st = os.stat(filename)
+        previous = self.files.get(filename)
+        if previous is not None and previous['size'] == st.st_size and previous['mtime'] == st.st_mtime:
+            sha1 = previous['sha1']
+        else:
+            sha1 = file_sha1(filename)
+        self._hashed[filename] = {'size': st.st_size, 'mtime': st.st_mtime, 'sha1': sha1}
+        return self._hashed[filename]
+
+    def sha1(self, filename):
+        return self.files[filename]['sha1'] if filename in self.files else self.entry(filename)['sha1']
+
+    def changed(self, filenames):
+        """New sources, and sources whose content differs from the last build (a touched file is unchanged)."""
+        return [f for f in filenames if f not in self.files or self.files[f]['sha1'] != self.entry(f)['sha1']]
+
+    def removed(self, filenames):
+        return sorted(set(self.files) - set(filenames))
+
+    def record(self, filenames):
+        for filename in filenames:
+            self.files[filename] = self.entry(filename)
+
+    def forget(self, filenames):
+        for filename in filenames:
+            self.files.pop(filename, None)
+            self._hashed.pop(filename, None)
+
+    def save(self):
+        output_dir = os.path.dirname(self.filename)
+        if output_dir and not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+        tmp_filename = self.filename + '.tmp'
+        with open(tmp_filename, 'w') as w:
+            json.dump({'params': self.params, 'files': self.files, 'outputs': self.outputs}, w, sort_keys=True)
+        os.replace(tmp_filename, self.filename)
@@ -0,0 +1,55 @@
+import logging
+
+import h5py
+import numpy as np
+
+from deepspeaker.gallery import l2_normalize
+
+logger = logging.getLogger(__name__)
+
+
+def load_layer_weights(checkpoint_file, layer_name):
+    # works for both model.save() and model.save_weights() files.
+    with h5py.File(checkpoint_file, 'r') as f:
+        weights = f['model_weights'] if 'model_weights' in f else f
+        layer = weights[layer_name]
+        weight_names = [n.decode('utf8') if isinstance(n, bytes) else n for n in layer.attrs['weight_names']]
+        return [np.array(layer[n]) for n in weight_names]
+
+
+def sigmoid(x):
+    # numerically stable, no overflow warning for large negative inputs.
+    return 0.5 * (1.0 + np.tanh(0.5 * x))
+
+
+class NumpyEmbeddingModel:
+    """
+    Embedding head of triplet_softmax_model (fc1 -> sigmoid -> l2_normalize) without Keras/TensorFlow.
+    Weights are read from the .h5 checkpoint. Stateless, safe to share between threads.
+    """
+
+    def __init__(self, kernel, bias, normalize_embeddings=True):
+        self.kernel = np.ascontiguousarray(kernel, dtype=np.float32)
+        self.bias = np.asarray(bias, dtype=np.float32)
+        self.normalize_embeddings = normalize_embeddings
+
+    @staticmethod
+    def from_checkpoint(checkpoint_file, normalize_embeddings=True):
+        logger.info('Loading checkpoint: {}.'.format(checkpoint_file))
+        kernel, bias = load_layer_weights(checkpoint_file, 'fc1')
+        return NumpyEmbeddingModel(kernel, bias, normalize_embeddings=normalize_embeddings)
+
+    @property
+    def input_dim(self):
+        return self.kernel.shape[0]
+
+    @property
+    def embedding_dim(self):
+        return self.kernel.shape[1]
+
+    def predict(self, x):
+        x = np.asarray(x, dtype=np.float32).reshape(-1, self.input_dim)
+        embeddings = sigmoid(x.dot(self.kernel) + self.bias)
+        if self.normalize_embeddings:
+            embeddings = l2_normalize(embeddings, axis=1)
+        return embeddings
@@ -0,0 +1,71 @@
+import logging
+
+import numpy as np
+
+from deepspeaker.diarization import ROW_HOP_SEC
+from deepspeaker.embedding_codec import l2_normalize
+from deepspeaker.streaming import StreamingFeatureExtractor
+
+logger = logging.getLogger(__name__)
+
+
+def margin_samples(gallery, embeddings, best, runner_up):
+    """Per input: cosine similarity to the best candidate minus cosine similarity to the runner-up."""
+    references = l2_normalize(gallery.codec.decode(gallery.codes[[best, runner_up]]))
+    similarities = gallery.codec.project(embeddings).dot(references.T)
+    return similarities[:, 0] - similarities[:, 1]
+
+
+def anytime_identify(sig, rate, embed_fn, gallery, k=5, match_threshold=0.1, stride=1, first_sec=0.5, growth=2.0,
+                     min_sec=1.5, segment_sec=0.3, confidence=3.0):
+    """
+    Identification that stops as soon as it is sure. The signal is featurized in increasing blocks (first_sec,
+    then growth times more each step). After each block, all the inputs so far are normalized and embedded
+    (as generate_features_for_new_file on the prefix) and ranked against the gallery. It stops when
+    the margin of the best speaker over the runner-up is above confidence standard errors (per-input margins,
+    averaged by segment) after at least min_sec,
+    or at the end of the signal, where the result is the same as MultithreadsInference.identify.
+    Returns {'speaker', 'candidates', 'processed_sec', 'total_sec', 'early_exit'}.
+    """
+    sig = np.asarray(sig, dtype=np.float32).reshape(-1)
+    gallery_rows = {speaker_id: i for i, speaker_id in enumerate(gallery.speaker_ids)}
+    extractor = StreamingFeatureExtractor(rate)
+    block = max(1, int(first_sec * rate))
+    position, rows = 0, []
+    speaker, candidates, early_exit = None, [], False
+    while position < len(sig):
+        new_rows = extractor.push(sig[position:position + block])
+        position += block
+        block = int(block * growth)
+        if len(new_rows) > 0:
+            rows.append(new_rows)
+        if len(rows) == 0:
+            continue
+        x = np.vstack(rows)[::stride]
+        x = (x - np.mean(x)) / max(np.std(x), 1e-12)
+        embeddings = np.asarray(embed_fn(x))
+        top = gallery.top_k(np.mean(embeddings, axis=0), k=max(2, k))
+        candidates = [{'speaker': speaker_id, 'cosine': cosine} for speaker_id, cosine in top]
+        if len(top) < 2 or position < min_sec * rate or position >= len(sig):
+            continue
+        margins = margin_samples(gallery, embeddings, gallery_rows[top[0][0]], gallery_rows[top[1][0]])
+        # consecutive inputs overlap (their contexts share frames): the standard error is estimated on the means
+        # of segments of segment_sec, not on the inputs themselves.
+        segment_rows = max(1, int(round(segment_sec / (ROW_HOP_SEC * stride))))
+        num_segments = len(margins) // segment_rows
+        if num_segments < 2:
+            continue
+        segments = np.mean(margins[0:num_segments * segment_rows].reshape(num_segments, segment_rows), axis=1)
+        bound = confidence * np.std(segments, ddof=1) / np.sqrt(num_segments)
+        if np.mean(margins) > bound:
+            early_exit = True
+            break
+    if len(candidates) > 0 and candidates[0]['cosine'] <= match_threshold:
+        speaker = candidates[0]['speaker']
+    processed_sec = min(position, len(sig)) / rate
+    logger.info('Identified {} after {:.1f}s out of {:.1f}s.'.format(speaker, processed_sec, len(sig) / rate))
+    return {'speaker': speaker,
+            'candidates': candidates[0:k],
+            'processed_sec': processed_sec,
+            'total_sec': len(sig) / rate,
+            'early_exit': early_exit}
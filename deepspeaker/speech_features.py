@@ -1,34 +1,145 @@
+from functools import lru_cache
+
 import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+NB_FEATURES = 13
+NFFT = 512  # python_speech_features default.
+PREEMPH = 0.97
+CEP_LIFTER = 22
+WINDOW_LENGTH_SEC = 25.0 / 1000
+WINDOW_STEP_SEC = 10.0 / 1000
+CONTEXT_FRAMES = 10  # 10 consecutive frames are stacked in one input.
+CONTEXT_STEP = 3  # hop between two stacked inputs, in frames.
+
+
+def window_sizes(rate):
+    window_cnn_fr_size = int(WINDOW_LENGTH_SEC * rate)  # window size in frames
+    window_cnn_fr_steps = int(WINDOW_STEP_SEC * rate)  # the step size in frames. if step < window, overlap!
+    return window_cnn_fr_size, window_cnn_fr_steps
+
+
+def feature_params(rate):
+    # everything the inputs depend on: a change invalidates the generated inputs.
+    return {'rate': rate, 'nb_features': NB_FEATURES, 'nfft': NFFT, 'preemph': PREEMPH, 'cep_lifter': CEP_LIFTER,
+            'window_length_sec': WINDOW_LENGTH_SEC, 'window_step_sec': WINDOW_STEP_SEC,
+            'context_frames': CONTEXT_FRAMES, 'context_step': CONTEXT_STEP}
+
+
+def num_frames(num_samples, rate):
+    window_cnn_fr_size, window_cnn_fr_steps = window_sizes(rate)
+    # only full windows are kept (same as checking len(slice_sig) / rate == window_length_sec).
+    if window_cnn_fr_size / rate != WINDOW_LENGTH_SEC or num_samples < window_cnn_fr_size:
+        return 0
+    return (num_samples - window_cnn_fr_size) // window_cnn_fr_steps + 1
+
+
+def num_stacked_frames(num_samples, rate):
+    n = num_frames(num_samples, rate)
+    return 0 if n < CONTEXT_FRAMES else (n - CONTEXT_FRAMES) // CONTEXT_STEP + 1
+
+
+@lru_cache(maxsize=8)
+def _filterbank(nb_filters, nfft, rate):
+    from python_speech_features.base import get_filterbanks
+    fb = get_filterbanks(nb_filters, nfft, rate, 0, rate / 2)
+    fb.setflags(write=False)
+    return fb
+
+
+def frame_signal(sig, rate):
+    """(num_frames, window_size) strided view over sig. No copy."""
+    sig = np.ascontiguousarray(np.asarray(sig).reshape(-1))
+    window_cnn_fr_size, window_cnn_fr_steps = window_sizes(rate)
+    n = num_frames(len(sig), rate)
+    return as_strided(sig, shape=(n, window_cnn_fr_size),
+                      strides=(sig.strides[0] * window_cnn_fr_steps, sig.strides[0]),
+                      writeable=False)
+
+
+def mfcc_frames(frames, rate, nb_features=NB_FEATURES):
+    """
+    Batched equivalent of calling mfcc_features() on each 25ms frame independently.
+    Returns a (num_frames, 3 * nb_features) matrix.
+    """
+    from python_speech_features.base import lifter
+    from python_speech_features.sigproc import powspec
+    from scipy.fftpack import dct
+    if len(frames) == 0:
+        return np.zeros(shape=(0, 3 * nb_features), dtype=float)
+    # pre-emphasis is applied per frame: the first sample of every frame is kept as is.
+    emphasized = np.empty_like(frames)
+    emphasized[:, 0] = frames[:, 0]
+    emphasized[:, 1:] = frames[:, 1:] - PREEMPH * frames[:, :-1]
+    pspec = powspec(emphasized, NFFT)
+    energy = np.sum(pspec, 1)
+    energy = np.where(energy == 0, np.finfo(float).eps, energy)
+    feat = np.dot(pspec, _filterbank(nb_features, NFFT, rate).T)
+    feat = np.where(feat == 0, np.finfo(float).eps, feat)
+    feat = dct(np.log(feat), type=2, axis=1, norm='ortho')[:, :nb_features]
+    feat = lifter(feat, CEP_LIFTER)
+    feat[:, 0] = np.log(energy)
+    # delta and delta-delta are computed on a single frame sequence (cf. mfcc_features): they are always 0.
+    deltas = np.zeros_like(feat)
+    return np.concatenate((feat, deltas, deltas), axis=1)
+
+
+def stack_context(feat_mat):
+    """(N, 39) -> (M, 390). Each row is (39, 10).flatten() over 10 consecutive frames, hopping 3 frames."""
+    feat_mat = np.ascontiguousarray(feat_mat, dtype=float)
+    n = 0 if len(feat_mat) < CONTEXT_FRAMES else (len(feat_mat) - CONTEXT_FRAMES) // CONTEXT_STEP + 1
+    if n == 0:
+        return np.array([])
+    s0, s1 = feat_mat.strides
+    windows = as_strided(feat_mat, shape=(n, feat_mat.shape[1], CONTEXT_FRAMES),
+                         strides=(s0 * CONTEXT_STEP, s1, s0), writeable=False)
+    return windows.reshape(n, -1)
 
 
 def get_mfcc_features_390(sig, rate, max_frames=None):
-    window_length_sec = 25.0 / 1000
-    window_step_sec = 10.0 / 1000
-    window_cnn_fr_size = int(window_length_sec * rate)  # window size in frames
-    window_cnn_fr_steps = int(window_step_sec * rate)  # the step size in frames. if step < window, overlap!
-    feat_mat = []
-    for i in range(int(len(sig) / window_cnn_fr_steps)):
-        start = window_cnn_fr_steps * i
-        end = start + window_cnn_fr_size
-        slice_sig = sig[start:end]
-        if len(slice_sig) / rate == window_length_sec:
-            feat = mfcc_features(slice_sig, rate).flatten()
-            feat_mat.append(feat)
-    feat_mat = np.array(feat_mat, dtype=float)
-
-    indices = np.array(range(10))
-    new_feat_mat = []
-    for frame_id in range(len(feat_mat)):
-        if max(indices) >= len(feat_mat):
-            break
-        new_feat_mat.append(np.transpose(feat_mat[indices]).flatten())  # (39, 10).flatten()
-        indices += 3
-    new_feat_mat = np.array(new_feat_mat)
+    if max_frames is not None:
+        # no need to compute the frames that would be cut anyway.
+        window_cnn_fr_size, window_cnn_fr_steps = window_sizes(rate)
+        last_frame = (max_frames - 1) * CONTEXT_STEP + CONTEXT_FRAMES
+        sig = np.asarray(sig)[0:max(0, (last_frame - 1) * window_cnn_fr_steps + window_cnn_fr_size)]
+    frames = frame_signal(sig, rate)
+    new_feat_mat = stack_context(mfcc_frames(frames, rate))
     if max_frames is not None:
         new_feat_mat = new_feat_mat[0:max_frames]
     return new_feat_mat
 
 
+def iter_mfcc_features_390(sig, rate, block_rows=2000):
+    """
+    Same rows as get_mfcc_features_390(sig, rate), computed block_rows at a time to bound memory on long signals.
+    Yields (first_row_index, features) tuples.
+    """
+    sig = np.asarray(sig)
+    window_cnn_fr_size, window_cnn_fr_steps = window_sizes(rate)
+    row_hop = CONTEXT_STEP * window_cnn_fr_steps  # samples between two consecutive rows.
+    row_span = (CONTEXT_FRAMES - 1) * window_cnn_fr_steps + window_cnn_fr_size  # samples covered by one row.
+    total_rows = num_stacked_frames(len(sig), rate)
+    for first_row in range(0, total_rows, block_rows):
+        rows = min(block_rows, total_rows - first_row)
+        start = first_row * row_hop
+        yield first_row, get_mfcc_features_390(sig[start:start + (rows - 1) * row_hop + row_span], rate)
+
+
+def crop_mfcc_features_390(feat, start, end, rate):
+    """
+    Rows of get_mfcc_features_390(sig[start:end]) taken from feat = get_mfcc_features_390(sig), without recomputing
+    anything. start is moved forward to the next input boundary (at most 30ms): the frames are then the same
+    and so are the rows (each frame is featurized independently).
+    """
+    window_cnn_fr_size, window_cnn_fr_steps = window_sizes(rate)
+    row_hop = CONTEXT_STEP * window_cnn_fr_steps
+    first_row = -(-int(start) // row_hop)
+    rows = num_stacked_frames(max(0, int(end) - first_row * row_hop), rate)
+    if rows == 0 or len(feat) == 0:
+        return np.array([])
+    return feat[first_row:first_row + rows]
+
+
 def mfcc_features(sig, rate, nb_features=13):
     from python_speech_features import mfcc, delta
     mfcc_feat = mfcc(sig, rate, numcep=nb_features, nfilt=nb_features)
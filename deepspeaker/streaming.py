@@ -0,0 +1,83 @@
+import logging
+import time
+from collections import deque
+
+import numpy as np
+
+from deepspeaker.diarization import ROW_HOP_SEC
+from deepspeaker.speech_features import CONTEXT_FRAMES, CONTEXT_STEP, NB_FEATURES, frame_signal, mfcc_frames, \
+    num_frames, stack_context, window_sizes
+
+logger = logging.getLogger(__name__)
+
+
+class StreamingFeatureExtractor:
+    """
+    Incremental get_mfcc_features_390: push the signal chunk by chunk and get back the new inputs only.
+    The concatenation of all the outputs is exactly get_mfcc_features_390(whole signal).
+    Only the samples of the next incomplete frame and the frames of the next incomplete context are kept.
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.window_size, self.window_step = window_sizes(rate)
+        self.samples = np.zeros(shape=(0,), dtype=np.float32)  # starts at the next frame.
+        self.frames = np.zeros(shape=(0, 3 * NB_FEATURES), dtype=float)  # starts at the first frame of the next input.
+
+    def push(self, chunk):
+        samples = np.concatenate([self.samples, np.asarray(chunk, dtype=np.float32).reshape(-1)])
+        n = num_frames(len(samples), self.rate)
+        if n > 0:
+            self.frames = np.concatenate([self.frames, mfcc_frames(frame_signal(samples, self.rate), self.rate)])
+        self.samples = samples[n * self.window_step:]
+        rows = stack_context(self.frames)
+        if len(rows) == 0:
+            return np.zeros(shape=(0, 3 * NB_FEATURES * CONTEXT_FRAMES), dtype=float)
+        self.frames = self.frames[len(rows) * CONTEXT_STEP:]
+        return rows
+
+
+class StreamingSpeakerIdentifier:
+    """
+    Rolling speaker decision over a live PCM stream: every interval_ms of audio, the last window_sec of inputs
+    are normalized, embedded and scored against the gallery. The work per chunk depends on the chunk size
+    and window_sec only, not on how long the stream has been running.
+    """
+
+    def __init__(self, embed_fn, gallery, rate, window_sec=3.0, interval_ms=500, match_threshold=0.1):
+        self.embed_fn = embed_fn
+        self.gallery = gallery
+        self.rate = rate
+        self.match_threshold = match_threshold
+        self.extractor = StreamingFeatureExtractor(rate)
+        self.rows = deque(maxlen=max(1, int(window_sec / ROW_HOP_SEC)))
+        self.interval_samples = max(1, int(rate * interval_ms / 1000))
+        self.pending_samples = 0
+        self.total_samples = 0
+
+    def push(self, chunk):
+        """Returns the decisions made while processing chunk: none or one."""
+        chunk = np.asarray(chunk, dtype=np.float32).reshape(-1)
+        self.rows.extend(self.extractor.push(chunk))
+        self.total_samples += len(chunk)
+        self.pending_samples += len(chunk)
+        if self.pending_samples < self.interval_samples or len(self.rows) == 0:
+            return []
+        self.pending_samples %= self.interval_samples
+        return [self.decide()]
+
+    def decide(self):
+        start_time = time.time()
+        x = np.array(self.rows)
+        x = (x - np.mean(x)) / max(np.std(x), 1e-12)
+        distances = self.gallery.distances(np.mean(self.embed_fn(x), axis=0))
+        speaker, cosine = None, None
+        if len(distances) > 0:
+            best = int(np.argmin(distances))
+            cosine = float(distances[best])
+            if cosine <= self.match_threshold:
+                speaker = self.gallery.speaker_ids[best]
+        return {'time': self.total_samples / self.rate,
+                'speaker': speaker,
+                'cosine': cosine,
+                'processing_ms': 1000.0 * (time.time() - start_time)}
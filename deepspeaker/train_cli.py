@@ -1,7 +1,5 @@
 import argparse
 import os
-import pickle
-import deepdish as dd
 from argparse import ArgumentParser
 from collections import deque
 from glob import glob
@@ -15,8 +13,9 @@ from keras.optimizers import Adam
 from natsort import natsorted
 
 from deepspeaker.constants import c
-from deepspeaker.triplet_loss import deep_speaker_loss
-from deepspeaker.utils import data_to_keras
+from deepspeaker.training_data import TrainingData, chunked_data_filename, is_training_data, prefetch, \
+    speaker_batches, triplet_batches, write_training_data
+from deepspeaker.triplet_loss import TRIPLET_LOSSES, deep_speaker_loss
 
 BATCH_SIZE = 900
 
@@ -39,6 +38,10 @@ def get_script_arguments():
     parser.add_argument('--loss_on_embeddings', action='store_true')
     parser.add_argument('--freeze_embedding_weights', action='store_true')
     parser.add_argument('--normalize_embeddings', action='store_true')
+    # fixed (default): [anchors, positives, negatives] layout. batch_hard / batch_all (opt-in): mined in the batch
+    # from the labels (batch_all needs O(batch_size ** 3) memory).
+    parser.add_argument('--triplet_loss', choices=sorted(TRIPLET_LOSSES), default='fixed')
+    parser.add_argument('--speakers_per_batch', type=int, default=30)  # batch_hard / batch_all only.
     args = get_arguments(parser)
     return args
 
@@ -57,9 +60,10 @@ def triplet_softmax_model(num_speakers_softmax, batch_size=BATCH_SIZE,
     return Model(inputs=[inp], outputs=[embeddings, softmax])
 
 
-def compile_triplet_softmax_model(m: Model, loss_on_softmax=True, loss_on_embeddings=False):
+def compile_triplet_softmax_model(m: Model, loss_on_softmax=True, loss_on_embeddings=False,
+                                  embeddings_loss=deep_speaker_loss):
     losses = {
-        'embeddings': deep_speaker_loss,
+        'embeddings': embeddings_loss,
         'softmax': 'categorical_crossentropy',
     }
 
@@ -76,8 +80,8 @@ def compile_triplet_softmax_model(m: Model, loss_on_softmax=True, loss_on_embedd
               metrics=['accuracy'])
 
 
-def fit_model(m, kx_train, ky_train, kx_test, ky_test,
-              batch_size=BATCH_SIZE, max_grad_steps=1000000, initial_epoch=0):
+def fit_model(m, train_data, test_data,
+              batch_size=BATCH_SIZE, max_grad_steps=1000000, initial_epoch=0, speakers_per_batch=None):
     # TODO: use this callback checkpoint.
     # checkpoint = ModelCheckpoint(monitor='val_acc', filepath='checkpoints/model_{epoch:02d}_{val_acc:.3f}.h5',
     #                              save_best_only=True)
@@ -90,52 +94,33 @@ def fit_model(m, kx_train, ky_train, kx_test, ky_test,
     # anchor and positive = first one.
     # negative = second one.
     # order is [anchor, positive, negative].
-
-    def select_inputs_and_outputs_for_speaker(x, y, speaker_id_):
-        indices = np.random.choice(np.where(y.argmax(axis=1) == speaker_id_)[0], size=batch_size // 3)
-        return x[indices], y[indices]
+    # with speakers_per_batch, the triplets are mined in the batch instead (the loss takes the labels).
 
     print()
     print()
-    assert sorted(set(ky_test.argmax(axis=1))) == sorted(set(ky_train.argmax(axis=1)))
-    num_different_speakers = len(set(ky_train.argmax(axis=1)))
+    assert sorted(test_data.indices_by_speaker) == sorted(train_data.indices_by_speaker)
+    num_different_speakers = len(train_data.indices_by_speaker)
     print('num different speakers =', num_different_speakers)
     deque_size = 100
     train_overall_loss_emb = deque(maxlen=deque_size)
     test_overall_loss_emb = deque(maxlen=deque_size)
     train_overall_loss_softmax = deque(maxlen=deque_size)
     test_overall_loss_softmax = deque(maxlen=deque_size)
+    # the next batches are sampled in a background thread while the model trains on the current one.
+    if speakers_per_batch is None:
+        batches = prefetch(triplet_batches(train_data, test_data, batch_size))
+    else:
+        batches = prefetch(speaker_batches(train_data, test_data, batch_size, speakers_per_batch))
     # TODO: not very much epoch here.
     for epoch in range(initial_epoch, max_grad_steps):
-        two_different_speakers = np.random.choice(range(num_different_speakers), size=2, replace=False)
-        anchor_positive_speaker = two_different_speakers[0]
-        # negative_speaker = two_different_speakers[0]
-        negative_speaker = two_different_speakers[1]
-        assert negative_speaker != anchor_positive_speaker
-
-        train_inputs_outputs = [
-            select_inputs_and_outputs_for_speaker(kx_train, ky_train, anchor_positive_speaker),
-            select_inputs_and_outputs_for_speaker(kx_train, ky_train, anchor_positive_speaker),
-            select_inputs_and_outputs_for_speaker(kx_train, ky_train, negative_speaker)
-        ]
-        inputs = np.vstack([v[0] for v in train_inputs_outputs])
-        outputs = np.vstack([v[1] for v in train_inputs_outputs])
-
-        train_loss = m.train_on_batch(inputs, {'embeddings': outputs * 0, 'softmax': outputs})
+        speakers, (inputs, outputs), (test_inputs, test_outputs) = next(batches)
+
+        train_loss = m.train_on_batch(inputs, {'embeddings': outputs, 'softmax': outputs})
         train_loss = dict(zip(m.metrics_names, train_loss))
         train_overall_loss_emb.append(train_loss['embeddings_loss'])
         train_overall_loss_softmax.append(train_loss['softmax_loss'])
 
-        test_inputs_outputs = [
-            select_inputs_and_outputs_for_speaker(kx_test, ky_test, anchor_positive_speaker),
-            select_inputs_and_outputs_for_speaker(kx_test, ky_test, anchor_positive_speaker),
-            select_inputs_and_outputs_for_speaker(kx_test, ky_test, negative_speaker)
-        ]
-
-        test_inputs = np.vstack([v[0] for v in test_inputs_outputs])
-        test_outputs = np.vstack([v[1] for v in test_inputs_outputs])
-
-        test_loss = m.test_on_batch(test_inputs, {'embeddings': test_outputs * 0, 'softmax': test_outputs})
+        test_loss = m.test_on_batch(test_inputs, {'embeddings': test_outputs, 'softmax': test_outputs})
         test_loss = dict(zip(m.metrics_names, test_loss))
         test_overall_loss_emb.append(test_loss['embeddings_loss'])
         test_overall_loss_softmax.append(test_loss['softmax_loss'])
@@ -151,11 +136,11 @@ def fit_model(m, kx_train, ky_train, kx_test, ky_test,
             print('train metrics =', train_loss)
             print('test metrics =', test_loss)
             m.save_weights('checkpoints/unified_model_checkpoints_{}.h5'.format(epoch), overwrite=True)
-            print('Last two speakers were {} and {}.'.format(anchor_positive_speaker, negative_speaker))
+            print('Last speakers were {}.'.format(', '.join(str(s) for s in speakers)))
             print('Saving...')
 
 
-def fit_model_softmax(m, kx_train, ky_train, kx_test, ky_test, batch_size=BATCH_SIZE, max_epochs=1000, initial_epoch=0):
+def fit_model_softmax(m, train_data, test_data, batch_size=BATCH_SIZE, max_epochs=1000, initial_epoch=0):
     checkpoint = ModelCheckpoint(filepath='checkpoints/unified_model_checkpoints_{epoch}.h5',
                                  period=10)
     # if the accuracy does not increase by 1.0% over 10 epochs, we stop the training.
@@ -164,15 +149,6 @@ def fit_model_softmax(m, kx_train, ky_train, kx_test, ky_test, batch_size=BATCH_
     # if the accuracy does not increase over 10 epochs, we reduce the learning rate by half.
     reduce_lr = ReduceLROnPlateau(monitor='val_softmax_acc', factor=0.5, patience=10, min_lr=0.0001, verbose=1)
 
-    max_len_train = len(kx_train) - len(kx_train) % batch_size
-
-    kx_train = kx_train[0:max_len_train]
-    ky_train = ky_train[0:max_len_train]
-
-    max_len_test = len(kx_test) - len(kx_test) % batch_size
-    kx_test = kx_test[0:max_len_test]
-    ky_test = ky_test[0:max_len_test]
-
     print('The embedding loss here does not make sense. Do not get fooled by it. Triplets are not present here.')
     print('We train the embedding weights first.')
 
@@ -181,14 +157,19 @@ def fit_model_softmax(m, kx_train, ky_train, kx_test, ky_test, batch_size=BATCH_
             print('The embedding loss here does not make sense. Do not get fooled by it. '
                   'Triplets are not generated here. We train the embedding weights first.')
 
-    m.fit(kx_train,
-          {'embeddings': ky_train, 'softmax': ky_train},
-          batch_size=batch_size,
-          epochs=initial_epoch + max_epochs,
-          initial_epoch=initial_epoch,
-          verbose=1,
-          validation_data=(kx_test, {'embeddings': ky_test, 'softmax': ky_test}),
-          callbacks=[early_stopping, reduce_lr, checkpoint, WarningCallback()])
+    def keras_batches(data, shuffle):
+        # read from disk in a background thread, a few batches ahead of the training.
+        for x, y in prefetch(data.batches(batch_size, shuffle=shuffle)):
+            yield x, {'embeddings': y, 'softmax': y}
+
+    m.fit_generator(keras_batches(train_data, shuffle=True),
+                    steps_per_epoch=len(train_data) // batch_size,
+                    epochs=initial_epoch + max_epochs,
+                    initial_epoch=initial_epoch,
+                    verbose=1,
+                    validation_data=keras_batches(test_data, shuffle=False),
+                    validation_steps=len(test_data) // batch_size,
+                    callbacks=[early_stopping, reduce_lr, checkpoint, WarningCallback()])
 
 
 def start_training():
@@ -203,16 +184,22 @@ def start_training():
     # data_filename = '/tmp/speaker-change-detection-data.pkl'
     data_filename = os.path.expanduser(args.data_filename)
     assert os.path.exists(data_filename), 'Data does not exist.'
-    print('Loading the inputs in memory. It might take a while...')
-    data = pickle.load(open(data_filename, 'rb'))
-    data = dd.io.load(data_filename)
-    kx_train, ky_train, kx_test, ky_test, categorical_speakers = data_to_keras(data)
-
-    print(categorical_speakers.speaker_ids)
-    print(len(categorical_speakers.speaker_ids))
-
-    assert c.AUDIO.SPEAKERS_TRAINING_SET == categorical_speakers.speaker_ids
-    assert len(categorical_speakers.speaker_ids) == 80
+    if not is_training_data(data_filename):
+        # the inputs are streamed from disk: converted once to chunked datasets (cf. training_data).
+        training_data_filename = chunked_data_filename(data_filename)
+        if not os.path.isfile(training_data_filename) or \
+                os.path.getmtime(training_data_filename) < os.path.getmtime(data_filename):
+            print('Converting the inputs to chunked datasets. It might take a while...')
+            write_training_data(data_filename, training_data_filename)
+        data_filename = training_data_filename
+    train_data = TrainingData(data_filename, 'train')
+    test_data = TrainingData(data_filename, 'test')
+
+    print(train_data.speaker_ids)
+    print(len(train_data.speaker_ids))
+
+    assert c.AUDIO.SPEAKERS_TRAINING_SET == train_data.speaker_ids
+    assert len(train_data.speaker_ids) == 80
 
     emb_trainable = True
     if args.freeze_embedding_weights:
@@ -225,7 +212,8 @@ def start_training():
 
     checkpoints = natsorted(glob('checkpoints/*.h5'))
 
-    compile_triplet_softmax_model(m, loss_on_softmax=args.loss_on_softmax, loss_on_embeddings=args.loss_on_embeddings)
+    compile_triplet_softmax_model(m, loss_on_softmax=args.loss_on_softmax, loss_on_embeddings=args.loss_on_embeddings,
+                                  embeddings_loss=TRIPLET_LOSSES[args.triplet_loss])
     print(m.summary())
 
     initial_epoch = 0
@@ -238,9 +226,10 @@ def start_training():
 
     if args.loss_on_softmax:
         print('Softmax pre-training.')
-        fit_model_softmax(m, kx_train, ky_train, kx_test, ky_test, initial_epoch=initial_epoch)
+        fit_model_softmax(m, train_data, test_data, initial_epoch=initial_epoch)
     else:
-        fit_model(m, kx_train, ky_train, kx_test, ky_test, initial_epoch=initial_epoch)
+        fit_model(m, train_data, test_data, initial_epoch=initial_epoch,
+                  speakers_per_batch=None if args.triplet_loss == 'fixed' else args.speakers_per_batch)
 
 
 if __name__ == '__main__':
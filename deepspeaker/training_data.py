@@ -0,0 +1,178 @@
+import logging
+import os
+import queue
+import threading
+
+import h5py
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+CHUNK_ROWS = 4096
+INPUT_DIM = 39 * 10
+SPLITS = ('train', 'test')
+
+
+def chunked_data_filename(data_filename):
+    return os.path.splitext(data_filename)[0] + '_chunked.h5'
+
+
+def is_training_data(filename):
+    with h5py.File(filename, 'r') as f:
+        return all('{}/x'.format(split) in f for split in SPLITS)
+
+
+def _deepdish_list(group):
+    # lists saved by deepdish are groups of i0, i1, ... items.
+    return [group['i{}'.format(i)] for i in range(len(group))]
+
+
+def write_training_data(full_inputs_filename, output_filename, chunk_rows=CHUNK_ROWS):
+    """
+    Converts the unified inputs (full_inputs.h5, cf. InputsGenerator) into chunked float32 datasets
+    <split>/x (N, 390) and a speaker index column <split>/speaker (N,), one speaker at a time:
+    memory is bounded by the inputs of a single speaker. The speaker ids are stored in the speaker_ids attribute.
+    """
+    tmp_filename = output_filename + '.tmp'
+    with h5py.File(full_inputs_filename, 'r') as full, h5py.File(tmp_filename, 'w') as out:
+        speaker_ids = sorted(full.keys())
+        out.attrs['speaker_ids'] = np.array(speaker_ids, dtype=h5py.special_dtype(vlen=str))
+        for split in SPLITS:
+            x = out.create_dataset('{}/x'.format(split), shape=(0, INPUT_DIM), maxshape=(None, INPUT_DIM),
+                                   dtype=np.float32, chunks=(chunk_rows, INPUT_DIM))
+            speaker = out.create_dataset('{}/speaker'.format(split), shape=(0,), maxshape=(None,),
+                                         dtype=np.int32, chunks=(chunk_rows,))
+            for speaker_index, speaker_id in enumerate(speaker_ids):
+                for item in _deepdish_list(full[speaker_id][split]):
+                    rows = np.asarray(item, dtype=np.float32).reshape(-1, INPUT_DIM)
+                    n = len(x)
+                    x.resize(n + len(rows), axis=0)
+                    x[n:] = rows
+                    speaker.resize(n + len(rows), axis=0)
+                    speaker[n:] = speaker_index
+            logger.info('{} inputs for {}, {} speakers.'.format(len(x), split, len(speaker_ids)))
+    os.replace(tmp_filename, output_filename)
+    logger.info('[DUMP TRAINING DATA] {}'.format(output_filename))
+
+
+class TrainingData:
+    """
+    One split of the chunked training data, read from disk on demand. Only the speaker column is held in memory.
+    """
+
+    def __init__(self, filename, split='train'):
+        self.file = h5py.File(filename, 'r')
+        self.x = self.file['{}/x'.format(split)]
+        self.speaker = self.file['{}/speaker'.format(split)][:]
+        self.speaker_ids = [str(s) for s in self.file.attrs['speaker_ids']]
+        self.num_speakers = len(self.speaker_ids)
+        self.chunk_rows = self.x.chunks[0]
+        # rows grouped by speaker (already the case when written by write_training_data): the indices of
+        # a speaker are one contiguous slice of self.order, computed once.
+        self.order = np.argsort(self.speaker, kind='stable')
+        speakers, starts, counts = np.unique(self.speaker[self.order], return_index=True, return_counts=True)
+        self.indices_by_speaker = {int(s): self.order[a:a + n] for s, a, n in zip(speakers, starts, counts)}
+
+    def __len__(self):
+        return len(self.x)
+
+    def one_hot(self, speaker):
+        return np.eye(self.num_speakers, dtype=np.float32)[speaker]
+
+    def read(self, indices):
+        # h5py needs increasing and unique indices: rows drawn with replacement are read once.
+        unique, inverse = np.unique(indices, return_inverse=True)
+        return self.x[unique][inverse], self.speaker[indices]
+
+    def sample_speaker(self, speaker, size):
+        """size random inputs (with replacement) of speaker: (x, one-hot y)."""
+        indices = self.indices_by_speaker[speaker]
+        x, s = self.read(indices[np.random.randint(len(indices), size=size)])
+        return x, self.one_hot(s)
+
+    def batches(self, batch_size, shuffle=True, buffer_chunks=8):
+        """
+        Infinite (x, one-hot y) batches of batch_size inputs. Whole chunks are read in a random order and
+        shuffled together buffer_chunks at a time: reads stay sequential, memory stays bounded.
+        """
+        num_chunks = int(np.ceil(len(self) / self.chunk_rows))
+        while True:
+            order = np.random.permutation(num_chunks) if shuffle else np.arange(num_chunks)
+            rest_x, rest_s = np.zeros(shape=(0, INPUT_DIM), dtype=np.float32), np.zeros(shape=(0,), dtype=np.int32)
+            for i in range(0, num_chunks, buffer_chunks):
+                xs, ss = [rest_x], [rest_s]
+                for chunk in order[i:i + buffer_chunks]:
+                    xs.append(self.x[chunk * self.chunk_rows:(chunk + 1) * self.chunk_rows])
+                    ss.append(self.speaker[chunk * self.chunk_rows:(chunk + 1) * self.chunk_rows])
+                x, s = np.concatenate(xs), np.concatenate(ss)
+                if shuffle:
+                    p = np.random.permutation(len(x))
+                    x, s = x[p], s[p]
+                n = len(x) - len(x) % batch_size
+                for j in range(0, n, batch_size):
+                    yield x[j:j + batch_size], self.one_hot(s[j:j + batch_size])
+                rest_x, rest_s = x[n:], s[n:]  # incomplete batch: carried over (the models have a fixed batch size).
+
+    def close(self):
+        self.file.close()
+
+
+def triplet_batches(train_data, test_data, batch_size):
+    """
+    Infinite triplet batches for fit_model: two random speakers, then batch_size // 3 anchors, positives
+    (same speaker) and negatives (other speaker), for train and for test.
+    Yields ((anchor_positive_speaker, negative_speaker), (train x, train y), (test x, test y)).
+    """
+    speakers = sorted(train_data.indices_by_speaker)
+    while True:
+        anchor_positive_speaker, negative_speaker = np.random.choice(speakers, size=2, replace=False)
+        batches = []
+        for data in (train_data, test_data):
+            parts = [data.sample_speaker(s, batch_size // 3)
+                     for s in (anchor_positive_speaker, anchor_positive_speaker, negative_speaker)]
+            batches.append((np.vstack([p[0] for p in parts]), np.vstack([p[1] for p in parts])))
+        yield (anchor_positive_speaker, negative_speaker), batches[0], batches[1]
+
+
+def speaker_batches(train_data, test_data, batch_size, num_speakers):
+    """
+    Infinite batches for the losses mined in the batch (labels, no layout): num_speakers random speakers and
+    batch_size // num_speakers random inputs of each, for train and for test.
+    Yields (speakers, (train x, train y), (test x, test y)).
+    """
+    assert batch_size % num_speakers == 0, 'The models have a fixed batch size: {} is not a multiple of {}.'.format(
+        batch_size, num_speakers)
+    speakers = sorted(train_data.indices_by_speaker)
+    per_speaker = batch_size // num_speakers
+    while True:
+        batch_speakers = np.random.choice(speakers, size=num_speakers, replace=False)
+        batches = []
+        for data in (train_data, test_data):
+            parts = [data.sample_speaker(s, per_speaker) for s in batch_speakers]
+            batches.append((np.vstack([p[0] for p in parts]), np.vstack([p[1] for p in parts])))
+        yield tuple(batch_speakers), batches[0], batches[1]
+
+
+def prefetch(generator, size=4):
+    """Runs generator in a background thread, at most size items ahead of the consumer."""
+    q = queue.Queue(maxsize=size)
+    end = object()
+    errors = []
+
+    def worker():
+        try:
+            for item in generator:
+                q.put(item)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            q.put(end)
+
+    threading.Thread(target=worker, daemon=True).start()
+    while True:
+        item = q.get()
+        if item is end:
+            if errors:
+                raise errors[0]
+            return
+        yield item
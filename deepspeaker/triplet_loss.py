@@ -55,3 +55,55 @@ def deep_speaker_loss(y_true, y_pred):
     total_loss = K.mean(loss)
     logging.info('total_loss={}'.format(total_loss))
     return total_loss
+
+
+def pairwise_cosine_similarity(y_pred):
+    # (batch_size, batch_size) in one matmul. Embeddings are L2-normalized (cf. normalize_embeddings).
+    return K.dot(y_pred, K.transpose(y_pred))
+
+
+def same_speaker_masks(y_true, batch_size):
+    # y_true: one-hot speakers (batch_size, num_speakers), the same targets as the softmax output.
+    same = K.dot(y_true, K.transpose(y_true))
+    positive_mask = same * (1.0 - K.eye(batch_size))
+    negative_mask = 1.0 - same
+    return positive_mask, negative_mask
+
+
+def batch_hard_triplet_loss(y_true, y_pred):
+    """
+    Triplet loss mined in the batch, from labels instead of the anchor/positive/negative layout: every input is
+    an anchor, with its least similar input of the same speaker as positive and its most similar input of another
+    speaker as negative. Anchors without positive or negative in the batch are ignored.
+    """
+    sim = pairwise_cosine_similarity(y_pred)
+    positive_mask, negative_mask = same_speaker_masks(y_true, K.int_shape(y_pred)[0])
+    # cosine similarities are in [-1, 1]: +/- 4 moves the masked pairs out of the min / max.
+    hardest_positive = K.min(sim + 4.0 * (1.0 - positive_mask), axis=1)
+    hardest_negative = K.max(sim - 4.0 * (1.0 - negative_mask), axis=1)
+    valid = K.cast(K.greater(K.sum(positive_mask, axis=1), 0), 'float32') * \
+        K.cast(K.greater(K.sum(negative_mask, axis=1), 0), 'float32')
+    loss = K.maximum(hardest_negative - hardest_positive + alpha, 0.0) * valid
+    return K.sum(loss) / K.maximum(K.sum(valid), 1.0)
+
+
+def batch_all_triplet_loss(y_true, y_pred):
+    """
+    Mean of the triplet loss over all the (anchor, positive, negative) triplets of the batch that violate the margin.
+    Memory is O(batch_size ** 3): for small batches only (batch_hard_triplet_loss otherwise).
+    """
+    sim = pairwise_cosine_similarity(y_pred)
+    positive_mask, negative_mask = same_speaker_masks(y_true, K.int_shape(y_pred)[0])
+    # loss[a, p, n] = san - sap + alpha
+    loss = K.expand_dims(sim, 1) - K.expand_dims(sim, 2) + alpha
+    mask = K.expand_dims(positive_mask, 2) * K.expand_dims(negative_mask, 1)
+    loss = K.maximum(loss, 0.0) * mask
+    num_positive_triplets = K.sum(K.cast(K.greater(loss, 1e-16), 'float32'))
+    return K.sum(loss) / K.maximum(num_positive_triplets, 1.0)
+
+
+TRIPLET_LOSSES = {
+    'fixed': deep_speaker_loss,
+    'batch_hard': batch_hard_triplet_loss,
+    'batch_all': batch_all_triplet_loss,
+}
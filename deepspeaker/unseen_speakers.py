@@ -4,18 +4,30 @@ from glob import glob
 import numpy as np
 from natsort import natsorted
 
+from deepspeaker.batching import BatchingScheduler
 from deepspeaker.constants import c
-from deepspeaker.speech_features import get_mfcc_features_390
-from deepspeaker.train_cli import triplet_softmax_model
-from deepspeaker.utils import normalize, InputsGenerator, generate_features_for_new_file
-from keras import backend as K
-import tensorflow as tf
+from deepspeaker.diarization import diarize
+from deepspeaker.embedding_codec import EmbeddingCodec, codec_report, fit_pca
+from deepspeaker.gallery import GALLERY_FILENAME, SpeakerGallery, files_fingerprint
+from deepspeaker.manifest import digest
+from deepspeaker.numpy_model import NumpyEmbeddingModel
+from deepspeaker.sequential import anytime_identify
+from deepspeaker.speech_features import feature_params, get_mfcc_features_390
+from deepspeaker.streaming import StreamingSpeakerIdentifier
+from deepspeaker.utils import normalize, InputsGenerator, generate_features_for_new_file, get_audio, \
+    read_audio_from_filename
 from multiprocessing import cpu_count
 from multiprocessing.pool import ThreadPool
-from itertools import repeat
 
 logger = logging.getLogger(__name__)
 
+CHECKPOINTS_PATTERN = 'deepspeaker/checkpoints/*.h5'
+
+
+def latest_checkpoint(pattern=CHECKPOINTS_PATTERN):
+    checkpoints = natsorted(glob(pattern))
+    return checkpoints[-1] if len(checkpoints) != 0 else None
+
 
 def get_feat_from_audio(audio_reader, sr, norm_data, speaker):
     feat = get_mfcc_features_390(audio_reader, sr, max_frames=None)
@@ -23,15 +35,16 @@ def get_feat_from_audio(audio_reader, sr, norm_data, speaker):
     return feat
 
 
-def generate_features_for_unseen_speakers(audio_reader, target_speaker='p363'):
+def generate_features_for_unseen_speakers(audio_reader, target_speaker='p363', stride=None, feature_executor=None):
     # assert target_speaker in audio_reader.all_speaker_ids
     # audio.metadata = dict()  # small cache <SPEAKER_ID -> SENTENCE_ID, filename>
     # audio.cache = dict()  # big cache <filename, data:audio librosa, blanks.>
     inputs_generator = InputsGenerator(cache_dir=audio_reader.cache_dir,
                                        audio_reader=audio_reader,
-                                       max_count_per_class=1000)
+                                       max_count_per_class=1000,
+                                       feature_executor=feature_executor)
     # inputs = inputs_generator.generate_inputs_for_inference(target_speaker)
-    inputs = inputs_generator.generate_inputs_for_inference_no_cache(target_speaker)
+    inputs = inputs_generator.generate_inputs_for_inference_no_cache(target_speaker, stride=stride)
     return inputs
 
 
@@ -39,6 +52,7 @@ def inference_unseen_speakers(audio_reader, filename, sp2):
     sp1_feat = generate_features_for_new_file(filename)
     sp2_feat = generate_features_for_unseen_speakers(audio_reader, target_speaker=sp2)
 
+    from deepspeaker.train_cli import triplet_softmax_model
     # batch_size => None (for inference).
     m = triplet_softmax_model(num_speakers_softmax=len(c.AUDIO.SPEAKERS_TRAINING_SET),
                               emb_trainable=False,
@@ -95,10 +109,39 @@ def inference_unseen_speakers(audio_reader, filename, sp2):
 
 
 class MultithreadsInference:
-    def __init__(self, audio_reader, num_threads=cpu_count()):
+    def __init__(self, audio_reader, num_threads=cpu_count(), gallery_filename=GALLERY_FILENAME,
+                 auto_enroll=True, backend='numpy', stride=1, max_batch_size=4096, max_wait_ms=5,
+                 feature_executor=None, gallery_codec=None):
         self.audio_reader = audio_reader
+        self.gallery_codec = gallery_codec  # None: the codec of the saved gallery (float32 if none).
+        self.feature_executor = feature_executor  # MFCC extraction in worker processes (FeatureExecutor).
         self.speakers = self.audio_reader.get_enrolled_speakers()
         self.num_threads = num_threads
+        self.gallery_filename = gallery_filename
+        self.stride = stride  # sliding-window featurization, deterministic.
+
+        self.backend = backend
+        self.checkpoint_file = latest_checkpoint()
+        if self.backend == 'numpy':
+            # fc1 + l2 normalization only: no need for TensorFlow to serve the embeddings.
+            assert self.checkpoint_file is not None, 'No checkpoint found in {}.'.format(CHECKPOINTS_PATTERN)
+            self.model = NumpyEmbeddingModel.from_checkpoint(self.checkpoint_file)
+        else:
+            self.load_keras_model()
+        # the checkpoint the model in memory was loaded from, even if the file is replaced afterwards.
+        self.checkpoint_fingerprint = files_fingerprint([self.checkpoint_file]) \
+            if self.checkpoint_file is not None else None
+        # one long-lived worker runs the model for all the concurrent requests.
+        self.scheduler = BatchingScheduler(self.predict, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms)
+
+        self.gallery = SpeakerGallery.load(self.gallery_filename)
+        if auto_enroll and (self.gallery is None or self.gallery.is_stale(self.gallery_fingerprint())):
+            self.enroll()
+
+    def load_keras_model(self):
+        from deepspeaker.train_cli import triplet_softmax_model
+        from keras import backend as K
+        import tensorflow as tf
 
         # batch_size => None (for inference).
         self.model = triplet_softmax_model(
@@ -108,64 +151,150 @@ class MultithreadsInference:
             batch_size=None
         )
 
-        checkpoints = natsorted(glob('deepspeaker/checkpoints/*.h5'))
-        # print(checkpoints)
-
         # compile_triplet_softmax_model(m, loss_on_softmax=False, loss_on_embeddings=False)
         # print(self.model.summary())
 
-        if len(checkpoints) != 0:
-            checkpoint_file = checkpoints[-1]
-            initial_epoch = int(checkpoint_file.split('/')[-1].split('.')[0].split('_')[-1])
+        if self.checkpoint_file is not None:
+            initial_epoch = int(self.checkpoint_file.split('/')[-1].split('.')[0].split('_')[-1])
             logger.info('Initial epoch is {}.'.format(initial_epoch))
-            logger.info('Loading checkpoint: {}.'.format(checkpoint_file))
-            self.model.load_weights(checkpoint_file)  # latest one.
+            logger.info('Loading checkpoint: {}.'.format(self.checkpoint_file))
+            self.model.load_weights(self.checkpoint_file)  # latest one.
 
         self.session = K.get_session()
         self.graph = tf.get_default_graph()
         # self.graph.finalize()  # finalize
 
-    def inference(self, filename, speaker):
-        sp1_feat = generate_features_for_new_file(filename)
-        sp2_feat = generate_features_for_unseen_speakers(self.audio_reader, target_speaker=speaker)
-
+    def gallery_fingerprint(self):
+        # the gallery has to be rebuilt when the enrolled samples or the checkpoint change.
+        filenames = list(self.audio_reader.inference_wav_filenames)
+        if self.checkpoint_file is not None:
+            filenames.append(self.checkpoint_file)
+        return files_fingerprint(filenames, extra='stride={}'.format(self.stride))
+
+    def results_version(self):
+        """
+        Everything an identification result depends on besides the audio: the checkpoint, the feature parameters
+        and the enrolled gallery (its fingerprint changes with every enrollment). Part of the result cache keys.
+        """
+        gallery = (self.gallery.fingerprint, self.gallery.codec.name, len(self.gallery)) \
+            if self.gallery is not None else None
+        return digest({'checkpoint': self.checkpoint_fingerprint, 'backend': self.backend, 'stride': self.stride,
+                       'gallery': gallery, 'features': feature_params(self.audio_reader.sample_rate)})
+
+    def predict(self, x):
+        if self.backend == 'numpy':
+            return self.model.predict(x)
         with self.session.as_default():
             with self.graph.as_default():
-                emb_sp1 = self.model.predict(np.vstack(sp1_feat))[0]
-                emb_sp2 = self.model.predict(np.vstack(sp2_feat))[0]
-
-                logger.info('Checking that L2 norm is 1.')
-                logger.info(np.mean(np.linalg.norm(emb_sp1, axis=1)))
-                logger.info(np.mean(np.linalg.norm(emb_sp2, axis=1)))
-
-                from scipy.spatial.distance import cosine
-
-                # note to myself:
-                # embeddings are sigmoid-ed.
-                # so they are between 0 and 1.
-                # A hypersphere is defined on tanh.
-
-                logger.info('Emb1.shape = {}'.format(emb_sp1.shape))
-                logger.info('Emb2.shape = {}'.format(emb_sp2.shape))
-
-                emb1 = np.mean(emb_sp1, axis=0)
-                emb2 = np.mean(emb_sp2, axis=0)
-
-                return {speaker: cosine(emb1, emb2)}
-                # print('SAP =', np.mean([cosine(u, v) for (u, v) in zip(emb_sp1[:-1], emb_sp1[1:])]))
-                # print('SAN =', np.mean([cosine(u, v) for (u, v) in zip(emb_sp1, emb_sp2)]))
-                # print('We expect: SAP << SAN.')
-
-    def run(self, filename):
-        print('Using {} threads.'.format(self.num_threads))
+                return self.model.predict(x)[0]
+
+    def embed(self, feat):
+        return self.scheduler.predict(np.vstack(feat))
+
+    def speaker_embedding(self, speaker):
+        sp_feat = generate_features_for_unseen_speakers(self.audio_reader, target_speaker=speaker,
+                                                        stride=self.stride,
+                                                        feature_executor=self.feature_executor)
+        emb_sp = self.embed(sp_feat)
+        logger.info('Checking that L2 norm is 1.')
+        logger.info(np.mean(np.linalg.norm(emb_sp, axis=1)))
+        return np.mean(emb_sp, axis=0)
+
+    def enroll(self):
+        logger.info('Enrolling {} speakers using {} threads.'.format(len(self.speakers), self.num_threads))
         pool = ThreadPool(processes=self.num_threads)
-        result = pool.starmap(self.inference, zip(repeat(filename), self.speakers))
-        cleaned = merge_dicts(*result)
-        print(cleaned)
-        cleaned = {k: v for k, v in cleaned.items() if v <= 0.1}
+        embeddings = pool.map(self.speaker_embedding, self.speakers)
         pool.close()
         pool.join()
-        return min(cleaned, key=cleaned.get) if any(cleaned) else None
+        codec = self.gallery_codec or (self.gallery.codec if self.gallery is not None else None)
+        self.gallery = SpeakerGallery(speaker_ids=self.speakers,
+                                      embeddings=np.vstack(embeddings) if len(embeddings) > 0 else None,
+                                      fingerprint=self.gallery_fingerprint(),
+                                      codec=codec)
+        self.gallery.save(self.gallery_filename)
+        return self.gallery
+
+    def file_embedding(self, filename):
+        sp1_feat = generate_features_for_new_file(filename, stride=self.stride,
+                                                  feature_executor=self.feature_executor)
+        emb_sp1 = self.embed(sp1_feat)
+
+        logger.info('Checking that L2 norm is 1.')
+        logger.info(np.mean(np.linalg.norm(emb_sp1, axis=1)))
+
+        # note to myself:
+        # embeddings are sigmoid-ed.
+        # so they are between 0 and 1.
+        # A hypersphere is defined on tanh.
+
+        logger.info('Emb1.shape = {}'.format(emb_sp1.shape))
+        return np.mean(emb_sp1, axis=0)
+
+    def training_embeddings(self, max_speakers=None):
+        """Mean embedding of the training speakers (audio cache), e.g. to fit the PCA of the gallery codec."""
+        from deepspeaker.utils import generate_features_sliding
+        embeddings = []
+        for speaker in self.audio_reader.all_speaker_ids[0:max_speakers]:
+            cache, _ = self.audio_reader.load_cache([speaker])
+            feat = generate_features_sliding(list(cache.values()), stride=self.stride,
+                                             feature_executor=self.feature_executor)
+            if len(feat) == 0:
+                continue
+            feat = normalize(feat, np.mean([np.mean(t) for t in feat]), np.mean([np.std(t) for t in feat]))
+            embeddings.append(np.mean(self.embed(feat), axis=0))
+        return np.vstack(embeddings) if len(embeddings) > 0 else None
+
+    def make_codec(self, dtype='float32', pca_dim=None):
+        codec = EmbeddingCodec(dtype=dtype)
+        if pca_dim:
+            embeddings = self.training_embeddings()
+            if embeddings is None:
+                logger.info('No training speakers in the audio cache: PCA fit on the enrolled speakers.')
+                embeddings = np.vstack([self.speaker_embedding(s) for s in self.speakers])
+            codec.pca_mean, codec.pca_components = fit_pca(embeddings, pca_dim)
+        return codec
+
+    def codec_report(self, codec):
+        """Identification accuracy of the enrolled recordings (held out, cf. codec_report), full precision vs codec."""
+        filenames = self.audio_reader.speaker_ids_to_filename_wav
+        recordings = [np.vstack([self.file_embedding(f) for f in filenames[speaker]]) for speaker in self.speakers]
+        return codec_report(codec, self.speakers, recordings)
+
+    def inference(self, filename):
+        # cosine distance to every enrolled speaker in a single matrix-vector product.
+        return self.gallery.score(self.file_embedding(filename))
+
+    def identify(self, filename, k=5, match_threshold=0.1):
+        """
+        (speaker, candidates): the k closest enrolled speakers [{'speaker', 'cosine'}], closest first, and the
+        closest one if its distance is at most match_threshold (None otherwise).
+        """
+        candidates = [{'speaker': speaker_id, 'cosine': cosine}
+                      for speaker_id, cosine in self.gallery.top_k(self.file_embedding(filename), k=max(1, k))]
+        speaker = None
+        if len(candidates) > 0 and candidates[0]['cosine'] <= match_threshold:
+            speaker = candidates[0]['speaker']
+        return speaker, candidates[0:k]
+
+    def identify_anytime(self, filename, k=5, match_threshold=0.1, **kwargs):
+        # identify that stops once the decision is confident, cf. sequential.anytime_identify for the parameters.
+        audio_entity = get_audio(sample_rate=self.audio_reader.sample_rate, input_filename=filename)[0]
+        return anytime_identify(audio_entity['audio_voice_only'], self.audio_reader.sample_rate, self.embed,
+                                self.gallery, k=k, match_threshold=match_threshold, stride=self.stride, **kwargs)
+
+    def diarize(self, filename, **kwargs):
+        # who speaks when in a long recording, cf. diarization.diarize for the parameters.
+        audio, _ = read_audio_from_filename(filename, self.audio_reader.sample_rate)
+        return diarize(audio, self.audio_reader.sample_rate, self.embed, self.gallery, **kwargs)
+
+    def streaming_identifier(self, **kwargs):
+        # one per live stream, cf. streaming.StreamingSpeakerIdentifier for the parameters.
+        return StreamingSpeakerIdentifier(self.embed, self.gallery, self.audio_reader.sample_rate, **kwargs)
+
+    def run(self, filename):
+        speaker, candidates = self.identify(filename, k=1)
+        print(candidates)
+        return speaker
 
 
 def merge_dicts(*dict_args):
@@ -182,6 +311,7 @@ def merge_dicts(*dict_args):
 def inference_embeddings(audio_reader, speaker_id):
     speaker_feat = generate_features_for_unseen_speakers(audio_reader, target_speaker=speaker_id)
 
+    from deepspeaker.train_cli import triplet_softmax_model
     # batch_size => None (for inference).
     m = triplet_softmax_model(num_speakers_softmax=len(c.AUDIO.SPEAKERS_TRAINING_SET),
                               emb_trainable=False,
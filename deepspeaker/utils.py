@@ -8,7 +8,8 @@ import deepdish as dd
 import librosa
 
 from deepspeaker.constants import c
-from deepspeaker.speech_features import get_mfcc_features_390
+from deepspeaker.manifest import MANIFEST_FILENAME, Manifest, digest
+from deepspeaker.speech_features import crop_mfcc_features_390, feature_params, get_mfcc_features_390
 
 logger = logging.getLogger(__name__)
 
@@ -45,28 +46,53 @@ def data_to_keras(data):
     return kx_train, ky_train, kx_test, ky_test, categorical_speakers
 
 
-def generate_features(audio_entities, max_count, progress_bar=False):
-    features = []
+def extract_features(signals, feature_executor=None):
+    # get_mfcc_features_390 of every signal, in the worker processes of feature_executor if any.
+    if feature_executor is not None:
+        return feature_executor.map_mfcc_features_390(signals, c.AUDIO.SAMPLE_RATE)
+    return [get_mfcc_features_390(signal, c.AUDIO.SAMPLE_RATE, max_frames=None) for signal in signals]
+
+
+def generate_features(audio_entities, max_count, progress_bar=False, feature_executor=None):
+    # random crops of the voiced signals. The features of each signal are computed once and every crop is a slice
+    # of them (cf. crop_mfcc_features_390), instead of featurizing max_count sub-signals.
     count_range = range(max_count)
     if progress_bar:
         from tqdm import tqdm
         count_range = tqdm(count_range)
+
+    signals = [audio_entity['audio_voice_only'] for audio_entity in audio_entities]
+    full_features = extract_features(signals, feature_executor)
+    features = []
     for _ in count_range:
-        audio_entity = np.random.choice(audio_entities)
-        voice_only_signal = audio_entity['audio_voice_only']
-        cuts = np.random.uniform(low=1, high=len(voice_only_signal), size=2)
-        signal_to_process = voice_only_signal[int(min(cuts)):int(max(cuts))]
-        features_per_conv = get_mfcc_features_390(signal_to_process, c.AUDIO.SAMPLE_RATE, max_frames=None)
+        i = np.random.randint(len(audio_entities))
+        cuts = np.random.uniform(low=1, high=len(signals[i]), size=2)
+        features_per_conv = crop_mfcc_features_390(full_features[i], int(min(cuts)), int(max(cuts)),
+                                                   c.AUDIO.SAMPLE_RATE)
+        if len(features_per_conv) > 0:
+            features.append(features_per_conv)
+    return features
+
+
+def generate_features_sliding(audio_entities, stride=1, max_inputs=None, feature_executor=None):
+    # deterministic: the features of each voiced signal are computed once and every input is kept
+    # (or one every stride inputs, or max_inputs evenly spaced ones), instead of random crops.
+    features = []
+    signals = [audio_entity['audio_voice_only'] for audio_entity in audio_entities]
+    for features_per_conv in extract_features(signals, feature_executor):
+        features_per_conv = features_per_conv[::stride]
+        if max_inputs is not None and len(features_per_conv) > max_inputs:
+            features_per_conv = features_per_conv[np.linspace(0, len(features_per_conv) - 1, max_inputs).astype(int)]
         if len(features_per_conv) > 0:
             features.append(features_per_conv)
     return features
 
 
-def generate_features_for_new_file(input_filename):
+def generate_features_for_new_file(input_filename, stride=1, max_inputs=None, feature_executor=None):
     audio_entities = get_audio(sample_rate=8000, input_filename=input_filename)
     logger.info('Generating the inputs necessary for inference...')
-    logger.info('This might take a couple of minutes to complete.')
-    feat = generate_features(audio_entities, 500, progress_bar=False)
+    feat = generate_features_sliding(audio_entities, stride=stride, max_inputs=max_inputs,
+                                     feature_executor=feature_executor)
     mean = np.mean([np.mean(t) for t in feat])
     std = np.mean([np.std(t) for t in feat])
     feat = normalize(feat, mean, std)
@@ -80,31 +106,68 @@ def normalize(list_matrices, mean, std):
 class InputsGenerator:
 
     def __init__(self, cache_dir, audio_reader, max_count_per_class=500,
-                 speakers_sub_list=None, multi_threading=False):
+                 speakers_sub_list=None, multi_threading=False, feature_executor=None):
         self.cache_dir = cache_dir
         self.audio_reader = audio_reader
         self.multi_threading = multi_threading
+        self.feature_executor = feature_executor
         self.inputs_dir = os.path.join(self.cache_dir, 'inputs')
         self.max_count_per_class = max_count_per_class
         if not os.path.exists(self.inputs_dir):
             os.makedirs(self.inputs_dir)
 
         self.speaker_ids = self.audio_reader.all_speaker_ids if speakers_sub_list is None else speakers_sub_list
+        # <speaker_id -> digest of its audio files> of the inputs already generated, and the generation parameters.
+        self.manifest = Manifest(os.path.join(self.inputs_dir, MANIFEST_FILENAME),
+                                 params={'max_count_per_class': max_count_per_class,
+                                         'features': feature_params(c.AUDIO.SAMPLE_RATE)})
+        self.audio_manifest = None
+
+    def speaker_digest(self, speaker_id):
+        """Digest of the audio files (paths and content hashes) the inputs of speaker_id are generated from."""
+        audio_cache = self.audio_reader.audio_cache
+        if speaker_id in audio_cache.rows_by_speaker:
+            if self.audio_manifest is None:
+                self.audio_manifest = self.audio_reader.load_manifest()
+            filenames = [str(audio_cache.index['filename'][row]) for row in audio_cache.rows_by_speaker[speaker_id]]
+            sources = [(f, self.audio_manifest.files.get(f, {}).get('sha1')) for f in sorted(filenames)]
+        else:
+            # pkl cache: the pkl files are only rewritten when their audio changes.
+            filenames = self.audio_reader.speaker_ids_to_filename.get(speaker_id, [])
+            sources = [(f, os.path.getsize(f), os.path.getmtime(f)) for f in sorted(filenames)]
+        return digest(sources)
 
     def start_generation(self):
         logger.info('Starting the inputs generation...')
-        if self.multi_threading:
+        if self.feature_executor is not None:
+            # speakers one after the other, the features of each speaker in parallel.
+            logger.info('Using the feature extraction processes.')
+            generated = [self.generate_and_dump_inputs_to_hdf5(s) for s in sorted(self.speaker_ids)]
+        elif self.multi_threading:
             num_threads = os.cpu_count()
             logger.info('Using {} threads.'.format(num_threads))
             # parallel_function(self.generate_and_dump_inputs_to_pkl, sorted(self.speaker_ids), num_threads)
-            parallel_function(self.generate_and_dump_inputs_to_hdf5, sorted(self.speaker_ids), num_threads)
+            generated = parallel_function(self.generate_and_dump_inputs_to_hdf5, sorted(self.speaker_ids), num_threads)
         else:
             logger.info('Using only 1 thread.')
+            generated = []
             for s in self.speaker_ids:
                 # self.generate_and_dump_inputs_to_pkl(s)
-                self.generate_and_dump_inputs_to_hdf5(s)
+                generated.append(self.generate_and_dump_inputs_to_hdf5(s))
+        # the workers return what they generated: the manifest is only written here.
+        generated = [g for g in generated if g is not None]
+        for speaker_id, speaker_digest, _ in generated:
+            self.manifest.outputs[speaker_id] = speaker_digest
+        self.manifest.save()
         from glob import glob
 
+        full_inputs_output_filename = os.path.join(self.cache_dir, 'full_inputs.h5')
+        inputs_filenames = {os.path.basename(f)[:-len('.h5')]: f for f in glob(self.inputs_dir + '/*.h5')}
+        if os.path.isfile(full_inputs_output_filename):
+            patch_unified_inputs(full_inputs_output_filename, inputs_filenames,
+                                 [s for s, _, regenerated in generated if regenerated])
+            return
+
         logger.info('Generating the unified inputs pkl file.')
         full_inputs = {}
         # for inputs_filename in glob(self.inputs_dir + '/*.pkl', recursive=True):
@@ -129,13 +192,19 @@ class InputsGenerator:
             return
 
         output_filename = os.path.join(self.inputs_dir, speaker_id + '.h5')
+        speaker_digest = self.speaker_digest(speaker_id)
         if os.path.isfile(output_filename):
-            logger.info('Inputs file already exists: {}.'.format(output_filename))
-            return
+            # files generated before the manifest existed are trusted as they are.
+            trusted = not self.manifest.params_changed and speaker_id not in self.manifest.outputs
+            if trusted or self.manifest.outputs.get(speaker_id) == speaker_digest:
+                logger.info('Inputs file is up to date: {}.'.format(output_filename))
+                return speaker_id, speaker_digest, False
+            logger.info('Audio of speaker {} changed: regenerating {}.'.format(speaker_id, output_filename))
 
         inputs = self.generate_inputs(speaker_id)
         dd.io.save(output_filename, inputs)
         logger.info('[DUMP INPUTS] {}'.format(output_filename))
+        return speaker_id, speaker_digest, True
 
     def generate_and_dump_inputs_to_pkl(self, speaker_id):
 
@@ -164,12 +233,16 @@ class InputsGenerator:
         feat = normalize(feat, mean, std)
         return feat
 
-    def generate_inputs_for_inference_no_cache(self, speaker_id):
+    def generate_inputs_for_inference_no_cache(self, speaker_id, stride=None):
         speaker_cache = self.audio_reader.load_audio_file_no_cache([speaker_id])
         audio_entities = list(speaker_cache.values())
         logger.info('Generating the inputs necessary for the inference (speaker is {})...'.format(speaker_id))
-        logger.info('This might take a couple of minutes to complete.')
-        feat = generate_features(audio_entities, self.max_count_per_class, progress_bar=False)
+        if stride is not None:
+            feat = generate_features_sliding(audio_entities, stride=stride, feature_executor=self.feature_executor)
+        else:
+            logger.info('This might take a couple of minutes to complete.')
+            feat = generate_features(audio_entities, self.max_count_per_class, progress_bar=False,
+                                     feature_executor=self.feature_executor)
         mean = np.mean([np.mean(t) for t in feat])
         std = np.mean([np.std(t) for t in feat])
         feat = normalize(feat, mean, std)
@@ -193,8 +266,10 @@ class InputsGenerator:
         audio_entities_train = audio_entities[0:cutoff]
         audio_entities_test = audio_entities[cutoff:]
 
-        train = generate_features(audio_entities_train, self.max_count_per_class)
-        test = generate_features(audio_entities_test, self.max_count_per_class)
+        train = generate_features(audio_entities_train, self.max_count_per_class,
+                                  feature_executor=self.feature_executor)
+        test = generate_features(audio_entities_test, self.max_count_per_class,
+                                 feature_executor=self.feature_executor)
         logger.info('Generated {}/{} inputs for train/test for speaker {}.'.format(self.max_count_per_class,
                                                                                    self.max_count_per_class,
                                                                                    speaker_id))
@@ -210,6 +285,38 @@ class InputsGenerator:
         return inputs
 
 
+DEEPDISH_FILE_ATTRS = ('DEEPDISH_IO_VERSION', 'PYTABLES_FORMAT_VERSION', 'TITLE')
+DEEPDISH_GROUP_ATTRS = ('CLASS', 'TITLE', 'VERSION')
+
+
+def patch_unified_inputs(full_inputs_filename, inputs_filenames, updated_speaker_ids):
+    """
+    Updates full_inputs.h5 in place instead of re-reading every per-speaker file: the group of each updated
+    speaker is replaced by a copy of its inputs file, and the groups of the speakers without inputs file
+    are deleted. The result is what dd.io.save would write for the whole dict.
+    HDF5 does not reclaim the space of deleted groups: h5repack the file to shrink it.
+    """
+    with h5py.File(full_inputs_filename, 'a') as full:
+        for speaker_id in sorted(set(full.keys()) - set(inputs_filenames)):
+            del full[speaker_id]
+            logger.info('Removed speaker {} from {}.'.format(speaker_id, full_inputs_filename))
+        for speaker_id in sorted(set(updated_speaker_ids) | (set(inputs_filenames) - set(full.keys()))):
+            if speaker_id in full:
+                del full[speaker_id]
+            with h5py.File(inputs_filenames[speaker_id], 'r') as inputs:
+                # the root of the inputs file (with its attributes: speaker_id, mean_train, std_train) becomes
+                # the group of the speaker.
+                inputs.copy(inputs['/'], full, name=speaker_id)
+            group = full[speaker_id]
+            entries = len(group) + len([k for k in group.attrs if k not in DEEPDISH_FILE_ATTRS + DEEPDISH_GROUP_ATTRS])
+            for k in DEEPDISH_FILE_ATTRS:
+                if k in group.attrs:
+                    del group.attrs[k]
+            group.attrs['TITLE'] = np.bytes_('dict:{}'.format(entries))
+            logger.info('Patched speaker {} in {}.'.format(speaker_id, full_inputs_filename))
+    logger.info('[PATCH UNIFIED INPUTS] {}'.format(full_inputs_filename))
+
+
 class SpeakersToCategorical:
     def __init__(self, data):
         from keras.utils import to_categorical
@@ -2,4 +2,5 @@
 python 2.7.0
 pip 18.1
 install CORS, Flask
+optional: flask-sock (websocket /api/stream_inference)
 '''
\ No newline at end of file
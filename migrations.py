@@ -0,0 +1,76 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+# MIGRATIONS[i] upgrades the schema from version i to version i + 1.
+# The version of a database file is stored in PRAGMA user_version (0 for a new or legacy file).
+# Never edit a migration that has been released: append a new one.
+MIGRATIONS = [
+	# 1: tables (previously created by create_table.py).
+	[
+		'CREATE TABLE IF NOT EXISTS personnel (id INTEGER PRIMARY KEY, name TEXT, phone TEXT, email TEXT, ava_url TEXT, position TEXT, part TEXT, sounds TEXT)',
+		'CREATE TABLE IF NOT EXISTS room (id INTEGER PRIMARY KEY, ava_url TEXT, name TEXT, description TEXT)',
+		'CREATE TABLE IF NOT EXISTS meeting (id INTEGER PRIMARY KEY, name TEXT, content TEXT, members TEXT, room_name TEXT, date_time TEXT, leader TEXT, secretary TEXT)',
+		'CREATE TABLE IF NOT EXISTS detail ( meeting_id INTEGER, id INTEGER PRIMARY KEY, time TEXT, name TEXT, content TEXT)',
+	],
+	# 2: indexes for the hot queries.
+	[
+		# detail lines of a meeting, in id order (the rowid is part of every index entry).
+		'CREATE INDEX IF NOT EXISTS idx_detail_meeting_id ON detail (meeting_id)',
+		'CREATE INDEX IF NOT EXISTS idx_meeting_date_time ON meeting (date_time)',
+		'CREATE INDEX IF NOT EXISTS idx_meeting_room_name ON meeting (room_name, date_time)',
+	],
+	# 3: full-text search over transcripts and meeting descriptions (cf. search.py).
+	# External content FTS5 tables, kept in sync with detail and meeting by triggers.
+	[
+		"CREATE VIRTUAL TABLE IF NOT EXISTS detail_fts USING fts5(content, name, content='detail', content_rowid='id')",
+		'''CREATE TRIGGER IF NOT EXISTS detail_fts_ai AFTER INSERT ON detail BEGIN
+			INSERT INTO detail_fts (rowid, content, name) VALUES (new.id, new.content, new.name);
+		END''',
+		'''CREATE TRIGGER IF NOT EXISTS detail_fts_ad AFTER DELETE ON detail BEGIN
+			INSERT INTO detail_fts (detail_fts, rowid, content, name) VALUES ('delete', old.id, old.content, old.name);
+		END''',
+		'''CREATE TRIGGER IF NOT EXISTS detail_fts_au AFTER UPDATE ON detail BEGIN
+			INSERT INTO detail_fts (detail_fts, rowid, content, name) VALUES ('delete', old.id, old.content, old.name);
+			INSERT INTO detail_fts (rowid, content, name) VALUES (new.id, new.content, new.name);
+		END''',
+		"INSERT INTO detail_fts (detail_fts) VALUES ('rebuild')",
+		"CREATE VIRTUAL TABLE IF NOT EXISTS meeting_fts USING fts5(name, content, content='meeting', content_rowid='id')",
+		'''CREATE TRIGGER IF NOT EXISTS meeting_fts_ai AFTER INSERT ON meeting BEGIN
+			INSERT INTO meeting_fts (rowid, name, content) VALUES (new.id, new.name, new.content);
+		END''',
+		'''CREATE TRIGGER IF NOT EXISTS meeting_fts_ad AFTER DELETE ON meeting BEGIN
+			INSERT INTO meeting_fts (meeting_fts, rowid, name, content) VALUES ('delete', old.id, old.name, old.content);
+		END''',
+		'''CREATE TRIGGER IF NOT EXISTS meeting_fts_au AFTER UPDATE ON meeting BEGIN
+			INSERT INTO meeting_fts (meeting_fts, rowid, name, content) VALUES ('delete', old.id, old.name, old.content);
+			INSERT INTO meeting_fts (rowid, name, content) VALUES (new.id, new.name, new.content);
+		END''',
+		"INSERT INTO meeting_fts (meeting_fts) VALUES ('rebuild')",
+	],
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def schema_version(con):
+	return con.execute('PRAGMA user_version').fetchone()[0]
+
+
+def migrate(con):
+	"""Upgrades the database in place to SCHEMA_VERSION. Each migration runs in its own transaction."""
+	version = schema_version(con)
+	if version > SCHEMA_VERSION:
+		raise RuntimeError('Database schema version {} is newer than this code ({}).'.format(version, SCHEMA_VERSION))
+	for version in range(version, SCHEMA_VERSION):
+		logger.info('Migrating database schema from version {} to {}.'.format(version, version + 1))
+		with con:
+			con.execute('BEGIN IMMEDIATE')
+			if schema_version(con) != version:
+				continue  # done by another process in the meantime.
+			for statement in MIGRATIONS[version]:
+				con.execute(statement)
+			con.execute('PRAGMA user_version = {}'.format(version + 1))
+	con.execute('PRAGMA optimize')
+	return schema_version(con)
+
@@ -0,0 +1,130 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+def content_key(data, *parts):
+	"""Hash of the uploaded bytes and of everything the result depends on (e.g. the model version, the parameters)."""
+	h = hashlib.sha256()
+	h.update(json.dumps(parts, sort_keys=True).encode('utf8'))
+	h.update(b'\0')
+	h.update(data)
+	return h.hexdigest()
+
+
+class ResultCache:
+	"""
+	Results of the uploads, by content_key: an in-memory LRU of max_entries JSON-serializable values and,
+	if disk_dir is set, an on-disk tier (one JSON file per key) that survives restarts, bounded to
+	max_disk_entries files (least recently used first, by mtime).
+	Thread-safe. Results computed by an older model or gallery are never returned, because their version
+	is part of the key: they just age out. Results of a dependency that cannot be versioned (e.g. a remote
+	service) are read with a max_age_sec.
+	"""
+
+	def __init__(self, max_entries=1024, disk_dir=None, max_disk_entries=100000):
+		self.max_entries = max_entries
+		self.disk_dir = disk_dir
+		self.max_disk_entries = max_disk_entries
+		self.entries = OrderedDict()  # <key -> (time stored, value)>
+		self.lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+		self.disk_entries = 0
+		if disk_dir is not None:
+			if not os.path.exists(disk_dir):
+				os.makedirs(disk_dir)
+			self.disk_entries = len(self._disk_files())
+
+	def _disk_filename(self, key):
+		return os.path.join(self.disk_dir, key[0:2], key + '.json')
+
+	def _disk_files(self):
+		return [os.path.join(root, name) for root, _, names in os.walk(self.disk_dir)
+				for name in names if name.endswith('.json')]
+
+	def _remember(self, key, entry):
+		with self.lock:
+			self.entries[key] = entry
+			self.entries.move_to_end(key)
+			while len(self.entries) > self.max_entries:
+				self.entries.popitem(last=False)
+
+	def _read_disk(self, key):
+		filename = self._disk_filename(key)
+		try:
+			with open(filename, 'r') as r:
+				entry = json.load(r)
+			os.utime(filename)  # recently used: pruned last.
+		except (OSError, ValueError):
+			return None
+		return entry['time'], entry['value']
+
+	def get(self, key, default=None, max_age_sec=None):
+		with self.lock:
+			entry = self.entries.get(key)
+			if entry is not None:
+				self.entries.move_to_end(key)
+		if entry is None and self.disk_dir is not None:
+			entry = self._read_disk(key)
+			if entry is not None:
+				self._remember(key, entry)
+		if entry is None or (max_age_sec is not None and time.time() - entry[0] > max_age_sec):
+			self.misses += 1
+			return default
+		self.hits += 1
+		return entry[1]
+
+	def put(self, key, value):
+		entry = (time.time(), value)
+		self._remember(key, entry)
+		if self.disk_dir is not None:
+			filename = self._disk_filename(key)
+			try:
+				if not os.path.exists(os.path.dirname(filename)):
+					os.makedirs(os.path.dirname(filename), exist_ok=True)
+				is_new = not os.path.exists(filename)
+				tmp_filename = '{}.{}.tmp'.format(filename, threading.get_ident())
+				with open(tmp_filename, 'w') as w:
+					json.dump({'time': entry[0], 'value': value}, w)
+				os.replace(tmp_filename, filename)
+			except OSError as e:
+				logger.warning('Could not write the cached result {}: {}'.format(filename, e))
+				return
+			with self.lock:
+				self.disk_entries += is_new
+				prune = self.max_disk_entries is not None and self.disk_entries > self.max_disk_entries
+			if prune:
+				self.prune_disk()
+
+	def prune_disk(self):
+		"""Removes the least recently used files of the disk tier, down to 90% of max_disk_entries."""
+		files = []
+		for filename in self._disk_files():
+			try:
+				files.append((os.stat(filename).st_mtime, filename))
+			except OSError:
+				pass
+		files.sort()
+		excess = len(files) - int(0.9 * self.max_disk_entries)
+		for _, filename in files[0:max(0, excess)]:
+			try:
+				os.remove(filename)
+			except OSError:
+				pass
+		with self.lock:
+			self.disk_entries = len(files) - max(0, excess)
+		logger.info('Pruned {} cached results from {}.'.format(max(0, excess), self.disk_dir))
+
+	def clear(self):
+		with self.lock:
+			self.entries.clear()
+
+	def __len__(self):
+		return len(self.entries)
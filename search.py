@@ -0,0 +1,78 @@
+import html
+
+HIGHLIGHT_START = '<b>'
+HIGHLIGHT_END = '</b>'
+# FTS5 marks the matches with these control characters, replaced by the HTML tags once the text is escaped
+MATCH_START = '\x02'
+MATCH_END = '\x03'
+HIGHLIGHTED_FIELDS = ('meeting_name', 'content')
+
+DETAIL_QUERY = '''SELECT 'detail' AS type, d.id AS id, d.meeting_id AS meeting_id, d.name AS name, d.time AS time,
+	m.name AS meeting_name, m.date_time AS date_time,
+	highlight(detail_fts, 0, :hl_start, :hl_end) AS content, bm25(detail_fts) AS rank, 1 AS kind_order
+	FROM detail_fts JOIN detail d ON d.id = detail_fts.rowid LEFT JOIN meeting m ON m.id = d.meeting_id
+	WHERE detail_fts MATCH :q'''
+
+MEETING_QUERY = '''SELECT 'meeting' AS type, m.id AS id, m.id AS meeting_id, NULL AS name, NULL AS time,
+	highlight(meeting_fts, 0, :hl_start, :hl_end) AS meeting_name, m.date_time AS date_time,
+	snippet(meeting_fts, 1, :hl_start, :hl_end, '...', 32) AS content, bm25(meeting_fts) AS rank,
+	0 AS kind_order
+	FROM meeting_fts JOIN meeting m ON m.id = meeting_fts.rowid
+	WHERE meeting_fts MATCH :q'''
+
+RESULT_FIELDS = ['type', 'id', 'meeting_id', 'name', 'time', 'meeting_name', 'date_time', 'content', 'rank']
+
+
+def to_html(highlighted):
+	# user text is escaped: only the highlight tags are markup.
+	if highlighted is None:
+		return None
+	return html.escape(highlighted).replace(MATCH_START, HIGHLIGHT_START).replace(MATCH_END, HIGHLIGHT_END)
+
+
+def to_match_query(text):
+	# user text -> FTS5 query: every word must appear, FTS5 operators and syntax characters are not interpreted.
+	return ' '.join('"{}"'.format(word.replace('"', '""')) for word in text.split())
+
+
+def date_filters(date_from, date_to):
+	where = ''
+	if date_from:
+		where += ' AND m.date_time >= :date_from'
+	if date_to:
+		where += ' AND substr(m.date_time, 1, length(:date_to)) <= :date_to'
+	return where
+
+
+def search(con, text, meeting_id=None, name=None, date_from=None, date_to=None,
+		   kinds=('detail', 'meeting'), limit=20, offset=0):
+	"""
+	Ranked (bm25) full-text search over transcript lines and meeting descriptions, with highlighted matches:
+	content and meeting_name are HTML-escaped, with the matches in <b></b>.
+	bm25 scores of the two tables are not comparable (each has its own statistics), so the kinds are not
+	interleaved: the matching meetings come first, then the matching lines, each kind in its own rank order
+	(then by id, so that pages do not overlap). rank is only meaningful within a kind.
+	date_from and date_to are inclusive and compared with meeting.date_time as prefixes ('2018-12', '2018-12-21'...).
+	A speaker name filter only applies to transcript lines.
+	"""
+	params = {'q': to_match_query(text), 'hl_start': MATCH_START, 'hl_end': MATCH_END,
+			  'meeting_id': meeting_id, 'name': name, 'date_from': date_from, 'date_to': date_to,
+			  'limit': limit, 'offset': offset}
+	queries = []
+	if 'detail' in kinds:
+		where = date_filters(date_from, date_to)
+		if meeting_id is not None:
+			where += ' AND d.meeting_id = :meeting_id'
+		if name:
+			where += ' AND TRIM(d.name) = TRIM(:name)'
+		queries.append(DETAIL_QUERY + where)
+	if 'meeting' in kinds and not name:
+		where = date_filters(date_from, date_to)
+		if meeting_id is not None:
+			where += ' AND m.id = :meeting_id'
+		queries.append(MEETING_QUERY + where)
+	if not queries or not params['q']:
+		return []
+	query = ' UNION ALL '.join(queries) + ' ORDER BY kind_order, rank, id LIMIT :limit OFFSET :offset'
+	return [{f: to_html(row[f]) if f in HIGHLIGHTED_FIELDS else row[f] for f in RESULT_FIELDS}
+			for row in con.execute(query, params)]
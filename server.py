@@ -1,45 +1,131 @@
-from flask import Flask, render_template, request, g, make_response, jsonify
+from flask import Flask, render_template, request, g, make_response, jsonify, Response, abort, stream_with_context
 from flask_cors import CORS
-import sqlite3 as sql
 import json
 from werkzeug import secure_filename
 from deepspeaker.unseen_speakers import MultithreadsInference
 from deepspeaker.audio_reader import AudioReader
+from deepspeaker.feature_executor import FeatureExecutor
+from db import ConnectionPool, DetailWriteBehind, detail_time, insert_details, label_details, select_page
+from migrations import migrate
+from result_cache import ResultCache, content_key
+from search import search as search_transcripts
+from transcription import TranscriptionClient, TranscriptionError, transcribe_long
+import atexit
+import numpy as np
 import os
 
+try:
+	from flask_sock import Sock
+except ImportError:
+	Sock = None
+
 app = Flask(__name__)
 CORS(app)
 
 audio_reader = AudioReader()
-ds_inference = MultithreadsInference(audio_reader=audio_reader)
+# FEATURE_WORKERS=N: the MFCC extraction of uploads and enrollment runs in N processes
+feature_executor = None
+if int(os.environ.get('FEATURE_WORKERS', 0)) > 0:
+	feature_executor = FeatureExecutor(int(os.environ['FEATURE_WORKERS']))
+	atexit.register(feature_executor.shutdown)
+ds_inference = MultithreadsInference(audio_reader=audio_reader, feature_executor=feature_executor)
+db_pool = ConnectionPool("database.db")
+transcription_client = TranscriptionClient(os.environ.get('TRANSCRIBE_URL', 'http://0.0.0.0:4000/transcribe'))
+with db_pool.connection() as con:
+	migrate(con)
+
+# results of /api/inference and /api/uploader by content of the upload: RESULT_CACHE_SIZE entries in memory
+# (0 disables the cache), and RESULT_CACHE_DIR=<dir> keeps at most RESULT_CACHE_DISK_SIZE of them on disk as well
+result_cache = None
+if int(os.environ.get('RESULT_CACHE_SIZE', 1024)) > 0:
+	result_cache = ResultCache(int(os.environ.get('RESULT_CACHE_SIZE', 1024)), os.environ.get('RESULT_CACHE_DIR'),
+							   max_disk_entries=int(os.environ.get('RESULT_CACHE_DISK_SIZE', 100000)))
+# the transcription model is remote: its transcripts are keyed by TRANSCRIBE_VERSION (to set when the service's
+# model changes) and expire after TRANSCRIPT_CACHE_TTL seconds anyway
+TRANSCRIBE_VERSION = os.environ.get('TRANSCRIBE_VERSION', '')
+TRANSCRIPT_CACHE_TTL = float(os.environ.get('TRANSCRIPT_CACHE_TTL', 24 * 3600))
+
+# DETAIL_WRITE_BEHIND=1: single detail lines are queued and written in batches
+detail_writer = None
+if os.environ.get('DETAIL_WRITE_BEHIND') == '1':
+	detail_writer = DetailWriteBehind(db_pool)
+	atexit.register(detail_writer.close)
+
+
+# one pooled connection per request, given back when the request ends
+def get_db():
+	if 'db' not in g:
+		g.db = db_pool.acquire()
+	return g.db
+
+
+@app.teardown_appcontext
+def release_db(exception):
+	con = g.pop('db', None)
+	if con is not None:
+		db_pool.release(con)
+
+
+PERSONNEL_FIELDS = ['id', 'ava_url', 'name', 'phone', 'email', 'position', 'part', 'sounds']
+ROOM_FIELDS = ['id', 'ava_url', 'name', 'description']
+MEETING_FIELDS = ['id', 'name', 'content', 'members', 'room_name', 'date_time', 'leader', 'secretary']
+DETAIL_FIELDS = ['id', 'name', 'meeting_id', 'time', 'content']
+
+
+# ?limit=&after_id= for keyset pagination, ?fields=a,b for projection
+def list_args(all_fields):
+	fields = request.args.get('fields')
+	fields = all_fields if not fields else fields.split(',')
+	unknown = [f for f in fields if f not in all_fields]
+	if unknown:
+		abort(400, 'Unknown fields: {}'.format(', '.join(unknown)))
+	limit = request.args.get('limit', type=int)
+	if limit is not None and limit <= 0:
+		abort(400, 'limit must be positive')
+	after_id = request.args.get('after_id', type=int)
+	return fields, limit, after_id
+
+
+def list_table(table, all_fields, where=None, params=()):
+	fields, limit, after_id = list_args(all_fields)
+	rows = select_page(get_db(), table, fields, where, params, limit, after_id).fetchall()
+	result = {
+		table: [{f: row[f] for f in fields} for row in rows]
+	}
+	if limit is not None:
+		# id to pass as after_id to get the next page, None when this was the last one
+		result['next_after_id'] = rows[-1]['id'] if len(rows) == limit else None
+	return json.dumps(result)
+
+
+def stream_rows(table, cur, fields, limit=None, ndjson=False, chunk_size=500):
+	last_id = None
+	count = 0
+	if not ndjson:
+		yield '{"%s": [' % table
+	while True:
+		rows = cur.fetchmany(chunk_size)
+		if not rows:
+			break
+		lines = [json.dumps({f: row[f] for f in fields}) for row in rows]
+		if ndjson:
+			yield '\n'.join(lines) + '\n'
+		else:
+			yield (', ' if count else '') + ', '.join(lines)
+		count += len(rows)
+		last_id = rows[-1]['id']
+	if not ndjson:
+		if limit is not None:
+			yield '], "next_after_id": %s}' % json.dumps(last_id if count == limit else None)
+		else:
+			yield ']}'
 
 
 # api get all personnel
 @app.route('/api/personnel', methods = ['GET'])
 def personnel():
 	if request.method == 'GET':
-		con = sql.connect("database.db")
-		con.row_factory = sql.Row   
-		cur = con.cursor()
-		cur.execute("select * from personnel")
-		rows = cur.fetchall();
-		psn={
-		'personnel':[]
-		}
-
-		for row in rows:
-			psn['personnel'].append({
-				'id':row['id'],
-				'ava_url': row['ava_url'],
-				'name':row['name'],
-				'phone': row['phone'],
-				'email':row['email'],
-				'position':row['position'],
-				'part': row['part'],
-				'sounds':row['sounds']
-				})
-		con.close()
-		return json.dumps(psn)
+		return list_table('personnel', PERSONNEL_FIELDS)
 
 
 # api post a personnel
@@ -54,10 +140,9 @@ def add_person():
 		part=request.json['part']
 		sounds=request.json['sounds']
 
-		with sql.connect("database.db") as con:
+		with get_db() as con:
 			cur = con.cursor()
 			cur.execute("INSERT INTO personnel (ava_url,name,phone,email,position,part,sounds) VALUES (?,?,?,?,?,?,?)",(ava_url,name,phone,email,position,part,sounds))
-			con.commit()
 		return "Person Added"
 
 
@@ -73,10 +158,9 @@ def put_person(id):
 		part=request.json['part']
 		sounds=request.json['sounds']
 
-		with sql.connect("database.db") as con:
+		with get_db() as con:
 			cur = con.cursor()
 			cur.execute("UPDATE personnel SET ava_url=?,name=?,phone=?,email=?,position=?,part=?,sounds=? WHERE id=?",(ava_url,name,phone,email,position,part,sounds, id))
-			con.commit()
 
 		return "Person Changed"
 
@@ -85,10 +169,9 @@ def put_person(id):
 @app.route('/api/personnel/id=<int:id>',methods=['DELETE'])
 def del_person(id):
 	if request.method == 'DELETE':
-		with sql.connect("database.db") as con:
+		with get_db() as con:
 			cur = con.cursor()
-			cur.execute("DELETE FROM personnel WHERE id=%d" %id)
-			con.commit()
+			cur.execute("DELETE FROM personnel WHERE id=?", (id,))
 
 		return "Person Deleted"
 
@@ -97,25 +180,7 @@ def del_person(id):
 @app.route('/api/room', methods = ['GET'])
 def room():
 	if request.method == 'GET':
-		con = sql.connect("database.db")
-		con.row_factory = sql.Row   
-		cur = con.cursor()
-		cur.execute("SELECT * FROM room")
-
-		rows = cur.fetchall();
-		r = {
-			'room': []
-		}
-
-		for row in rows:
-			r['room'].append({
-				'id':row['id'],
-				'ava_url': row['ava_url'],
-				'name':row['name'],
-				'description':row['description']
-				})
-		con.close()
-		return json.dumps(r)
+		return list_table('room', ROOM_FIELDS)
 
 
 # api post a room
@@ -126,10 +191,9 @@ def add_room():
 		name=request.json['name']
 		description=request.json['description']
 	
-		with sql.connect("database.db") as con:
+		with get_db() as con:
 			cur = con.cursor()
 			cur.execute("INSERT INTO room (ava_url,name,description) VALUES (?,?,?)",(ava_url,name,description))
-			con.commit()
 
 		return "Room Added"
 
@@ -142,10 +206,9 @@ def put_room(id):
 		name=request.json['name']
 		description=request.json['description']
 	
-		with sql.connect("database.db") as con:
+		with get_db() as con:
 			cur = con.cursor()
 			cur.execute("UPDATE room SET ava_url=?,name=?,description=? WHERE id=?",(ava_url,name,description, id))
-			con.commit()
 
 		return "Room Changed"
 
@@ -154,10 +217,9 @@ def put_room(id):
 @app.route('/api/room/id=<int:id>',methods=['DELETE'])
 def del_room(id):
 	if request.method == 'DELETE':
-		with sql.connect("database.db") as con:
+		with get_db() as con:
 			cur = con.cursor()
-			cur.execute("DELETE FROM room WHERE id=%d" %id)
-			con.commit()
+			cur.execute("DELETE FROM room WHERE id=?", (id,))
 
 		return "Room Deleted"
 
@@ -166,28 +228,7 @@ def del_room(id):
 @app.route('/api/meeting', methods = ['GET'])
 def meeting():
 	if request.method == 'GET':
-		con = sql.connect("database.db")
-		con.row_factory = sql.Row   
-		cur = con.cursor()
-		cur.execute("select * from meeting")
-		rows = cur.fetchall();
-		m = {
-			'meeting': []
-		}
-
-		for row in rows:
-			m['meeting'].append({
-				'id':row['id'],
-				'name':row['name'],
-				'content':row['content'],
-				'members': row['members'],
-				'room_name': row['room_name'],
-				'date_time': row['date_time'],
-				'leader': row['leader'],
-				'secretary': row['secretary']
-				})
-		con.close()
-		return json.dumps(m)
+		return list_table('meeting', MEETING_FIELDS)
 
 
 # api create a meeting
@@ -202,10 +243,9 @@ def add_meeting():
 		leader=request.json['leader']
 		secretary=request.json['secretary']
 
-		with sql.connect("database.db") as con:
+		with get_db() as con:
 			cur = con.cursor()
 			cur.execute("INSERT INTO meeting (name,content,members,room_name,date_time,leader,secretary) VALUES (?,?,?,?,?,?,?)",(name,content,members,room_name,date_time,leader,secretary))
-			con.commit()
 
 			return "Meeting Added"
 
@@ -222,10 +262,9 @@ def change_meeting(id):
 		leader=request.json['leader']
 		secretary=request.json['secretary']
 
-		with sql.connect("database.db") as con:
+		with get_db() as con:
 			cur = con.cursor()
 			cur.execute("UPDATE meeting SET name=?,content=?,members=?,room_name=?,date_time=?,leader=?,secretary=? WHERE id=?",(name,content,members,room_name,date_time,leader,secretary, id))
-			con.commit()
 
 			return "Meeting Changed"
 
@@ -234,37 +273,29 @@ def change_meeting(id):
 @app.route('/api/meeting/id=<int:id>', methods=['DELETE'])
 def del_meeting(id):
 	if request.method == 'DELETE':		
-		with sql.connect("database.db") as con:
+		with get_db() as con:
 			cur = con.cursor()
-			cur.execute("DELETE FROM meeting WHERE id=%d" %id)
-			con.commit()
+			cur.execute("DELETE FROM meeting WHERE id=?", (id,))
 
 			return "Meeting Deleted"
 
 
 # api get detail meeting by meetingId
+# transcripts can be long: rows are streamed, as a JSON document or as NDJSON (?format=ndjson)
 @app.route('/api/detail_meeting/meeting_id=<int:id>', methods = ['GET'])
 def detail(id):
 	if request.method == 'GET':
-		con = sql.connect("database.db")
-		con.row_factory = sql.Row   
-		cur = con.cursor()	
-		cur.execute("select * from detail where meeting_id = %d" %id)
-		rows = cur.fetchall();
-		d = {
-			'detail': []
-		}
-
-		for row in rows:
-			d['detail'].append({
-				'id':row['id'],
-				'name':row['name'],
-				'meeting_id':row['meeting_id'],
-				'time': row['time'],
-				'content': row['content']
-				})
-		con.close()
-		return json.dumps(d)
+		fields, limit, after_id = list_args(DETAIL_FIELDS)
+		ndjson = request.args.get('format') == 'ndjson'
+
+		def generate():
+			with db_pool.connection() as con:
+				cur = select_page(con, 'detail', fields, 'meeting_id = ?', (id,), limit, after_id)
+				for chunk in stream_rows('detail', cur, fields, limit, ndjson):
+					yield chunk
+
+		mimetype = 'application/x-ndjson' if ndjson else 'application/json'
+		return Response(stream_with_context(generate()), mimetype=mimetype)
 
 
 # api them 1 loi thoai
@@ -275,14 +306,38 @@ def add_detail(id):
 		content=request.json['content']
 		time=request.json['time']
 
-		with sql.connect("database.db") as con:
+		if detail_writer is not None:
+			detail_writer.put(name, content, time, id)
+			return "Detail Added", 202
+
+		with get_db() as con:
 			cur = con.cursor()
 			cur.execute("INSERT INTO detail (name,content,time,meeting_id) VALUES (?,?,?,?)",(name,content,time,id))
-			con.commit()
 
 			return "Detail Added"
 
 
+# api them nhieu loi thoai: [{name, content, time}, ...] in one transaction
+@app.route('/api/detail_meeting/meeting_id=<int:id>/bulk', methods = ['POST'])
+def add_details(id):
+	if request.method == 'POST':
+		lines = request.json
+		if isinstance(lines, dict):
+			lines = lines.get('detail')
+		if not isinstance(lines, list):
+			abort(400, 'Expected a list of detail lines')
+		try:
+			rows = [(line['name'], line['content'], line['time'], id) for line in lines]
+		except (KeyError, TypeError):
+			abort(400, 'Each detail line needs name, content and time')
+
+		ids = insert_details(get_db(), rows)
+		return make_response(jsonify({
+			'status': 'success',
+			'ids': ids
+		})), 200
+
+
 # api sua loi thoai
 @app.route('/api/detail_meeting/meeting_id=<int:id>/id=<int:id2>', methods = ['PUT'])
 def put_detail(id,id2):
@@ -291,10 +346,9 @@ def put_detail(id,id2):
 		content=request.json['content']
 		time=request.json['time']
 
-		with sql.connect("database.db") as con:
+		with get_db() as con:
 			cur = con.cursor()
 			cur.execute("UPDATE detail SET name=?,content=?,time=? WHERE meeting_id=? AND id =?",(name,content,time,id,id2))
-			con.commit()
 
 			return "Detail Changed"
 
@@ -303,23 +357,135 @@ def put_detail(id,id2):
 @app.route('/api/detail_meeting/meeting_id=<int:id>/id=<int:id2>', methods = ['DELETE'])
 def delete_detail(id,id2):
 	if request.method == 'DELETE':
-		with sql.connect("database.db") as con:
+		with get_db() as con:
 			cur = con.cursor()
 			cur.execute("DELETE FROM detail WHERE meeting_id=? AND id =?",(id,id2))
-			con.commit()
 
 			return "Detail Deleted"
 
 
+# api tim kiem: full-text search over transcript lines and meeting descriptions
+# ?q=&meeting_id=&name=&date_from=&date_to=&type=detail|meeting&limit=&offset=
+@app.route('/api/search', methods = ['GET'])
+def search():
+	if request.method == 'GET':
+		q = request.args.get('q', '')
+		kinds = request.args.get('type')
+		kinds = ('detail', 'meeting') if not kinds else kinds.split(',')
+		limit = request.args.get('limit', 20, type=int)
+		offset = request.args.get('offset', 0, type=int)
+		if limit <= 0 or offset < 0:
+			abort(400, 'limit must be positive and offset non negative')
+		results = search_transcripts(get_db(), q,
+									 meeting_id=request.args.get('meeting_id', type=int),
+									 name=request.args.get('name'),
+									 date_from=request.args.get('date_from'),
+									 date_to=request.args.get('date_to'),
+									 kinds=kinds, limit=limit, offset=offset)
+		return json.dumps({
+			'search': results,
+			'next_offset': offset + limit if len(results) == limit else None
+		})
+
+
+# writes the bytes of an upload already read (e.g. to compute its cache key) into lkh/
+def save_upload(client_filename, data):
+	audio_path = os.path.join('lkh', secure_filename(client_filename))
+	with open(audio_path, 'wb') as w:
+		w.write(data)
+	return audio_path
+
+
 # api upload file
 @app.route('/api/uploader', methods=['POST'])
 def uploader_file():
 	if request.method == 'POST':
 		f = request.files['file']
-		f.save(os.path.join('lkh', secure_filename(f.filename)))
-		audio_path =os.getcwd() +"/"+ os.path.join('lkh', secure_filename(f.filename))
-		r = os.popen('curl -X POST http://0.0.0.0:4000/transcribe -H "Content-type: multipart/form-data"' + ' -F "file=@"' + audio_path).read()
-		return r
+		data = f.read()
+		key = content_key(data, 'transcription', transcription_client.host, transcription_client.port,
+						  transcription_client.path, TRANSCRIBE_VERSION)
+		transcript = result_cache.get(key, max_age_sec=TRANSCRIPT_CACHE_TTL) if result_cache is not None else None
+		if transcript is not None:
+			return transcript
+		audio_path = save_upload(f.filename, data)
+		try:
+			transcript = transcription_client.transcribe(audio_path)
+		except TranscriptionError as e:
+			return make_response(jsonify({
+				'status': 'error',
+				'message': str(e)
+			})), 502
+		if result_cache is not None:
+			result_cache.put(key, transcript)
+		return transcript
+
+
+# api upload a whole meeting recording: transcribed in chunks split at silences,
+# fan_out chunks at a time, then written as detail lines of the meeting
+@app.route('/api/uploader/meeting_id=<int:id>', methods=['POST'])
+def uploader_meeting(id):
+	if request.method == 'POST':
+		f = request.files['file']
+		fan_out = request.args.get('fan_out', 4, type=int)
+		max_chunk_sec = request.args.get('max_chunk_sec', 30.0, type=float)
+		if fan_out < 1 or max_chunk_sec <= 0:
+			abort(400, 'fan_out and max_chunk_sec must be positive')
+		con = get_db()
+		meeting_row = con.execute("SELECT date_time FROM meeting WHERE id=?", (id,)).fetchone()
+		if meeting_row is None:
+			abort(404, 'Unknown meeting')
+		audio_path = os.path.join('lkh', secure_filename(f.filename))
+		f.save(audio_path)
+		try:
+			segments = transcribe_long(transcription_client, audio_path, fan_out=fan_out, max_chunk_sec=max_chunk_sec)
+		except TranscriptionError as e:
+			return make_response(jsonify({
+				'status': 'error',
+				'message': str(e)
+			})), 502
+
+		rows = [('', seg['text'], detail_time(meeting_row['date_time'], seg['start']), id) for seg in segments]
+		ids = insert_details(con, rows)
+		return make_response(jsonify({
+			'status': 'success',
+			'ids': ids,
+			'segments': segments
+		})), 200
+
+
+# api nhan dang ng noi theo thoi gian: (start, end, speaker) turns of a meeting recording
+# with ?meeting_id=<id>, unnamed detail lines of the meeting are labeled (write=label, default)
+# or one detail line is added per turn (write=insert)
+@app.route('/api/diarization', methods=['POST'])
+def diarization():
+	if request.method == 'POST':
+		f = request.files['file']
+		meeting_id = request.args.get('meeting_id', type=int)
+		write = request.args.get('write', 'label')
+		if write not in ('label', 'insert'):
+			abort(400, 'write must be label or insert')
+		meeting_row = None
+		if meeting_id is not None:
+			meeting_row = get_db().execute("SELECT date_time FROM meeting WHERE id=?", (meeting_id,)).fetchone()
+			if meeting_row is None:
+				abort(404, 'Unknown meeting')
+		filename = os.path.join('lkh', secure_filename(f.filename))
+		f.save(filename)
+		segments = ds_inference.diarize(filename)
+
+		ids = []
+		if meeting_row is not None:
+			if write == 'label':
+				ids = label_details(get_db(), meeting_id, meeting_row['date_time'], segments)
+			else:
+				rows = [(seg['speaker'] or '', '', detail_time(meeting_row['date_time'], seg['start']), meeting_id)
+						for seg in segments]
+				ids = insert_details(get_db(), rows)
+		return make_response(jsonify({
+			'status': 'success',
+			'segments': segments,
+			'ids': ids
+		})), 200
 
 
 # api upload file
@@ -327,14 +493,62 @@ def uploader_file():
 def inference():
 	if request.method == 'POST':
 		f = request.files['file']
-		f.save(os.path.join('lkh', secure_filename(f.filename)))
-		filename =os.getcwd() +"/"+ os.path.join('lkh', secure_filename(f.filename))
+		# result: the closest speaker if close enough, candidates: the k closest ones, ranked
+		k = request.args.get('k', 5, type=int)
+		if k < 1:
+			abort(400, 'k must be positive')
+		anytime = request.args.get('anytime', 0, type=int)
+		data = f.read()
+		# the version changes with the checkpoint and every enrollment: older results are never returned
+		key = content_key(data, 'inference', ds_inference.results_version(), k, anytime)
+		response = result_cache.get(key) if result_cache is not None else None
+		if response is not None:
+			return make_response(jsonify(response)), 200
+		filename = os.getcwd() + "/" + save_upload(f.filename, data)
 		# nhan dang ng noi
-		result = ds_inference.run(filename)
-		return make_response(jsonify({
-			'status': 'success',
-			'result': result
-		})), 200
+		if anytime:
+			# stops reading the upload as soon as the closest speaker is clearly ahead of the runner-up
+			decision = ds_inference.identify_anytime(filename, k=k)
+			response = {
+				'status': 'success',
+				'result': decision['speaker'],
+				'candidates': decision['candidates'],
+				'processed_sec': decision['processed_sec'],
+				'total_sec': decision['total_sec'],
+				'early_exit': decision['early_exit']
+			}
+		else:
+			result, candidates = ds_inference.identify(filename, k=k)
+			response = {
+				'status': 'success',
+				'result': result,
+				'candidates': candidates
+			}
+		if result_cache is not None:
+			result_cache.put(key, response)
+		return make_response(jsonify(response)), 200
+
+
+# websocket: live speaker identification. The client sends binary messages of 16-bit little-endian
+# mono PCM at 8 kHz and gets a JSON {time, speaker, cosine} decision every interval_ms of audio.
+# Needs the optional flask-sock package.
+if Sock is not None:
+	sock = Sock(app)
+
+	@sock.route('/api/stream_inference')
+	def stream_inference(ws):
+		identifier = ds_inference.streaming_identifier(interval_ms=request.args.get('interval_ms', 500, type=int),
+													   window_sec=request.args.get('window_sec', 3.0, type=float))
+		rest = b''  # odd trailing byte of the last message: a sample split across two messages
+		while True:
+			data = ws.receive()
+			if data is None or isinstance(data, str):
+				continue  # text messages (keep-alive) are ignored.
+			data = rest + data
+			rest = data[len(data) - len(data) % 2:]
+			pcm = np.frombuffer(data, dtype='<i2', count=len(data) // 2).astype(np.float32) / 32768.0
+			for decision in identifier.push(pcm):
+				ws.send(json.dumps(decision))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,20 @@
+import os
+import shutil
+import sys
+
+import pytest
+
+# the modules are imported as in server.py and the deepspeaker scripts, from the root of the repository
+# (deepspeaker/conf.json is looked up from the current directory).
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+
+@pytest.fixture
+def legacy_db(tmp_path):
+    """Copy of the database.db of the repository (legacy schema, user_version 0): the original is never modified."""
+    filename = str(tmp_path / 'database.db')
+    shutil.copy(os.path.join(ROOT, 'database.db'), filename)
+    return filename
@@ -0,0 +1,68 @@
+import numpy as np
+
+from deepspeaker.audio_cache import MmapAudioCache, voiced_bounds
+
+
+def entity(filename, num_samples, seed):
+    audio = np.random.RandomState(seed).uniform(-0.1, 0.1, size=(num_samples, 1)).astype(np.float32)
+    audio[num_samples // 3:num_samples // 2] *= 10  # the voiced part.
+    start, end = voiced_bounds(audio)
+    return {'audio': audio,
+            'audio_voice_only': audio[start:end],
+            'left_blank_duration_ms': float(start),
+            'right_blank_duration_ms': float(num_samples - end),
+            'filename': filename}
+
+
+def assert_same_entity(actual, expected):
+    assert actual['filename'] == expected['filename']
+    assert np.array_equal(actual['audio'], expected['audio'])
+    assert np.array_equal(actual['audio_voice_only'], expected['audio_voice_only'])
+    assert actual['left_blank_duration_ms'] == expected['left_blank_duration_ms']
+    assert actual['right_blank_duration_ms'] == expected['right_blank_duration_ms']
+
+
+def test_voiced_bounds():
+    audio = np.full(1000, 0.01, dtype=np.float32)
+    audio[400:500] = np.linspace(0.5, 1.0, 100)
+    start, end = voiced_bounds(audio)
+    assert 400 <= start < end < 500
+
+
+def test_append_and_load(tmp_path):
+    entities = [entity('corpus/p225/a.wav', 800, 0), entity('corpus/p225/b.wav', 1200, 1),
+                entity('corpus/p226/c.wav', 500, 2)]
+    cache = MmapAudioCache(str(tmp_path))
+    assert cache.append(entities) == 3
+    assert cache.append(entities[0:1]) == 0  # already cached.
+    assert len(cache) == 3
+    assert cache.speaker_ids == ['p225', 'p226']
+    assert cache.num_samples == 2500
+
+    loaded = cache.load_speakers(['p225'])
+    assert sorted(loaded) == ['corpus/p225/a.wav', 'corpus/p225/b.wav']
+    for e in entities[0:2]:
+        assert_same_entity(loaded[e['filename']], e)
+    assert len(cache.load_speakers()) == 3
+    assert cache.load_speakers(['unknown']) == {}
+
+
+def test_persistence_and_remove(tmp_path):
+    entities = [entity('corpus/p225/a.wav', 800, 0), entity('corpus/p226/b.wav', 600, 1)]
+    MmapAudioCache(str(tmp_path)).append(entities)
+
+    cache = MmapAudioCache(str(tmp_path))
+    assert 'corpus/p226/b.wav' in cache
+    assert_same_entity(cache.load_speakers(['p226'])['corpus/p226/b.wav'], entities[1])
+
+    assert cache.remove(['corpus/p225/a.wav', 'corpus/p999/missing.wav']) == 1
+    reopened = MmapAudioCache(str(tmp_path))
+    assert 'corpus/p225/a.wav' not in reopened
+    assert reopened.speaker_ids == ['p226']
+
+    # appending after a removal keeps the remaining samples intact.
+    new = entity('corpus/p227/c.wav', 400, 3)
+    reopened.append([new])
+    loaded = MmapAudioCache(str(tmp_path)).load_speakers()
+    assert_same_entity(loaded['corpus/p226/b.wav'], entities[1])
+    assert_same_entity(loaded['corpus/p227/c.wav'], new)
@@ -0,0 +1,84 @@
+import threading
+
+import numpy as np
+import pytest
+
+from deepspeaker.batching import BatchingScheduler
+
+
+class RecordingModel:
+
+    def __init__(self):
+        self.batch_sizes = []
+        self.lock = threading.Lock()
+
+    def predict(self, x):
+        with self.lock:
+            self.batch_sizes.append(len(x))
+        return x * 2.0 + 1.0
+
+
+def test_concurrent_callers_get_their_own_rows():
+    model = RecordingModel()
+    scheduler = BatchingScheduler(model.predict, max_batch_size=64, max_wait_ms=50)
+    rng = np.random.RandomState(0)
+    inputs = [rng.randn(rng.randint(1, 10), 390) for _ in range(32)]
+    outputs = [None] * len(inputs)
+    barrier = threading.Barrier(len(inputs))
+
+    def call(i):
+        barrier.wait()
+        outputs[i] = scheduler.predict(inputs[i])
+
+    threads = [threading.Thread(target=call, args=(i,)) for i in range(len(inputs))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    scheduler.close()
+    for x, y in zip(inputs, outputs):
+        assert np.array_equal(y, x * 2.0 + 1.0)
+    assert sum(model.batch_sizes) == sum(len(x) for x in inputs)
+    assert len(model.batch_sizes) < len(inputs)  # some requests were batched together.
+
+
+def test_errors_are_given_to_every_caller_of_the_batch():
+    def fail(x):
+        raise ValueError('bad batch')
+
+    scheduler = BatchingScheduler(fail, max_wait_ms=1)
+    with pytest.raises(ValueError):
+        scheduler.predict(np.zeros((2, 390)))
+    scheduler.close()
+
+
+def test_closed_scheduler_refuses_requests():
+    scheduler = BatchingScheduler(lambda x: x)
+    scheduler.close()
+    with pytest.raises(RuntimeError):
+        scheduler.submit(np.zeros((1, 390)))
+
+
+def test_submit_racing_close_never_hangs():
+    for _ in range(20):
+        scheduler = BatchingScheduler(RecordingModel().predict, max_batch_size=8, max_wait_ms=1)
+        futures = []
+        errors = []
+
+        def call():
+            for _ in range(50):
+                try:
+                    futures.append(scheduler.submit(np.ones((1, 390))))
+                except RuntimeError:
+                    errors.append(1)
+
+        threads = [threading.Thread(target=call) for _ in range(4)]
+        for t in threads:
+            t.start()
+        scheduler.close()
+        for t in threads:
+            t.join()
+        for f in futures:
+            assert np.allclose(f.result(timeout=5), 3.0)
+        assert len(futures) + len(errors) == 200
+    scheduler.close()  # closing twice is harmless.
@@ -0,0 +1,189 @@
+import sqlite3 as sql
+import threading
+import time
+from contextlib import contextmanager
+
+from db import ConnectionPool, DetailWriteBehind, detail_offset, detail_time, insert_details, label_details, \
+	select_page
+
+
+def test_pool_connections_are_wal_and_reused(legacy_db):
+	pool = ConnectionPool(legacy_db, max_idle=2)
+	with pool.connection() as con:
+		assert con.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+		first = con
+	with pool.connection() as con:
+		assert con is first
+	pool.close_all()
+
+
+def test_release_rolls_back_open_transactions(legacy_db):
+	pool = ConnectionPool(legacy_db)
+	con = pool.acquire()
+	count = con.execute('SELECT COUNT(*) FROM room').fetchone()[0]
+	con.execute("INSERT INTO room (name) VALUES ('not committed')")
+	pool.release(con)
+	with pool.connection() as con:
+		assert con.execute('SELECT COUNT(*) FROM room').fetchone()[0] == count
+	pool.close_all()
+
+
+def test_readers_are_not_blocked_by_a_writer(legacy_db):
+	pool = ConnectionPool(legacy_db, timeout=0.5)
+	with pool.connection() as con:
+		count = con.execute('SELECT COUNT(*) FROM room').fetchone()[0]
+	writer = pool.acquire()
+	writer.execute('BEGIN IMMEDIATE')
+	writer.execute("INSERT INTO room (name) VALUES ('pending')")
+	counts = []
+
+	def read():
+		with pool.connection() as con:
+			counts.append(con.execute('SELECT COUNT(*) FROM room').fetchone()[0])
+
+	t = threading.Thread(target=read)
+	t.start()
+	t.join()
+	writer.rollback()
+	pool.release(writer)
+	assert counts == [count]  # the pending row is not visible, and the read did not time out.
+	pool.close_all()
+
+
+def test_select_page_walks_every_row_once(legacy_db):
+	pool = ConnectionPool(legacy_db)
+	with pool.connection() as con:
+		with con:
+			con.executemany('INSERT INTO room (name, description) VALUES (?, ?)', [('r{}'.format(i), 'd') for i in range(25)])
+		expected = [row['id'] for row in con.execute('SELECT id FROM room ORDER BY id')]
+		ids, after_id = [], None
+		while True:
+			rows = select_page(con, 'room', ['name'], limit=10, after_id=after_id).fetchall()
+			ids.extend(row['id'] for row in rows)
+			if len(rows) < 10:
+				break
+			after_id = rows[-1]['id']
+	assert ids == expected
+	pool.close_all()
+
+
+def test_select_page_projection_and_filter(legacy_db):
+	pool = ConnectionPool(legacy_db)
+	with pool.connection() as con:
+		meeting_id = con.execute('SELECT id FROM meeting ORDER BY id LIMIT 1').fetchone()[0]
+		rows = select_page(con, 'detail', ['content'], 'meeting_id = ?', (meeting_id,)).fetchall()
+		expected = con.execute('SELECT id, content FROM detail WHERE meeting_id = ? ORDER BY id', (meeting_id,)).fetchall()
+	assert [tuple(row) for row in rows] == [tuple(row) for row in expected]
+	assert all(row.keys() == ['id', 'content'] for row in rows)
+	pool.close_all()
+
+
+def test_insert_details_returns_the_new_ids(legacy_db):
+	pool = ConnectionPool(legacy_db)
+	rows = [('speaker', 'line {}'.format(i), '00:00:{:02d}'.format(i), 1) for i in range(50)]
+	with pool.connection() as con:
+		ids = insert_details(con, rows)
+		stored = con.execute('SELECT id, name, content, time, meeting_id FROM detail WHERE id >= ? ORDER BY id',
+							 (ids[0],)).fetchall()
+	assert len(ids) == 50 and ids == sorted(ids)
+	assert [tuple(row) for row in stored] == [(i,) + r for i, r in zip(ids, rows)]
+	pool.close_all()
+
+
+def test_write_behind_writes_every_row_in_batches(legacy_db):
+	pool = ConnectionPool(legacy_db)
+	with pool.connection() as con:
+		count = con.execute('SELECT COUNT(*) FROM detail').fetchone()[0]
+	writer = DetailWriteBehind(pool, max_rows=7, flush_interval=0.05)
+	for i in range(30):
+		writer.put('speaker', 'queued {}'.format(i), '', 1)
+	writer.close()  # flushes what is left.
+	with pool.connection() as con:
+		contents = [row[0] for row in con.execute('SELECT content FROM detail WHERE id > 0 ORDER BY id')]
+	assert len(contents) == count + 30
+	assert contents[-30:] == ['queued {}'.format(i) for i in range(30)]
+	pool.close_all()
+
+
+class FlakyPool:
+	"""ConnectionPool whose first failures connections fail, as when the database is locked."""
+
+	def __init__(self, pool, failures):
+		self.pool = pool
+		self.failures = failures
+		self.calls = 0
+
+	@contextmanager
+	def connection(self):
+		self.calls += 1
+		if self.calls <= self.failures:
+			raise sql.OperationalError('database is locked')
+		with self.pool.connection() as con:
+			yield con
+
+
+def stored_contents(pool, prefix):
+	with pool.connection() as con:
+		return [row[0] for row in con.execute('SELECT content FROM detail WHERE content LIKE ? ORDER BY id',
+											  (prefix + '%',))]
+
+
+def test_write_behind_retries_a_locked_database(legacy_db):
+	pool = ConnectionPool(legacy_db)
+	writer = DetailWriteBehind(FlakyPool(pool, failures=2), max_rows=10, flush_interval=0.05, retry_delay=0.001)
+	for i in range(5):
+		writer.put('speaker', 'retried {}'.format(i), '', 1)
+	writer.close()
+	assert stored_contents(pool, 'retried') == ['retried {}'.format(i) for i in range(5)]
+	assert writer.pending == [] and writer.failed == []
+	pool.close_all()
+
+
+def test_write_behind_keeps_rows_while_the_database_is_unavailable(legacy_db):
+	pool = ConnectionPool(legacy_db)
+	flaky = FlakyPool(pool, failures=10 ** 6)
+	writer = DetailWriteBehind(flaky, max_rows=10, flush_interval=0.05, retries=2, retry_delay=0.001)
+	for i in range(5):
+		writer.put('speaker', 'kept {}'.format(i), '', 1)
+	time.sleep(0.3)
+	flaky.failures = 0  # available again: the kept rows go first, in order.
+	writer.put('speaker', 'kept 5', '', 1)
+	writer.close()
+	assert stored_contents(pool, 'kept') == ['kept {}'.format(i) for i in range(6)]
+	assert writer.pending == []
+	pool.close_all()
+
+
+def test_write_behind_isolates_a_bad_row(legacy_db):
+	pool = ConnectionPool(legacy_db)
+	writer = DetailWriteBehind(pool, max_rows=10, flush_interval=0.05, retry_delay=0.001)
+	bad = ('speaker', object(), '', 1)  # cannot be bound.
+	writer.put('speaker', 'isolated 0', '', 1)
+	writer.put(*bad)
+	writer.put('speaker', 'isolated 1', '', 1)
+	writer.close()
+	assert stored_contents(pool, 'isolated') == ['isolated 0', 'isolated 1']
+	assert writer.failed == [bad]
+	pool.close_all()
+
+
+def test_detail_time_and_offset():
+	assert detail_time('2018-12-21 23:59:30', 45.4) == '00:00:15'
+	assert detail_offset('2018-12-21 23:59:30', '00:00:15') == 45
+	assert detail_time(None, 61) == '00:01:01'
+	assert detail_offset('2018-12-21 15:00:00', 'not a time') is None
+
+
+def test_label_details_names_unnamed_lines(legacy_db):
+	pool = ConnectionPool(legacy_db)
+	with pool.connection() as con:
+		with con:
+			meeting_id = con.execute("INSERT INTO meeting (name, date_time) VALUES ('m', '2018-12-21 15:00:00')").lastrowid
+		ids = insert_details(con, [('', 'a', '15:00:05', meeting_id), ('  ', 'b', '15:00:20', meeting_id),
+								   ('Lan', 'c', '15:00:06', meeting_id), ('', 'd', '15:00:50', meeting_id)])
+		segments = [{'start': 0.0, 'end': 10.0, 'speaker': 'Minh'}, {'start': 10.0, 'end': 30.0, 'speaker': 'Hoa'},
+					{'start': 30.0, 'end': 60.0, 'speaker': None}]
+		assert label_details(con, meeting_id, '2018-12-21 15:00:00', segments) == ids[0:2]
+		names = [row[0] for row in con.execute('SELECT name FROM detail WHERE meeting_id=? ORDER BY id', (meeting_id,))]
+	assert names == ['Minh', 'Hoa', 'Lan', '']
+	pool.close_all()
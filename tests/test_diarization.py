@@ -0,0 +1,81 @@
+import numpy as np
+
+from deepspeaker.diarization import ROW_HOP_SEC, SILENCE_LOG_ENERGY_RANGE, change_points, diarize, hop_embeddings
+from deepspeaker.embedding_codec import l2_normalize
+from deepspeaker.gallery import SpeakerGallery
+from deepspeaker.speech_features import get_mfcc_features_390
+
+RATE = 8000
+
+
+class ProjectionModel:
+    """Stand-in for the embedding model: fixed random projection, sigmoid, L2 normalization."""
+
+    def __init__(self, dim=32, seed=0):
+        self.kernel = np.random.RandomState(seed).randn(390, dim) * 0.1
+
+    def __call__(self, x):
+        return l2_normalize(1.0 / (1.0 + np.exp(-np.asarray(x).dot(self.kernel))))
+
+
+def two_speakers(seconds=6.0, silence_sec=0.0, seed=0):
+    # two very different "voices": a tone then white noise, then silence.
+    rng = np.random.RandomState(seed)
+    t = np.arange(int(seconds * RATE)) / RATE
+    first = 0.5 * np.sin(2 * np.pi * 800 * t) + 0.01 * rng.randn(len(t))
+    second = 0.5 * rng.randn(len(t))
+    return np.concatenate([first, second, 1e-6 * rng.randn(int(silence_sec * RATE))])
+
+
+def enroll_halves(sig, model, seconds=6.0):
+    feat = get_mfcc_features_390(sig, RATE)
+    mean, std = np.mean(feat), np.std(feat)
+    halves = [get_mfcc_features_390(sig[0:int(seconds * RATE)], RATE),
+              get_mfcc_features_390(sig[int(seconds * RATE):int(2 * seconds * RATE)], RATE)]
+    return SpeakerGallery(['tone', 'noise'], [np.mean(model((f - mean) / std), axis=0) for f in halves])
+
+
+def test_hop_embeddings_match_direct_computation():
+    sig = two_speakers(seconds=2.0, silence_sec=1.0)
+    model = ProjectionModel()
+    hop_rows = 10
+    hop_sums, voiced_counts = hop_embeddings(sig, RATE, model, hop_rows, block_rows=55)  # several blocks.
+    feat = get_mfcc_features_390(sig, RATE)
+    emb = model((feat - np.mean(feat)) / np.std(feat))
+    energies = np.mean(feat[:, 0:10], axis=1)
+    voiced = energies > np.percentile(energies, 95) - SILENCE_LOG_ENERGY_RANGE
+    hop_ids = np.arange(len(feat)) // hop_rows
+    assert len(hop_sums) == hop_ids[-1] + 1
+    for hop in range(len(hop_sums)):
+        rows = (hop_ids == hop) & voiced
+        assert voiced_counts[hop] == np.sum(rows)
+        assert np.allclose(hop_sums[hop], np.sum(emb[rows], axis=0), atol=1e-4)
+    assert voiced_counts[-1] == 0  # the trailing silence.
+
+
+def test_change_points_on_two_directions():
+    hop_sums = np.vstack([np.tile([1.0, 0.0, 0.1], (20, 1)), np.tile([0.0, 1.0, 0.1], (30, 1))])
+    assert change_points(hop_sums, window_hops=5) == [20]
+    assert change_points(hop_sums, window_hops=5, threshold=2.0) == []
+    assert change_points(hop_sums[0:8], window_hops=5) == []
+
+
+def test_diarize_two_speakers():
+    sig = two_speakers()
+    model = ProjectionModel()
+    segments = diarize(sig, RATE, model, enroll_halves(sig, model), match_threshold=1.0)
+    assert [s['speaker'] for s in segments] == ['tone', 'noise']
+    assert abs(segments[0]['end'] - 6.0) <= 0.3 + ROW_HOP_SEC
+    assert segments[0]['end'] == segments[1]['start']
+
+
+def test_diarize_does_not_report_silence():
+    sig = two_speakers(silence_sec=3.0)
+    model = ProjectionModel()
+    segments = diarize(sig, RATE, model, enroll_halves(sig, model), match_threshold=1.0, change_threshold=0.1)
+    assert [s['speaker'] for s in segments] == ['tone', 'noise']
+    assert segments[-1]['end'] <= 12.0 + 0.3 + ROW_HOP_SEC
+
+
+def test_diarize_empty_signal():
+    assert diarize(np.zeros(100), RATE, ProjectionModel(), SpeakerGallery()) == []
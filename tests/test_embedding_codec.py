@@ -0,0 +1,82 @@
+import numpy as np
+import pytest
+
+from deepspeaker.embedding_codec import EmbeddingCodec, codec_report, fit_pca, l2_normalize
+from deepspeaker.gallery import SpeakerGallery
+
+
+def embeddings(n=100, dim=64, seed=0):
+    return np.random.RandomState(seed).normal(size=(n, dim)).astype(np.float32)
+
+
+def test_float32_is_exact():
+    x = embeddings()
+    codec = EmbeddingCodec()
+    assert np.allclose(codec.decode(codec.encode(x)), l2_normalize(x), atol=1e-7)
+
+
+@pytest.mark.parametrize('dtype,bound', [('float16', 1e-3), ('int8', 0.5 / 127 + 1e-6)])
+def test_quantization_error_bounds(dtype, bound):
+    x = embeddings()
+    codec = EmbeddingCodec(dtype)
+    codes = codec.encode(x)
+    assert codes.dtype == np.dtype(dtype)
+    assert codes.nbytes == x.size * np.dtype(dtype).itemsize
+    assert np.max(np.abs(codec.decode(codes) - l2_normalize(x))) <= bound
+    # cosine similarities on the codes stay close to the full precision ones.
+    query = embeddings(1, seed=1)[0]
+    expected = l2_normalize(x).dot(l2_normalize(query))
+    assert np.max(np.abs(codec.similarities(codes, query, block_rows=7) - expected)) < 2e-2
+
+
+def test_pca_projection():
+    rng = np.random.RandomState(2)
+    # embeddings in a 8-dimensional subspace of a 64-dimensional space.
+    x = rng.normal(size=(200, 8)).dot(rng.normal(size=(8, 64))).astype(np.float32)
+    mean, components = fit_pca(x, 8)
+    assert components.shape == (8, 64)
+    assert np.allclose(components.dot(components.T), np.eye(8), atol=1e-4)
+    codec = EmbeddingCodec(pca_mean=mean, pca_components=components)
+    assert codec.name == 'float32+pca8'
+    codes = codec.encode(x)
+    assert codes.shape == (200, 8)
+    # the subspace is kept entirely: the cosine similarities are unchanged.
+    assert np.allclose(codec.similarities(codes, x[0]), l2_normalize(x).dot(l2_normalize(x[0])), atol=1e-4)
+
+
+def test_arrays_round_trip():
+    mean, components = fit_pca(embeddings(), 16)
+    for codec in (EmbeddingCodec(), EmbeddingCodec('int8', mean, components)):
+        loaded = EmbeddingCodec.from_arrays(codec.to_arrays())
+        assert loaded.name == codec.name
+        assert np.array_equal(loaded.encode(embeddings(seed=3)), codec.encode(embeddings(seed=3)))
+    assert EmbeddingCodec.from_arrays({}).name == 'float32'
+
+
+def test_gallery_save_load_with_codec(tmp_path):
+    x = embeddings()
+    speaker_ids = ['speaker_{}'.format(i) for i in range(len(x))]
+    mean, components = fit_pca(x, 32)
+    gallery = SpeakerGallery(speaker_ids, x, codec=EmbeddingCodec('int8', mean, components))
+    filename = str(tmp_path / 'gallery.npz')
+    gallery.save(filename)
+    loaded = SpeakerGallery.load(filename)
+    assert loaded.codec.name == 'int8+pca32'
+    assert loaded.codes.dtype == np.int8
+    assert loaded.top_k(x[5], k=5) == gallery.top_k(x[5], k=5)
+    assert loaded.top_k(x[5], k=1)[0][0] == 'speaker_5'
+
+
+def test_codec_report_on_held_out_recordings():
+    rng = np.random.RandomState(4)
+    centers = rng.normal(size=(20, 64))
+    recordings = [center + 0.5 * rng.normal(size=(4, 64)) for center in centers]
+    recordings.append(rng.normal(size=(1, 64)))  # a single recording: gallery only.
+    speaker_ids = ['speaker_{}'.format(i) for i in range(len(recordings))]
+    report = codec_report(EmbeddingCodec('int8'), speaker_ids, recordings)
+    assert report['queries'] == 80
+    assert report['bytes'] * 4 == report['bytes_full']
+    assert report['accuracy_full'] == 1.0
+    assert report['accuracy_delta'] == report['accuracy'] - report['accuracy_full']
+    assert report['top1_agreement'] == 1.0
+    assert 0 < report['max_distance_error'] < 2e-2
@@ -0,0 +1,47 @@
+import os
+
+import numpy as np
+import pytest
+
+from deepspeaker.feature_executor import FeatureExecutor
+from deepspeaker.speech_features import get_mfcc_features_390
+
+RATE = 8000
+
+
+@pytest.fixture(scope='module')
+def executor():
+    executor = FeatureExecutor(2)
+    yield executor
+    executor.shutdown()
+
+
+def shared_memory_segments():
+    return set(os.listdir('/dev/shm')) if os.path.isdir('/dev/shm') else set()
+
+
+def test_map_matches_serial(executor):
+    rng = np.random.RandomState(0)
+    signals = [rng.uniform(-1, 1, size=n).astype(np.float32) for n in (0, 100, 8000, 24000, 500, 16001)]
+    results = executor.map_mfcc_features_390(signals, RATE, max_pending=2)
+    assert len(results) == len(signals)
+    for sig, feat in zip(signals, results):
+        expected = get_mfcc_features_390(sig, RATE)
+        assert feat.shape == expected.shape
+        assert np.allclose(feat, expected)
+
+
+def test_single_extraction(executor):
+    sig = np.random.RandomState(1).uniform(-1, 1, size=8000)
+    assert np.allclose(executor.mfcc_features_390(sig, RATE), get_mfcc_features_390(sig, RATE))
+
+
+def test_shared_memory_is_freed_on_error(executor):
+    before = shared_memory_segments()
+    signals = [np.random.RandomState(i).uniform(-1, 1, size=16000).astype(np.float32) for i in range(6)]
+    signals[1] = np.zeros((16000, 3), dtype=np.float32)  # fails in the worker.
+    with pytest.raises(ValueError):
+        executor.map_mfcc_features_390(signals, RATE, max_pending=4)
+    assert shared_memory_segments() - before == set()
+    # the pool is still usable.
+    assert np.allclose(executor.mfcc_features_390(signals[0], RATE), get_mfcc_features_390(signals[0], RATE))
@@ -0,0 +1,126 @@
+import os
+import threading
+import time
+
+import numpy as np
+from scipy.spatial.distance import cosine
+
+from deepspeaker import gallery as gallery_module
+from deepspeaker.gallery import SpeakerGallery, files_fingerprint, top_k_rows
+
+
+def random_gallery(num_speakers=20, dim=200, seed=0, **kwargs):
+    rng = np.random.RandomState(seed)
+    embeddings = rng.uniform(size=(num_speakers, dim))
+    speaker_ids = ['speaker_{}'.format(i) for i in range(num_speakers)]
+    return SpeakerGallery(speaker_ids, embeddings, **kwargs), speaker_ids, embeddings
+
+
+def test_score_matches_scipy_cosine():
+    gallery, speaker_ids, embeddings = random_gallery()
+    query = np.random.RandomState(1).uniform(size=embeddings.shape[1])
+    scores = gallery.score(query)
+    for speaker_id, embedding in zip(speaker_ids, embeddings):
+        assert np.isclose(scores[speaker_id], cosine(query, embedding), atol=1e-5)
+
+
+def test_top_k_is_sorted_score():
+    gallery, _, embeddings = random_gallery()
+    query = np.random.RandomState(2).uniform(size=embeddings.shape[1])
+    expected = sorted(gallery.score(query).items(), key=lambda kv: kv[1])[0:5]
+    top = gallery.top_k(query, k=5)
+    assert [s for s, _ in top] == [s for s, _ in expected]
+    assert np.allclose([d for _, d in top], [d for _, d in expected], atol=1e-6)
+
+
+def test_empty_gallery():
+    gallery = SpeakerGallery()
+    assert len(gallery) == 0
+    assert gallery.top_k(np.ones(200)) == []
+    assert gallery.score(np.ones(200)) == {}
+
+
+def test_save_load_round_trip(tmp_path):
+    gallery, speaker_ids, embeddings = random_gallery(fingerprint='abc')
+    filename = str(tmp_path / 'gallery.npz')
+    gallery.save(filename)
+    loaded = SpeakerGallery.load(filename)
+    assert loaded.speaker_ids == speaker_ids
+    assert loaded.fingerprint == 'abc'
+    assert not loaded.is_stale('abc') and loaded.is_stale('def')
+    query = embeddings[3]
+    assert loaded.top_k(query, k=3) == gallery.top_k(query, k=3)
+
+
+def test_load_missing_file(tmp_path):
+    assert SpeakerGallery.load(str(tmp_path / 'missing.npz')) is None
+
+
+def test_files_fingerprint_changes_with_files(tmp_path):
+    a, b = str(tmp_path / 'a.wav'), str(tmp_path / 'b.wav')
+    for filename in (a, b):
+        with open(filename, 'wb') as w:
+            w.write(b'RIFF')
+    fingerprint = files_fingerprint([a, b])
+    assert files_fingerprint([b, a]) == fingerprint
+    assert files_fingerprint([a]) != fingerprint
+    assert files_fingerprint([a, b], extra='stride=2') != fingerprint
+    with open(b, 'ab') as w:
+        w.write(b'more')
+    assert files_fingerprint([a, b]) != fingerprint
+    os.remove(b)
+
+
+def clustered_gallery(num_clusters=50, per_cluster=40, dim=64, seed=0, **kwargs):
+    rng = np.random.RandomState(seed)
+    centers = rng.normal(size=(num_clusters, dim))
+    embeddings = np.repeat(centers, per_cluster, axis=0) + 0.3 * rng.normal(size=(num_clusters * per_cluster, dim))
+    speaker_ids = ['speaker_{}'.format(i) for i in range(len(embeddings))]
+    return SpeakerGallery(speaker_ids, embeddings, **kwargs), embeddings
+
+
+def test_top_k_rows_matches_argsort():
+    similarities = np.random.RandomState(3).normal(size=100)
+    for k in (1, 5, 100, 200):
+        assert np.array_equal(top_k_rows(similarities, k), np.argsort(-similarities)[0:k])
+    assert len(top_k_rows(similarities, 0)) == 0
+    assert len(top_k_rows(np.zeros(0), 5)) == 0
+
+
+def test_ivf_recall_against_flat_search():
+    ivf_gallery, embeddings = clustered_gallery(ivf_min_size=1, nprobe=4)
+    flat_gallery, _ = clustered_gallery(ivf_min_size=None)
+    rng = np.random.RandomState(4)
+    queries = embeddings[rng.choice(len(embeddings), size=50, replace=False)] + 0.1 * rng.normal(
+        size=(50, embeddings.shape[1]))
+    found, total = 0, 0
+    for query in queries:
+        expected = {s for s, _ in flat_gallery.top_k(query, k=10)}
+        top = ivf_gallery.top_k(query, k=10)
+        assert len(top) == 10
+        assert [d for _, d in top] == sorted(d for _, d in top)
+        found += len(expected & {s for s, _ in top})
+        total += len(expected)
+    assert ivf_gallery.ivf is not None and flat_gallery.ivf is None
+    assert found / total >= 0.95
+
+
+def test_ivf_index_is_built_once(monkeypatch):
+    builds = []
+    ivf_index = gallery_module.IVFIndex
+
+    def slow_ivf_index(*args, **kwargs):
+        builds.append(1)
+        time.sleep(0.2)
+        return ivf_index(*args, **kwargs)
+
+    monkeypatch.setattr(gallery_module, 'IVFIndex', slow_ivf_index)
+    gallery, embeddings = clustered_gallery(num_clusters=10, per_cluster=10, ivf_min_size=1)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(gallery.top_k(embeddings[0], k=3))) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(builds) == 1
+    assert len(results) == 8 and all(r == results[0] for r in results)
@@ -0,0 +1,60 @@
+import os
+
+from deepspeaker.manifest import Manifest, digest, file_sha1
+
+
+def write(filename, data):
+    with open(filename, 'wb') as w:
+        w.write(data)
+    return filename
+
+
+def test_digest_is_stable():
+    assert digest({'a': 1, 'b': [1, 2]}) == digest({'b': [1, 2], 'a': 1})
+    assert digest({'a': 1}) != digest({'a': 2})
+
+
+def test_changed_removed_record(tmp_path):
+    a = write(str(tmp_path / 'a.wav'), b'aaaa')
+    b = write(str(tmp_path / 'b.wav'), b'bbbb')
+    manifest_filename = str(tmp_path / 'out' / 'manifest.json')
+
+    manifest = Manifest(manifest_filename, params={'rate': 8000})
+    assert manifest.changed([a, b]) == [a, b]
+    manifest.record([a, b])
+    manifest.save()
+
+    manifest = Manifest(manifest_filename, params={'rate': 8000})
+    assert not manifest.params_changed
+    assert manifest.changed([a, b]) == []
+    assert manifest.sha1(a) == file_sha1(a)
+
+    # touched but identical: unchanged. Modified: changed.
+    st = os.stat(a)
+    os.utime(a, (st.st_atime + 10, st.st_mtime + 10))
+    write(b, b'bbbbb')
+    c = write(str(tmp_path / 'c.wav'), b'cccc')
+    manifest = Manifest(manifest_filename, params={'rate': 8000})
+    assert manifest.changed([a, b, c]) == [b, c]
+    assert manifest.removed([b, c]) == [a]
+
+    manifest.forget([a])
+    manifest.record([b, c])
+    manifest.save()
+    manifest = Manifest(manifest_filename, params={'rate': 8000})
+    assert sorted(manifest.files) == [b, c]
+    assert manifest.changed([b, c]) == []
+
+
+def test_params_changed(tmp_path):
+    a = write(str(tmp_path / 'a.wav'), b'aaaa')
+    manifest_filename = str(tmp_path / 'manifest.json')
+    manifest = Manifest(manifest_filename, params={'rate': 8000})
+    manifest.record([a])
+    manifest.outputs['p225'] = 'digest'
+    manifest.save()
+
+    manifest = Manifest(manifest_filename, params={'rate': 16000})
+    assert manifest.params_changed
+    assert manifest.changed([a]) == [a]
+    assert manifest.outputs == {}
@@ -0,0 +1,54 @@
+import sqlite3 as sql
+
+import pytest
+
+from migrations import SCHEMA_VERSION, migrate, schema_version
+
+
+def connect(filename):
+	con = sql.connect(filename)
+	con.row_factory = sql.Row
+	return con
+
+
+def schema(con):
+	return sorted(tuple(row) for row in con.execute('SELECT type, name, sql FROM sqlite_master'))
+
+
+def table_contents(con):
+	return {table: con.execute('SELECT * FROM {} ORDER BY id'.format(table)).fetchall()
+			for table in ('personnel', 'room', 'meeting', 'detail')}
+
+
+def test_migrating_the_legacy_database_keeps_the_data(legacy_db):
+	con = connect(legacy_db)
+	assert schema_version(con) == 0
+	before = {table: [tuple(row) for row in rows] for table, rows in table_contents(con).items()}
+	assert migrate(con) == SCHEMA_VERSION
+	after = {table: [tuple(row) for row in rows] for table, rows in table_contents(con).items()}
+	assert after == before
+	names = {row['name'] for row in con.execute('SELECT name FROM sqlite_master')}
+	assert {'idx_detail_meeting_id', 'detail_fts', 'meeting_fts'} <= names
+
+
+def test_migrate_is_idempotent(legacy_db):
+	con = connect(legacy_db)
+	migrate(con)
+	migrated = schema(con)
+	assert migrate(con) == SCHEMA_VERSION
+	assert schema(con) == migrated
+	con.close()
+	assert migrate(connect(legacy_db)) == SCHEMA_VERSION
+
+
+def test_new_database(tmp_path):
+	con = connect(str(tmp_path / 'new.db'))
+	assert migrate(con) == SCHEMA_VERSION
+	assert con.execute('SELECT COUNT(*) FROM detail').fetchone()[0] == 0
+
+
+def test_newer_schema_is_refused(legacy_db):
+	con = connect(legacy_db)
+	con.execute('PRAGMA user_version = {}'.format(SCHEMA_VERSION + 1))
+	with pytest.raises(RuntimeError):
+		migrate(con)
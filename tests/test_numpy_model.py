@@ -0,0 +1,48 @@
+import h5py
+import numpy as np
+import pytest
+
+from deepspeaker.numpy_model import NumpyEmbeddingModel, load_layer_weights
+
+
+def write_keras_weights(filename, kernel, bias, full_model=False):
+    # layout of keras' save_weights() (and of save(), under model_weights).
+    with h5py.File(filename, 'w') as f:
+        weights = f.create_group('model_weights') if full_model else f
+        layer = weights.create_group('fc1')
+        layer.attrs['weight_names'] = [b'fc1/kernel:0', b'fc1/bias:0']
+        layer['fc1/kernel:0'] = kernel
+        layer['fc1/bias:0'] = bias
+
+
+@pytest.mark.parametrize('full_model', [False, True])
+def test_load_layer_weights(tmp_path, full_model):
+    rng = np.random.RandomState(0)
+    kernel, bias = rng.randn(390, 200).astype(np.float32), rng.randn(200).astype(np.float32)
+    filename = str(tmp_path / 'checkpoint.h5')
+    write_keras_weights(filename, kernel, bias, full_model=full_model)
+    loaded_kernel, loaded_bias = load_layer_weights(filename, 'fc1')
+    assert np.array_equal(loaded_kernel, kernel) and np.array_equal(loaded_bias, bias)
+
+
+def test_predict_matches_dense_sigmoid_l2_normalize(tmp_path):
+    rng = np.random.RandomState(1)
+    kernel, bias = rng.randn(390, 200).astype(np.float32) * 0.05, rng.randn(200).astype(np.float32)
+    filename = str(tmp_path / 'checkpoint.h5')
+    write_keras_weights(filename, kernel, bias)
+    model = NumpyEmbeddingModel.from_checkpoint(filename)
+    x = rng.randn(32, 390)
+    expected = 1.0 / (1.0 + np.exp(-(x.dot(kernel) + bias)))
+    expected /= np.linalg.norm(expected, axis=1, keepdims=True)
+    embeddings = model.predict(x)
+    assert embeddings.shape == (32, 200)
+    assert np.allclose(embeddings, expected, atol=1e-5)
+    assert np.allclose(np.linalg.norm(embeddings, axis=1), 1.0, atol=1e-5)
+
+
+def test_predict_without_normalization():
+    kernel, bias = np.zeros((390, 4), dtype=np.float32), np.array([0.0, 100.0, -100.0, 1.0], dtype=np.float32)
+    model = NumpyEmbeddingModel(kernel, bias, normalize_embeddings=False)
+    embeddings = model.predict(np.ones(390))
+    assert np.allclose(embeddings, [[0.5, 1.0, 0.0, 1.0 / (1.0 + np.exp(-1.0))]], atol=1e-6)
+    assert np.all(np.isfinite(embeddings))
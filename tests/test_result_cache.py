@@ -0,0 +1,64 @@
+import os
+import time
+
+from result_cache import ResultCache, content_key
+
+
+def test_content_key():
+	key = content_key(b'audio', 'model-v1', {'k': 5})
+	assert key == content_key(b'audio', 'model-v1', {'k': 5})
+	assert key != content_key(b'audio!', 'model-v1', {'k': 5})
+	assert key != content_key(b'audio', 'model-v2', {'k': 5})
+	assert key != content_key(b'audio', 'model-v1', {'k': 3})
+
+
+def test_lru_eviction():
+	cache = ResultCache(max_entries=2)
+	cache.put('a', 1)
+	cache.put('b', 2)
+	assert cache.get('a') == 1  # b is now the least recently used.
+	cache.put('c', 3)
+	assert len(cache) == 2
+	assert cache.get('b') is None
+	assert cache.get('a') == 1 and cache.get('c') == 3
+	assert cache.get('missing', default='x') == 'x'
+	assert (cache.hits, cache.misses) == (3, 2)
+
+
+def test_disk_tier_survives_a_new_instance(tmp_path):
+	cache = ResultCache(max_entries=1, disk_dir=str(tmp_path))
+	cache.put('ab12', {'speaker': 'p225'})
+	cache.put('cd34', {'speaker': 'p226'})
+	assert len(cache) == 1
+	assert cache.get('ab12') == {'speaker': 'p225'}  # evicted from memory, read from disk.
+
+	restarted = ResultCache(max_entries=1, disk_dir=str(tmp_path))
+	assert restarted.disk_entries == 2
+	assert restarted.get('cd34') == {'speaker': 'p226'}
+	restarted.clear()
+	assert len(restarted) == 0 and restarted.get('ab12') == {'speaker': 'p225'}
+
+
+def test_max_age(tmp_path):
+	cache = ResultCache(disk_dir=str(tmp_path))
+	cache.put('ab12', 'transcript')
+	assert cache.get('ab12', max_age_sec=60) == 'transcript'
+	cache.entries['ab12'] = (time.time() - 120, 'transcript')
+	assert cache.get('ab12', max_age_sec=60) is None
+	assert cache.get('ab12') == 'transcript'
+
+
+def test_prune_disk_bounds_the_files(tmp_path):
+	cache = ResultCache(max_entries=100, disk_dir=str(tmp_path), max_disk_entries=10)
+	for i in range(10):
+		key = content_key(str(i).encode('utf8'))
+		cache.put(key, i)
+		os.utime(cache._disk_filename(key), (1000 + i, 1000 + i))  # oldest first.
+	kept = content_key(b'0')
+	assert ResultCache(disk_dir=str(tmp_path)).get(kept) == 0  # reading it makes it the most recently used.
+	cache.put(content_key(b'10'), 10)
+	files = [name for _, _, names in os.walk(str(tmp_path)) for name in names]
+	assert len(files) == cache.disk_entries == 9
+	assert os.path.exists(cache._disk_filename(kept))
+	assert not os.path.exists(cache._disk_filename(content_key(b'1')))
+	assert os.path.exists(cache._disk_filename(content_key(b'10')))
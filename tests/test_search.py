@@ -0,0 +1,84 @@
+import sqlite3 as sql
+
+import pytest
+
+from migrations import migrate
+from search import search, to_match_query
+
+
+@pytest.fixture
+def con(legacy_db):
+	con = sql.connect(legacy_db)
+	con.row_factory = sql.Row
+	migrate(con)
+	meeting_id = con.execute("INSERT INTO meeting (name, content, date_time) VALUES ('Weekly sync', 'budget review', "
+							 "'2018-12-21 15:00:00')").lastrowid
+	with con:
+		con.execute("INSERT INTO detail (name, content, time, meeting_id) VALUES ('Lan', 'the zebra report', '15:01:00', ?)",
+					(meeting_id,))
+	return con
+
+
+def contents(results):
+	return [r['content'] for r in results if r['type'] == 'detail']
+
+
+def test_insert_is_indexed(con):
+	results = search(con, 'zebra')
+	assert contents(results) == ['the <b>zebra</b> report']
+	assert results[0]['name'] == 'Lan' and results[0]['meeting_name'] == 'Weekly sync'
+
+
+def test_update_trigger(con):
+	with con:
+		con.execute("UPDATE detail SET content='the giraffe report' WHERE content='the zebra report'")
+	assert search(con, 'zebra') == []
+	assert contents(search(con, 'giraffe')) == ['the <b>giraffe</b> report']
+
+
+def test_delete_trigger(con):
+	with con:
+		con.execute("DELETE FROM detail WHERE content='the zebra report'")
+	assert search(con, 'zebra') == []
+
+
+def test_meeting_descriptions_are_searched(con):
+	results = search(con, 'budget')
+	assert [(r['type'], r['content']) for r in results] == [('meeting', '<b>budget</b> review')]
+	assert search(con, 'budget', kinds=('detail',)) == []
+
+
+def test_filters(con):
+	assert contents(search(con, 'zebra', name='Lan')) == ['the <b>zebra</b> report']
+	assert search(con, 'zebra', name='Minh') == []
+	assert contents(search(con, 'zebra', date_from='2018-12', date_to='2018-12-21')) == ['the <b>zebra</b> report']
+	assert search(con, 'zebra', date_to='2018-11') == []
+
+
+def test_user_text_is_escaped(con):
+	with con:
+		con.execute("INSERT INTO detail (name, content, time, meeting_id) VALUES "
+					"('x', '<img src=x onerror=alert(1)> okapi & co', '', 1)")
+	assert contents(search(con, 'okapi')) == ['&lt;img src=x onerror=alert(1)&gt; <b>okapi</b> &amp; co']
+
+
+def test_query_syntax_is_not_interpreted(con):
+	assert to_match_query('zebra OR "x') == '"zebra" "OR" """x"'
+	assert search(con, 'zebra NOT') == []  # both words are required, NOT is not an operator.
+	assert search(con, '   ') == []
+
+
+def test_kinds_are_ranked_separately(con):
+	with con:
+		meeting_id = con.execute("INSERT INTO meeting (name, content, date_time) VALUES ('Zebra planning', 'zoo', "
+								 "'2018-12-22 09:00:00')").lastrowid
+		for content in ('zebra', 'a zebra, another zebra', 'one zebra among many other words in this line'):
+			con.execute("INSERT INTO detail (name, content, time, meeting_id) VALUES ('Minh', ?, '09:00:00', ?)",
+						(content, meeting_id))
+	results = search(con, 'zebra')
+	assert [r['type'] for r in results] == ['meeting'] + ['detail'] * 4
+	ranks = [r['rank'] for r in results if r['type'] == 'detail']
+	assert ranks == sorted(ranks)
+	# pages follow the same order.
+	pages = [r for offset in range(len(results)) for r in search(con, 'zebra', limit=1, offset=offset)]
+	assert pages == results
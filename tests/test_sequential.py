@@ -0,0 +1,66 @@
+import numpy as np
+
+from deepspeaker.embedding_codec import l2_normalize
+from deepspeaker.gallery import SpeakerGallery
+from deepspeaker.sequential import anytime_identify
+from deepspeaker.speech_features import get_mfcc_features_390
+
+RATE = 8000
+KERNEL = np.random.RandomState(0).randn(390, 32) * 0.1
+
+
+def embed(x):
+    # stand-in for the embedding model: fixed random projection, sigmoid, L2 normalization.
+    return l2_normalize(1.0 / (1.0 + np.exp(-np.asarray(x).dot(KERNEL))))
+
+
+def voices(seconds, seed=0):
+    rng = np.random.RandomState(seed)
+    t = np.arange(int(seconds * RATE)) / RATE
+    return {'tone': 0.5 * np.sin(2 * np.pi * 800 * t) + 0.01 * rng.randn(len(t)),
+            'noise': 0.5 * rng.randn(len(t))}
+
+
+def full_signal_embedding(sig):
+    feat = get_mfcc_features_390(sig, RATE)
+    return np.mean(embed((feat - np.mean(feat)) / np.std(feat)), axis=0)
+
+
+def enrolled_gallery():
+    enrollment = voices(4.0, seed=1)
+    return SpeakerGallery(sorted(enrollment), [full_signal_embedding(enrollment[s]) for s in sorted(enrollment)])
+
+
+def test_without_early_exit_equals_full_signal():
+    gallery = enrolled_gallery()
+    sig = voices(3.0, seed=2)['noise']
+    result = anytime_identify(sig, RATE, embed, gallery, k=2, match_threshold=1.0, confidence=np.inf)
+    assert not result['early_exit']
+    assert result['processed_sec'] == result['total_sec'] == 3.0
+    expected = gallery.top_k(full_signal_embedding(sig), k=2)
+    assert [c['speaker'] for c in result['candidates']] == [s for s, _ in expected]
+    assert np.allclose([c['cosine'] for c in result['candidates']], [d for _, d in expected], atol=1e-5)
+    assert result['speaker'] == expected[0][0] == 'noise'
+
+
+def test_early_exit_on_a_clear_case():
+    gallery = enrolled_gallery()
+    sig = voices(20.0, seed=3)['tone']
+    result = anytime_identify(sig, RATE, embed, gallery, k=2, match_threshold=1.0)
+    assert result['early_exit']
+    assert result['speaker'] == 'tone'
+    assert 1.5 <= result['processed_sec'] < result['total_sec'] == 20.0
+
+
+def test_no_match_above_threshold():
+    gallery = enrolled_gallery()
+    sig = voices(3.0, seed=4)['tone']
+    result = anytime_identify(sig, RATE, embed, gallery, k=1, match_threshold=-1.0)
+    assert result['speaker'] is None
+    assert len(result['candidates']) == 1
+
+
+def test_empty_signal():
+    result = anytime_identify(np.zeros(0), RATE, embed, enrolled_gallery())
+    assert result['speaker'] is None and result['candidates'] == []
+    assert result['processed_sec'] == result['total_sec'] == 0.0
@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+
+from deepspeaker.speech_features import crop_mfcc_features_390, get_mfcc_features_390, iter_mfcc_features_390, \
+    mfcc_features, num_stacked_frames
+
+RATE = 8000
+
+
+def baseline_mfcc_features_390(sig, rate, max_frames=None):
+    # the original implementation: one mfcc_features() call per 25ms frame, then a loop over the contexts.
+    window_cnn_fr_size = int(25.0 / 1000 * rate)
+    window_cnn_fr_steps = int(10.0 / 1000 * rate)
+    feat_mat = []
+    for i in range(int(len(sig) / window_cnn_fr_steps)):
+        start = window_cnn_fr_steps * i
+        slice_sig = sig[start:start + window_cnn_fr_size]
+        if len(slice_sig) / rate == 25.0 / 1000:
+            feat_mat.append(mfcc_features(slice_sig, rate).flatten())
+    feat_mat = np.array(feat_mat, dtype=float)
+    indices = np.array(range(10))
+    new_feat_mat = []
+    for _ in range(len(feat_mat)):
+        if max(indices) >= len(feat_mat):
+            break
+        new_feat_mat.append(np.transpose(feat_mat[indices]).flatten())
+        indices += 3
+    new_feat_mat = np.array(new_feat_mat)
+    if max_frames is not None:
+        new_feat_mat = new_feat_mat[0:max_frames]
+    return new_feat_mat
+
+
+def signal(num_samples, seed=0):
+    return np.random.RandomState(seed).uniform(low=-1, high=1, size=num_samples)
+
+
+@pytest.mark.parametrize('num_samples', [0, 100, 199, 200, 1000, 8000, 12345])
+def test_matches_baseline(num_samples):
+    sig = signal(num_samples)
+    expected = baseline_mfcc_features_390(sig, RATE)
+    actual = get_mfcc_features_390(sig, RATE)
+    assert actual.shape == expected.shape
+    assert len(actual) == num_stacked_frames(num_samples, RATE)
+    if len(expected) > 0:
+        assert np.allclose(actual, expected, atol=1e-8)
+
+
+def test_max_frames_matches_baseline():
+    sig = signal(16000, seed=1)
+    for max_frames in (1, 7, 50, 1000):
+        expected = baseline_mfcc_features_390(sig, RATE, max_frames=max_frames)
+        assert np.allclose(get_mfcc_features_390(sig, RATE, max_frames=max_frames), expected, atol=1e-8)
+
+
+
+def test_iter_blocks_concatenate_to_full():
+    sig = signal(40000, seed=2)
+    full = get_mfcc_features_390(sig, RATE)
+    blocks = list(iter_mfcc_features_390(sig, RATE, block_rows=97))
+    assert [first for first, _ in blocks] == list(range(0, len(full), 97))
+    assert np.allclose(np.vstack([feat for _, feat in blocks]), full)
+
+
+@pytest.mark.parametrize('start,end', [(0, 16000), (240, 9000), (100, 9000), (479, 12345), (7000, 7500), (15000, 16000)])
+def test_crop_equals_recomputing(start, end):
+    sig = np.random.RandomState(5).uniform(low=-1, high=1, size=16000)
+    feat = get_mfcc_features_390(sig, RATE)
+    snapped = -(-start // 240) * 240  # the next input boundary (3 frames of 10ms).
+    expected = get_mfcc_features_390(sig[snapped:end], RATE)
+    cropped = crop_mfcc_features_390(feat, start, end, RATE)
+    assert len(cropped) == len(expected)
+    if len(expected) > 0:
+        assert np.allclose(cropped, expected)
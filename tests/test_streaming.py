@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+
+from deepspeaker.diarization import ROW_HOP_SEC
+from deepspeaker.embedding_codec import l2_normalize
+from deepspeaker.gallery import SpeakerGallery
+from deepspeaker.speech_features import get_mfcc_features_390
+from deepspeaker.streaming import StreamingFeatureExtractor, StreamingSpeakerIdentifier
+
+RATE = 8000
+
+
+def signal(num_samples, seed=0):
+    return np.random.RandomState(seed).uniform(low=-1, high=1, size=num_samples).astype(np.float32)
+
+
+@pytest.mark.parametrize('chunk_sizes', [[1], [79, 80, 81], [240], [1000, 3], [100000]])
+def test_extractor_matches_whole_signal(chunk_sizes):
+    sig = signal(24001)
+    extractor = StreamingFeatureExtractor(RATE)
+    outputs, position, i = [], 0, 0
+    while position < len(sig):
+        size = chunk_sizes[i % len(chunk_sizes)]
+        rows = extractor.push(sig[position:position + size])
+        if len(rows) > 0:
+            outputs.append(rows)
+        position, i = position + size, i + 1
+    expected = get_mfcc_features_390(sig, RATE)
+    assert np.allclose(np.vstack(outputs), expected)
+
+
+def test_extractor_keeps_bounded_state():
+    extractor = StreamingFeatureExtractor(RATE)
+    for i in range(50):
+        extractor.push(signal(8000, seed=i))
+    assert len(extractor.samples) < RATE * 0.025
+    assert len(extractor.frames) < 10
+
+
+def embed(x):
+    kernel = np.random.RandomState(0).randn(390, 16) * 0.1
+    return l2_normalize(1.0 / (1.0 + np.exp(-np.asarray(x).dot(kernel))))
+
+
+def test_identifier_decides_on_the_last_window():
+    sig = signal(5 * RATE)
+    gallery = SpeakerGallery(['a', 'b'], [embed(np.ones((1, 390)))[0], embed(-np.ones((1, 390)))[0]])
+    identifier = StreamingSpeakerIdentifier(embed, gallery, RATE, window_sec=1.0, interval_ms=500, match_threshold=1.0)
+    decisions = []
+    for start in range(0, len(sig), 800):
+        decisions.extend(identifier.push(sig[start:start + 800]))
+    assert [d['time'] for d in decisions] == [0.5 * (i + 1) for i in range(10)]
+    window = get_mfcc_features_390(sig, RATE)[-int(1.0 / ROW_HOP_SEC):]
+    window = (window - np.mean(window)) / np.std(window)
+    distances = gallery.distances(np.mean(embed(window), axis=0))
+    assert decisions[-1]['speaker'] == gallery.speaker_ids[int(np.argmin(distances))]
+    assert np.isclose(decisions[-1]['cosine'], np.min(distances), atol=1e-5)
+
+
+def test_identifier_unknown_speaker():
+    gallery = SpeakerGallery(['a'], [embed(np.ones((1, 390)))[0]])
+    identifier = StreamingSpeakerIdentifier(embed, gallery, RATE, interval_ms=500, match_threshold=-1.0)
+    decisions = identifier.push(signal(RATE))
+    assert len(decisions) == 1 and decisions[0]['speaker'] is None and decisions[0]['cosine'] is not None
@@ -0,0 +1,122 @@
+import h5py
+import numpy as np
+import pytest
+
+from deepspeaker.training_data import INPUT_DIM, TrainingData, is_training_data, prefetch, speaker_batches, \
+    triplet_batches, write_training_data
+
+
+def write_full_inputs(filename, rows_by_speaker, seed=0):
+    """full_inputs.h5 as written by deepdish: <speaker>/<split>/i0, i1, ... Returns the rows of every split."""
+    rng = np.random.RandomState(seed)
+    expected = {'train': [], 'test': []}
+    with h5py.File(filename, 'w') as f:
+        for speaker_id, counts in sorted(rows_by_speaker.items()):
+            for split in ('train', 'test'):
+                group = f.create_group('{}/{}'.format(speaker_id, split))
+                group.attrs['TITLE'] = np.bytes_('list')
+                for i, n in enumerate(counts):
+                    item = rng.normal(size=(n, INPUT_DIM)).astype(np.float32)
+                    group.create_dataset('i{}'.format(i), data=item)
+                    expected[split].append((speaker_id, item))
+    return expected
+
+
+@pytest.fixture
+def training_data_filename(tmp_path):
+    full_inputs_filename = str(tmp_path / 'full_inputs.h5')
+    rows_by_speaker = {'p225': [3, 5], 'p226': [4], 'p227': [2, 2, 6]}
+    expected = write_full_inputs(full_inputs_filename, rows_by_speaker)
+    filename = str(tmp_path / 'full_inputs_chunked.h5')
+    write_training_data(full_inputs_filename, filename, chunk_rows=4)
+    return filename, expected
+
+
+def test_write_and_read(training_data_filename):
+    filename, expected = training_data_filename
+    assert is_training_data(filename)
+    for split in ('train', 'test'):
+        data = TrainingData(filename, split)
+        try:
+            assert data.speaker_ids == ['p225', 'p226', 'p227']
+            x = np.vstack([item for _, item in expected[split]])
+            speaker = np.concatenate([[data.speaker_ids.index(s)] * len(item) for s, item in expected[split]])
+            assert len(data) == len(x)
+            assert np.array_equal(data.x[:], x)
+            assert np.array_equal(data.speaker, speaker)
+            for s, indices in data.indices_by_speaker.items():
+                assert np.array_equal(indices, np.where(speaker == s)[0])
+            # rows drawn with replacement, in any order.
+            indices = np.array([7, 0, 7, 3, 20])
+            read_x, read_s = data.read(indices)
+            assert np.array_equal(read_x, x[indices])
+            assert np.array_equal(read_s, speaker[indices])
+        finally:
+            data.close()
+
+
+def test_batches_cover_every_row(training_data_filename):
+    filename, _ = training_data_filename
+    data = TrainingData(filename)
+    try:
+        batch_size = 11  # larger than the shuffle buffer: incomplete batches are carried over.
+        assert len(data) % batch_size == 0
+        batches = data.batches(batch_size, shuffle=True, buffer_chunks=2)
+        xs, ys = zip(*[next(batches) for _ in range(len(data) // batch_size)])
+        x, y = np.vstack(xs), np.vstack(ys)
+        assert x.shape == (len(data), INPUT_DIM)
+        # every row exactly once per epoch, with its label.
+        order = np.lexsort(x.T)
+        expected_order = np.lexsort(data.x[:].T)
+        assert np.array_equal(x[order], data.x[:][expected_order])
+        assert np.array_equal(np.argmax(y, axis=1)[order], data.speaker[expected_order])
+    finally:
+        data.close()
+
+
+def test_triplet_batches_layout(training_data_filename):
+    filename, _ = training_data_filename
+    train, test = TrainingData(filename, 'train'), TrainingData(filename, 'test')
+    try:
+        batches = triplet_batches(train, test, batch_size=6)
+        for _ in range(10):
+            (anchor_positive_speaker, negative_speaker), (x, y), (test_x, test_y) = next(batches)
+            assert anchor_positive_speaker != negative_speaker
+            assert x.shape == (6, INPUT_DIM) and test_x.shape == (6, INPUT_DIM)
+            for labels in (np.argmax(y, axis=1), np.argmax(test_y, axis=1)):
+                assert list(labels) == [anchor_positive_speaker] * 4 + [negative_speaker] * 2
+            for row, label in zip(x, np.argmax(y, axis=1)):
+                assert any(np.array_equal(row, train.x[i]) for i in train.indices_by_speaker[label])
+    finally:
+        train.close()
+        test.close()
+
+
+def test_speaker_batches_layout(training_data_filename):
+    filename, _ = training_data_filename
+    train, test = TrainingData(filename, 'train'), TrainingData(filename, 'test')
+    try:
+        with pytest.raises(AssertionError):
+            next(speaker_batches(train, test, batch_size=7, num_speakers=3))
+        batches = speaker_batches(train, test, batch_size=6, num_speakers=3)
+        speakers, (x, y), (test_x, test_y) = next(batches)
+        assert sorted(speakers) == [0, 1, 2]
+        assert x.shape == (6, INPUT_DIM)
+        assert list(np.argmax(y, axis=1)) == [s for s in speakers for _ in range(2)]
+        assert list(np.argmax(test_y, axis=1)) == [s for s in speakers for _ in range(2)]
+    finally:
+        train.close()
+        test.close()
+
+
+def test_prefetch():
+    assert list(prefetch(iter(range(10)), size=2)) == list(range(10))
+
+    def failing():
+        yield 1
+        raise ValueError('broken')
+
+    items = prefetch(failing())
+    assert next(items) == 1
+    with pytest.raises(ValueError):
+        next(items)
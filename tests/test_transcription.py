@@ -0,0 +1,214 @@
+import json
+import threading
+import time
+import wave
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+import numpy as np
+import pytest
+
+from transcription import TranscriptionClient, TranscriptionError, multipart_file_body, parse_transcript, \
+	transcribe_long, write_wav
+
+
+class FakeService(ThreadingMixIn, HTTPServer):
+	"""Transcription service answering the statuses of self.statuses in turn (200 when empty), or hanging."""
+	daemon_threads = True
+
+	def __init__(self):
+		self.statuses = []
+		self.hang = False
+		self.requests = 0
+		self.connections = 0
+		self.bodies = []
+		super().__init__(('127.0.0.1', 0), FakeHandler)
+
+	@property
+	def url(self):
+		return 'http://127.0.0.1:{}/transcribe'.format(self.server_address[1])
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+	protocol_version = 'HTTP/1.1'
+
+	def setup(self):
+		super().setup()
+		self.server.connections += 1
+
+	def log_message(self, *args):
+		pass
+
+	def do_POST(self):
+		self.server.requests += 1
+		self.server.bodies.append(self.rfile.read(int(self.headers['Content-Length'])))
+		if self.server.hang:
+			time.sleep(1)
+			return
+		status = self.server.statuses.pop(0) if self.server.statuses else 200
+		body = 'transcript {}'.format(self.server.requests).encode('utf8')
+		self.send_response(status)
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+
+@pytest.fixture
+def service():
+	server = FakeService()
+	threading.Thread(target=server.serve_forever, daemon=True).start()
+	yield server
+	server.shutdown()
+	server.server_close()
+
+
+@pytest.fixture
+def audio_file(tmp_path):
+	filename = str(tmp_path / 'upload.wav')
+	with open(filename, 'wb') as w:
+		w.write(b'RIFF' + bytes(range(256)) * 10)
+	return filename
+
+
+def test_multipart_body(audio_file):
+	content_type, length, body = multipart_file_body(audio_file, chunk_size=100)
+	data = b''.join(body)
+	assert len(data) == length
+	boundary = content_type.split('boundary=')[1].encode('utf8')
+	with open(audio_file, 'rb') as r:
+		assert b'\r\n\r\n' + r.read() + b'\r\n--' + boundary + b'--' in data
+	assert b'name="file"; filename="upload.wav"' in data
+
+
+def test_transcribe_reuses_connections(service, audio_file):
+	client = TranscriptionClient(service.url)
+	assert client.transcribe(audio_file) == 'transcript 1'
+	assert client.transcribe(audio_file) == 'transcript 2'
+	assert service.connections == 1
+	with open(audio_file, 'rb') as r:
+		assert r.read() in service.bodies[0]
+	client.close()
+
+
+def test_retries_unavailable_service(service, audio_file):
+	service.statuses = [503, 502]
+	client = TranscriptionClient(service.url, retries=2, backoff=0.01)
+	assert client.transcribe(audio_file) == 'transcript 3'
+	client.close()
+
+
+def test_gives_up_after_retries(service, audio_file):
+	service.statuses = [503, 503, 503]
+	client = TranscriptionClient(service.url, retries=2, backoff=0.01)
+	with pytest.raises(TranscriptionError):
+		client.transcribe(audio_file)
+	assert service.requests == 3
+	client.close()
+
+
+def test_client_errors_are_not_retried(service, audio_file):
+	service.statuses = [400]
+	client = TranscriptionClient(service.url, retries=2, backoff=0.01)
+	with pytest.raises(TranscriptionError):
+		client.transcribe(audio_file)
+	assert service.requests == 1
+	client.close()
+
+
+def test_timeouts_are_not_retried(service, audio_file):
+	service.hang = True
+	client = TranscriptionClient(service.url, timeout=0.3, retries=2, backoff=0.01)
+	started = time.time()
+	with pytest.raises(TranscriptionError):
+		client.transcribe(audio_file)
+	assert time.time() - started < 1.0
+	assert service.requests == 1
+	client.close()
+
+
+def test_unreachable_service(audio_file):
+	client = TranscriptionClient('http://127.0.0.1:1/transcribe', retries=1, backoff=0.01)
+	with pytest.raises(TranscriptionError):
+		client.transcribe(audio_file)
+
+
+def test_parse_transcript_formats():
+	assert parse_transcript('hello world', 3.0) == [(0.0, 3.0, 'hello world')]
+	assert parse_transcript('  ', 3.0) == []
+	assert parse_transcript(json.dumps({'transcript': 'hi'}), 2.0) == [(0.0, 2.0, 'hi')]
+	assert parse_transcript(json.dumps({'text': 'hi'}), 2.0) == [(0.0, 2.0, 'hi')]
+	segments = [{'start': 0.5, 'end': 1.0, 'text': 'a'}, {'start': 1.0, 'text': 'b'}]
+	assert parse_transcript(json.dumps({'segments': segments}), 2.0) == [(0.5, 1.0, 'a'), (1.0, 2.0, 'b')]
+	assert parse_transcript(json.dumps(segments), 2.0) == [(0.5, 1.0, 'a'), (1.0, 2.0, 'b')]
+
+
+def test_write_wav(tmp_path):
+	filename = str(tmp_path / 'chunk.wav')
+	audio = np.linspace(-1, 1, 8000)
+	write_wav(filename, audio, 8000)
+	with wave.open(filename, 'rb') as r:
+		assert (r.getnchannels(), r.getsampwidth(), r.getframerate(), r.getnframes()) == (1, 2, 8000, 8000)
+		pcm = np.frombuffer(r.readframes(8000), dtype='<i2')
+	assert np.allclose(pcm / 32767.0, audio, atol=1e-4)
+
+
+def speech_with_pauses(sample_rate, num_words=12, word_sec=4.0, pause_sec=0.5, seed=0):
+	rng = np.random.RandomState(seed)
+	parts = []
+	for _ in range(num_words):
+		parts.append(rng.uniform(-0.5, 0.5, size=int(word_sec * sample_rate)))
+		parts.append(np.zeros(int(pause_sec * sample_rate)))
+	return np.concatenate(parts)
+
+
+def test_split_on_silence():
+	audio_reader = pytest.importorskip('deepspeaker.audio_reader', exc_type=ImportError)
+	audio = speech_with_pauses(8000)
+	chunks = audio_reader.split_on_silence(audio, 8000, max_chunk_sec=10.0, min_chunk_sec=3.0)
+	assert chunks[0][0] == 0 and chunks[-1][1] == len(audio)
+	for (_, end), (start, _) in zip(chunks, chunks[1:]):
+		assert end == start
+		assert np.all(audio[end - 40:end + 40] == 0)  # cut in a pause.
+	assert all(end - start <= 10.0 * 8000 for start, end in chunks)
+	assert audio_reader.split_on_silence(np.ones(30), 8000) == [(0, 30)]
+	assert audio_reader.split_on_silence(np.zeros(0), 8000) == []
+
+
+@pytest.mark.parametrize('max_chunk_sec', [5.0, 3.0, 0.01, 0.0])
+def test_split_on_silence_max_not_above_min(max_chunk_sec):
+	audio_reader = pytest.importorskip('deepspeaker.audio_reader', exc_type=ImportError)
+	audio = speech_with_pauses(8000)[0:12 * 8000]
+	chunks = audio_reader.split_on_silence(audio, 8000, max_chunk_sec=max_chunk_sec, min_chunk_sec=5.0)
+	assert chunks[0][0] == 0 and chunks[-1][1] == len(audio)
+	for (_, end), (start, _) in zip(chunks, chunks[1:]):
+		assert end == start
+	assert all(end > start for start, end in chunks)
+	if max_chunk_sec >= 0.02:
+		assert all(end - start <= max_chunk_sec * 8000 for start, end in chunks)
+
+
+class FakeClient:
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.calls = 0
+
+	def transcribe(self, filename):
+		with wave.open(filename, 'rb') as r:
+			duration = r.getnframes() / r.getframerate()
+		with self.lock:
+			self.calls += 1
+		return json.dumps({'segments': [{'start': 0.0, 'end': duration, 'text': '{:.2f}'.format(duration)}]})
+
+
+def test_transcribe_long_stitches_chunks_in_order(tmp_path):
+	pytest.importorskip('deepspeaker.audio_reader', exc_type=ImportError)
+	filename = str(tmp_path / 'meeting.wav')
+	write_wav(filename, speech_with_pauses(8000), 8000)
+	client = FakeClient()
+	segments = transcribe_long(client, filename, fan_out=3, max_chunk_sec=10.0, min_chunk_sec=3.0)
+	assert client.calls == len(segments) > 1
+	assert segments[0]['start'] == 0.0
+	for previous, segment in zip(segments, segments[1:]):
+		assert np.isclose(previous['end'], segment['start'])
+	assert np.isclose(segments[-1]['end'], 12 * 4.5)
@@ -0,0 +1,80 @@
+import itertools
+
+import numpy as np
+import pytest
+
+K = pytest.importorskip('keras.backend', exc_type=ImportError)
+
+from deepspeaker.triplet_loss import alpha, batch_all_triplet_loss, batch_hard_triplet_loss, \
+    deep_speaker_loss  # noqa: E402
+
+
+def toy_batch(num_speakers=3, per_speaker=2, dim=8, seed=0):
+    rng = np.random.RandomState(seed)
+    y_pred = rng.normal(size=(num_speakers * per_speaker, dim)).astype(np.float32)
+    y_pred /= np.linalg.norm(y_pred, axis=1, keepdims=True)
+    labels = np.repeat(np.arange(num_speakers), per_speaker)
+    y_true = np.eye(num_speakers, dtype=np.float32)[labels]
+    return y_true, y_pred, labels
+
+
+def evaluate(loss, y_true, y_pred):
+    return float(K.eval(loss(K.constant(y_true), K.constant(y_pred))))
+
+
+def brute_force_triplets(labels):
+    n = len(labels)
+    return [(a, p, q) for a, p, q in itertools.product(range(n), repeat=3)
+            if a != p and labels[a] == labels[p] and labels[a] != labels[q]]
+
+
+def test_batch_all_matches_brute_force():
+    y_true, y_pred, labels = toy_batch()
+    sim = y_pred.dot(y_pred.T)
+    losses = [max(sim[a, q] - sim[a, p] + alpha, 0.0) for a, p, q in brute_force_triplets(labels)]
+    positive = [loss for loss in losses if loss > 1e-16]
+    assert np.isclose(evaluate(batch_all_triplet_loss, y_true, y_pred), sum(positive) / max(len(positive), 1),
+                      atol=1e-5)
+
+
+def test_batch_hard_matches_brute_force():
+    y_true, y_pred, labels = toy_batch(num_speakers=3, per_speaker=3, seed=1)
+    sim = y_pred.dot(y_pred.T)
+    losses = []
+    for a in range(len(labels)):
+        positives = [sim[a, p] for p in range(len(labels)) if p != a and labels[p] == labels[a]]
+        negatives = [sim[a, q] for q in range(len(labels)) if labels[q] != labels[a]]
+        losses.append(max(max(negatives) - min(positives) + alpha, 0.0))
+    assert np.isclose(evaluate(batch_hard_triplet_loss, y_true, y_pred), np.mean(losses), atol=1e-5)
+
+
+def test_batch_hard_ignores_anchors_without_positive():
+    # speakers 1 and 2 have a single input: they are only used as negatives.
+    _, y_pred, _ = toy_batch(num_speakers=2, per_speaker=2, seed=2)
+    labels = np.array([0, 0, 1, 2])
+    y_true = np.eye(3, dtype=np.float32)[labels]
+    sim = y_pred.dot(y_pred.T)
+    losses = []
+    for a in range(4):
+        positives = [sim[a, p] for p in range(4) if p != a and labels[p] == labels[a]]
+        negatives = [sim[a, q] for q in range(4) if labels[q] != labels[a]]
+        if positives:
+            losses.append(max(max(negatives) - min(positives) + alpha, 0.0))
+    assert np.isclose(evaluate(batch_hard_triplet_loss, y_true, y_pred), np.mean(losses), atol=1e-5)
+
+
+def test_well_separated_batch_has_no_loss():
+    labels = np.repeat(np.arange(3), 2)
+    y_pred = np.eye(3, dtype=np.float32)[labels]  # same speaker: identical, other speakers: orthogonal.
+    y_true = np.eye(3, dtype=np.float32)[labels]
+    assert evaluate(batch_hard_triplet_loss, y_true, y_pred) == pytest.approx(0.0)
+    assert evaluate(batch_all_triplet_loss, y_true, y_pred) == pytest.approx(0.0)
+
+
+def test_fixed_layout_loss():
+    rng = np.random.RandomState(3)
+    y_pred = rng.normal(size=(6, 8)).astype(np.float32)
+    y_pred /= np.linalg.norm(y_pred, axis=1, keepdims=True)
+    anchor, positive, negative = y_pred[0:2], y_pred[2:4], y_pred[4:6]
+    expected = np.mean(np.maximum(np.sum(anchor * negative, axis=1) - np.sum(anchor * positive, axis=1) + alpha, 0))
+    assert np.isclose(evaluate(deep_speaker_loss, np.zeros_like(y_pred), y_pred), expected, atol=1e-5)
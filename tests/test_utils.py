@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+
+# deepspeaker.utils needs the training dependencies (deepdish, namedtupled...).
+utils = pytest.importorskip('deepspeaker.utils', exc_type=ImportError)
+
+from deepspeaker.constants import c  # noqa: E402
+from deepspeaker.speech_features import get_mfcc_features_390  # noqa: E402
+
+
+def entities(*lengths, seed=0):
+    rng = np.random.RandomState(seed)
+    return [{'audio_voice_only': rng.uniform(low=-1, high=1, size=(n, 1)).astype(np.float32)} for n in lengths]
+
+
+def test_sliding_keeps_every_input():
+    audio_entities = entities(8000, 12000)
+    features = utils.generate_features_sliding(audio_entities)
+    assert len(features) == 2
+    for feat, entity in zip(features, audio_entities):
+        assert np.allclose(feat, get_mfcc_features_390(entity['audio_voice_only'], c.AUDIO.SAMPLE_RATE))
+
+
+def test_sliding_is_deterministic():
+    audio_entities = entities(8000)
+    assert np.array_equal(utils.generate_features_sliding(audio_entities)[0], utils.generate_features_sliding(audio_entities)[0])
+
+
+def test_sliding_stride_and_max_inputs():
+    audio_entities = entities(16000)
+    full = utils.generate_features_sliding(audio_entities)[0]
+    assert np.array_equal(utils.generate_features_sliding(audio_entities, stride=3)[0], full[::3])
+    subset = utils.generate_features_sliding(audio_entities, max_inputs=10)[0]
+    assert np.array_equal(subset, full[np.linspace(0, len(full) - 1, 10).astype(int)])
+
+
+def test_sliding_drops_signals_too_short():
+    assert len(utils.generate_features_sliding(entities(100, 8000))) == 1
+
+
+def test_patch_unified_inputs_round_trip(tmp_path):
+    import deepdish as dd
+
+    def inputs(speaker_id, seed):
+        rng = np.random.RandomState(seed)
+        return {'train': rng.normal(size=(4, 39, 10)).astype(np.float32),
+                'test': rng.normal(size=(2, 39, 10)).astype(np.float32),
+                'speaker_id': speaker_id,
+                'mean_train': float(rng.normal()),
+                'std_train': float(rng.uniform(1, 2))}
+
+    speakers = {'p225': inputs('p225', 0), 'p226': inputs('p226', 1), 'p227': inputs('p227', 2)}
+    full_inputs_filename = str(tmp_path / 'full_inputs.h5')
+    dd.io.save(full_inputs_filename, speakers)
+
+    # p225 is updated, p226 removed, p228 added.
+    speakers['p225'] = inputs('p225', 3)
+    del speakers['p226']
+    speakers['p228'] = inputs('p228', 4)
+    inputs_filenames = {}
+    for speaker_id in ['p225', 'p227', 'p228']:
+        inputs_filenames[speaker_id] = str(tmp_path / '{}.h5'.format(speaker_id))
+        dd.io.save(inputs_filenames[speaker_id], speakers[speaker_id])
+    utils.patch_unified_inputs(full_inputs_filename, inputs_filenames, ['p225'])
+
+    patched = dd.io.load(full_inputs_filename)
+    assert sorted(patched) == ['p225', 'p227', 'p228']
+    for speaker_id, expected in speakers.items():
+        assert patched[speaker_id]['speaker_id'] == expected['speaker_id']
+        assert patched[speaker_id]['mean_train'] == expected['mean_train']
+        assert patched[speaker_id]['std_train'] == expected['std_train']
+        assert np.array_equal(patched[speaker_id]['train'], expected['train'])
+        assert np.array_equal(patched[speaker_id]['test'], expected['test'])
@@ -0,0 +1,234 @@
+import http.client
+import json
+import logging
+import os
+import queue
+import shutil
+import socket
+import tempfile
+import time
+import uuid
+import wave
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+TRANSCRIBE_URL = 'http://0.0.0.0:4000/transcribe'
+RETRY_STATUSES = (502, 503, 504)
+
+
+class TranscriptionError(Exception):
+	pass
+
+
+def multipart_file_body(filename, field='file', boundary=None, chunk_size=64 * 1024):
+	"""
+	Streams filename as a multipart/form-data body without loading it in memory.
+	Returns (content_type, content_length, body generator).
+	"""
+	boundary = boundary or uuid.uuid4().hex
+	basename = os.path.basename(filename).replace('"', '')
+	head = ('--{}\r\nContent-Disposition: form-data; name="{}"; filename="{}"\r\n'
+			'Content-Type: application/octet-stream\r\n\r\n').format(boundary, field, basename).encode('utf8')
+	tail = '\r\n--{}--\r\n'.format(boundary).encode('utf8')
+	length = len(head) + os.path.getsize(filename) + len(tail)
+
+	def body():
+		yield head
+		with open(filename, 'rb') as f:
+			while True:
+				chunk = f.read(chunk_size)
+				if not chunk:
+					break
+				yield chunk
+		yield tail
+
+	return 'multipart/form-data; boundary={}'.format(boundary), length, body()
+
+
+class TranscriptionClient:
+	"""
+	Client of the transcription service (POST <url> with the audio file as multipart 'file').
+	Keeps a pool of keep-alive connections, streams the upload from disk and retries
+	on connection errors and 502/503/504 with exponential backoff.
+	"""
+
+	def __init__(self, url=TRANSCRIBE_URL, pool_size=8, timeout=300.0, retries=2, backoff=0.5):
+		parts = urlsplit(url)
+		self.host = parts.hostname
+		self.port = parts.port
+		self.path = parts.path or '/'
+		self.https = parts.scheme == 'https'
+		self.timeout = timeout
+		self.retries = retries
+		self.backoff = backoff
+		self.idle = queue.LifoQueue(maxsize=pool_size)
+
+	def _acquire(self):
+		try:
+			return self.idle.get_nowait()
+		except queue.Empty:
+			connection_class = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+			return connection_class(self.host, self.port, timeout=self.timeout)
+
+	def _release(self, conn):
+		try:
+			self.idle.put_nowait(conn)
+		except queue.Full:
+			conn.close()
+
+	def _post_file(self, filename):
+		content_type, length, body = multipart_file_body(filename)
+		conn = self._acquire()
+		try:
+			conn.request('POST', self.path, body=body,
+						 headers={'Content-Type': content_type, 'Content-Length': str(length)})
+			response = conn.getresponse()
+			data = response.read()
+		except Exception:
+			conn.close()
+			raise
+		if response.will_close:
+			conn.close()
+		else:
+			self._release(conn)
+		return response.status, data
+
+	def transcribe(self, filename):
+		"""
+		Returns the body of the service's response, decoded. A request that timed out is not retried (the service
+		is hung, not restarting), and no retry starts after timeout seconds in total.
+		"""
+		started = time.time()
+		for attempt in range(self.retries + 1):
+			try:
+				status, data = self._post_file(filename)
+			except socket.timeout as e:
+				raise TranscriptionError('Transcription service timed out after {}s: {}'.format(self.timeout, e))
+			except (http.client.HTTPException, OSError) as e:
+				# also covers keep-alive connections closed by the service in the meantime.
+				error = 'Transcription service unreachable: {}'.format(e)
+			else:
+				if status < 400:
+					return data.decode('utf8')
+				error = 'Transcription service answered {}: {}'.format(status, data[:200])
+				if status not in RETRY_STATUSES:
+					raise TranscriptionError(error)
+			delay = self.backoff * (2 ** attempt)
+			if attempt == self.retries or time.time() - started + delay > self.timeout:
+				raise TranscriptionError(error)
+			logger.warning('{}, retrying.'.format(error))
+			time.sleep(delay)
+
+	def close(self):
+		while True:
+			try:
+				self.idle.get_nowait().close()
+			except queue.Empty:
+				break
+
+
+def write_wav(filename, audio, sample_rate):
+	pcm = (np.clip(np.asarray(audio).reshape(-1), -1.0, 1.0) * 32767).astype('<i2')
+	with wave.open(filename, 'wb') as w:
+		w.setnchannels(1)
+		w.setsampwidth(2)
+		w.setframerate(sample_rate)
+		w.writeframes(pcm.tobytes())
+
+
+def parse_transcript(response, duration):
+	"""
+	Segments [(start, end, text)] relative to the chunk, from the service response. Accepts a JSON
+	list of {start, end, text} segments, a JSON object with 'segments', 'transcript' or 'text', or plain text.
+	"""
+	try:
+		obj = json.loads(response)
+	except ValueError:
+		obj = response
+	if isinstance(obj, dict):
+		if isinstance(obj.get('segments'), list):
+			obj = obj['segments']
+		else:
+			obj = obj.get('transcript', obj.get('text', ''))
+	if isinstance(obj, list):
+		segments = []
+		for seg in obj:
+			if isinstance(seg, dict):
+				text = seg.get('text', seg.get('transcript', ''))
+				segments.append((float(seg.get('start', 0.0)), float(seg.get('end', duration)), text))
+			else:
+				segments.append((0.0, duration, str(seg)))
+		return segments
+	text = str(obj).strip()
+	return [(0.0, duration, text)] if text else []
+
+
+def transcribe_long(client, filename, fan_out=4, max_chunk_sec=30.0, min_chunk_sec=5.0):
+	"""
+	Splits a long recording at silences (chunks of at most max_chunk_sec), sends the chunks to the
+	transcription service with fan_out concurrent requests and stitches the results back in order.
+	Returns [{'start', 'end', 'text'}] with timestamps in seconds from the beginning of the recording.
+	"""
+	import librosa
+	from deepspeaker.audio_reader import split_on_silence
+	audio, sample_rate = librosa.load(filename, sr=None, mono=True)
+	chunks = split_on_silence(audio, sample_rate, max_chunk_sec=max_chunk_sec, min_chunk_sec=min_chunk_sec)
+	logger.info('Transcribing {} in {} chunks ({} at a time).'.format(filename, len(chunks), fan_out))
+	tmp_dir = tempfile.mkdtemp(prefix='chunks_')
+	try:
+		chunk_filenames = []
+		for i, (start, end) in enumerate(chunks):
+			chunk_filename = os.path.join(tmp_dir, 'chunk_{:05d}.wav'.format(i))
+			write_wav(chunk_filename, audio[start:end], sample_rate)
+			chunk_filenames.append(chunk_filename)
+		with ThreadPoolExecutor(max_workers=max(1, fan_out)) as executor:
+			responses = list(executor.map(client.transcribe, chunk_filenames))  # in order.
+	finally:
+		shutil.rmtree(tmp_dir, ignore_errors=True)
+
+	segments = []
+	for (start, end), response in zip(chunks, responses):
+		offset = start / sample_rate
+		for seg_start, seg_end, text in parse_transcript(response, (end - start) / sample_rate):
+			segments.append({'start': offset + seg_start, 'end': offset + seg_end, 'text': text})
+	return segments
+
+
+def serve_stub(port=4000):
+	"""Local stand-in for the transcription service: answers every upload with a fixed transcript."""
+	import json
+	from http.server import BaseHTTPRequestHandler, HTTPServer
+	from socketserver import ThreadingMixIn
+
+	class StubHandler(BaseHTTPRequestHandler):
+		protocol_version = 'HTTP/1.1'  # keep-alive
+
+		def do_POST(self):
+			length = int(self.headers.get('Content-Length', 0))
+			received = 0
+			while received < length:
+				chunk = self.rfile.read(min(64 * 1024, length - received))
+				if not chunk:
+					break
+				received += len(chunk)
+			body = json.dumps({'transcript': 'stub transcript', 'bytes': received}).encode('utf8')
+			self.send_response(200)
+			self.send_header('Content-Type', 'application/json')
+			self.send_header('Content-Length', str(len(body)))
+			self.end_headers()
+			self.wfile.write(body)
+
+	class StubServer(ThreadingMixIn, HTTPServer):
+		daemon_threads = True
+
+	server = StubServer(('0.0.0.0', port), StubHandler)
+	print('Transcription stub listening on port {}.'.format(port))
+	server.serve_forever()
+
+
+if __name__ == '__main__':
+	serve_stub()